@@ -1,40 +1,187 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from dataclasses import dataclass
 from google.cloud.secretmanager import SecretManagerServiceAsyncClient, AccessSecretVersionResponse, SecretPayload
-from constants import PROJECT_ID, SECRET_NAME, SECRET_VERSION
+from google.cloud.secretmanager_v1.services.secret_manager_service.transports import SecretManagerServiceGrpcAsyncIOTransport
+from constants import SECRET_MANAGER_CHANNELS, PROJECT_ID, SECRET_NAME, SECRET_VERSION, API_KEY_CACHE_TTL_SECONDS, API_KEY_REFRESH_MARGIN_SECONDS
 from google_crc32c import Checksum
 from connexion.exceptions import Unauthorized
+from ClientUtils import ClientPool, ChannelInit, default_credentials
+from MetricsUtils import stage
 
-class AuthorizationUtils:
-    _client: SecretManagerServiceAsyncClient = None
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class ApiKey:
+    """The caller an api key belongs to, and the rate limit of its requests."""
+    # identifies the caller in logs and rate limits, without revealing the key
+    name: str
+    # None for the default rate limit, 0 for no rate limit
+    tokens_per_minute: float | None = None
+    burst: float | None = None
+
+def _digest(api_key: bytes) -> bytes:
+    """Returns the digest the provided api key is looked up by."""
+    return hashlib.sha256(api_key).digest()
+
+def _limit(entry: dict, field: str, minimum: float) -> float | None:
+    """Returns the provided rate limit field of an api key entry, None if it isn't set.
 
-    """Checks whether the provided api key is valid.
+    Raises:
+        ValueError if the field isn't a number of at least the provided minimum.
+    """
+    value = entry.get(field)
+    if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value < minimum):
+        raise ValueError(f"{field} has to be a number of at least {minimum}")
+    return value
+
+def parse_api_keys(data: bytes) -> dict[bytes, ApiKey]:
+    """Parses the api keys stored in the secret.
 
     Args:
-        api_key: The api key to be checked.
+        data: Either a single api key, which is named "default", or a json object mapping every api key to an object with the
+              unique name of its caller and optionally its rate limit, e.g. {"<key>": {"name": "team-a", "tokens_per_minute": 120, "burst": 40}}.
+
+    Returns:
+        The api keys by their digest.
 
     Raises:
-        Unauthorized if the api key is not valid or the data retrieved from the secret is corrupt.
+        Unauthorized if the json object is malformed, the rate isn't a non-negative number, the burst is less than the cost of a single
+        request (1) or a name is used by multiple keys.
     """
-    async def check_api_key(self, api_key: str) -> None:
-        self._prepare()
+    if not data.lstrip().startswith(b"{"):
+        return {_digest(data): ApiKey("default")}
+    try:
+        keys = {_digest(key.encode("UTF-8")): ApiKey(str(entry["name"]), _limit(entry, "tokens_per_minute", 0), _limit(entry, "burst", 1))
+                for key, entry in json.loads(data).items()}
+        # the rate limits are kept per name
+        if len({api_key.name for api_key in keys.values()}) != len(keys):
+            raise ValueError("the names of the api keys have to be unique")
+        return keys
+    except (ValueError, TypeError, KeyError, AttributeError) as exception:
+        raise Unauthorized("Malformed api keys") from exception
+
+class AuthorizationUtils:
+    """
+    Checks api keys against the api keys stored in the Google Cloud Secret Manager.
+
+    The keys are cached in memory for a configurable TTL and refreshed in the background shortly before they expire,
+    so the Secret Manager is only queried once per TTL instead of once per request. They are looked up by their digest,
+    so checking a key takes the same time no matter how many keys there are.
+    """
+
+    def __init__(self, ttl_seconds: float = API_KEY_CACHE_TTL_SECONDS, refresh_margin_seconds: float = API_KEY_REFRESH_MARGIN_SECONDS,
+                 clients: ClientPool[SecretManagerServiceAsyncClient] | None = None):
+        """
+        Args:
+            ttl_seconds: How long the key fetched from the Secret Manager is cached.
+            refresh_margin_seconds: How long before the cached key expires a background refresh is started.
+            clients: The pool of Secret Manager clients. If not given, a pool of SECRET_MANAGER_CHANNELS clients is used.
+        """
+        self._ttl_seconds = ttl_seconds
+        self._refresh_margin_seconds = refresh_margin_seconds
+        self._cached_keys: dict[bytes, ApiKey] | None = None
+        self._expires_at: float = 0.0
+        self._refresh_task: asyncio.Task | None = None
+        self.cache_hits: int = 0
+        self.cache_misses: int = 0
+        self.clients = clients or ClientPool("secret_manager", self._create_client, SECRET_MANAGER_CHANNELS, prepare=default_credentials)
+
+    @property
+    def cache_hit_rate(self) -> float:
+        """The share of key lookups that were served from the cache (0.0 if there were no lookups yet)."""
+        lookups = self.cache_hits + self.cache_misses
+        return self.cache_hits / lookups if lookups else 0.0
+
+    async def check_api_key(self, api_key: str) -> ApiKey:
+        """Checks whether the provided api key is valid.
+
+        Args:
+            api_key: The api key to be checked.
+
+        Returns:
+            The caller the api key belongs to.
+
+        Raises:
+            Unauthorized if the api key is not valid or the data retrieved from the secret is corrupt.
+        """
+        with stage("auth"):
+            expected_keys = await self._get_expected_keys()
+            # looked up by digest, so that the time of the lookup tells nothing about how much of a wrong key matches a valid one
+            key = expected_keys.get(_digest(api_key.encode("UTF-8")))
+            if key is None:
+                raise Unauthorized("Wrong API key")
+            return key
+
+    async def preload_key(self) -> None:
+        """Loads the api keys from the Secret Manager, e.g. at startup, so that the first request doesn't have to wait for them.
+
+        Raises:
+            Unauthorized if the data retrieved from the secret is corrupt.
+        """
+        await self.clients.warm_up()
+        await asyncio.shield(self._refresh())
+
+    async def _get_expected_keys(self) -> dict[bytes, ApiKey]:
+        """Returns the expected api keys, from the cache if they are still valid, otherwise from the Secret Manager.
+
+        If the cached keys are about to expire, a refresh is started in the background and the cached keys are returned.
+
+        Returns:
+            The expected api keys by their digest.
+        """
+        now = time.monotonic()
+        if self._cached_keys is not None and now < self._expires_at:
+            self.cache_hits += 1
+            if now >= self._expires_at - self._refresh_margin_seconds:
+                self._refresh()
+            return self._cached_keys
+        self.cache_misses += 1
+        # shielded so that a cancelled request doesn't cancel the refresh other requests are waiting for
+        return await asyncio.shield(self._refresh())
+
+    def _refresh(self) -> asyncio.Task:
+        """Starts loading the api keys from the Secret Manager unless a load is already in flight.
+
+        Returns:
+            The task loading the keys, shared by all callers while it is running.
+        """
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.ensure_future(self._load_keys())
+            self._refresh_task.add_done_callback(self._on_refresh_done)
+        return self._refresh_task
+
+    def _on_refresh_done(self, task: asyncio.Task) -> None:
+        """Clears the in-flight refresh and reports failures of refreshes nobody is waiting for."""
+        self._refresh_task = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("refreshing the api keys failed: %r", task.exception())
+
+    async def _load_keys(self) -> dict[bytes, ApiKey]:
+        """Loads the api keys from the Secret Manager and stores them in the cache.
+
+        Returns:
+            The api keys by their digest.
+
+        Raises:
+            Unauthorized if the data retrieved from the secret is corrupt.
+        """
         #https://cloud.google.com/secret-manager/docs/access-secret-version#access_a_secret_version
-        name: str = self._client.secret_version_path(PROJECT_ID, SECRET_NAME, SECRET_VERSION)
-        response: AccessSecretVersionResponse = await self._client.access_secret_version(name=name)
+        name: str = SecretManagerServiceAsyncClient.secret_version_path(PROJECT_ID, SECRET_NAME, SECRET_VERSION)
+        async with self.clients.lease() as client:
+            response: AccessSecretVersionResponse = await client.access_secret_version(name=name)
         payload: SecretPayload = response.payload
         crc32c = Checksum()
         crc32c.update(payload.data)
         if payload.data_crc32c != int(crc32c.hexdigest(), 16):
             raise Unauthorized("Data corruption detected")
-        expected_key = payload.data.decode("UTF-8")
-        if api_key != expected_key:
-            raise Unauthorized("Wrong API key")
-        
-    def _prepare(self):
-        """Intitializes the SecretManagerServiceClient if not yet done."""
-        if self._client is None:
-            print("instantiating SecretManagerServiceClient")
-            self._client = SecretManagerServiceAsyncClient()
-            print("instantiated SecretManagerServiceClient")
-        else:
-            print("SecretManagerServiceClient was already instantiated")
-
+        self._cached_keys = parse_api_keys(bytes(payload.data))
+        self._expires_at = time.monotonic() + self._ttl_seconds
+        return self._cached_keys
 
+    def _create_client(self, channel: ChannelInit) -> SecretManagerServiceAsyncClient:
+        """Creates a Secret Manager client whose calls are made via the provided channel."""
+        return SecretManagerServiceAsyncClient(transport=SecretManagerServiceGrpcAsyncIOTransport(credentials=default_credentials(), channel=channel(SecretManagerServiceGrpcAsyncIOTransport)))
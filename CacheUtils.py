@@ -0,0 +1,471 @@
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import tempfile
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+_cache_statuses: ContextVar[dict[str, str] | None] = ContextVar("cache_statuses", default=None)
+
+def track_cache_statuses() -> dict[str, str]:
+    """Starts tracking the cache lookups of the current request.
+
+    Returns:
+        The dict the lookups are recorded in, mapping the name of the consulted cache to "HIT" or "MISS".
+    """
+    statuses: dict[str, str] = {}
+    _cache_statuses.set(statuses)
+    return statuses
+
+def record_cache_status(cache_name: str, hit: bool) -> None:
+    """Records a cache lookup for the current request, if the lookups of the request are tracked.
+
+    Args:
+        cache_name: The name of the consulted cache, e.g. "poem".
+        hit: Whether the lookup was a hit.
+    """
+    statuses = _cache_statuses.get()
+    if statuses is not None:
+        statuses[cache_name] = "HIT" if hit else "MISS"
+
+def cache_headers(statuses: dict[str, str]) -> dict[str, str]:
+    """Builds the X-Cache response headers from the tracked cache lookups of a request.
+
+    X-Cache is HIT if all lookups were hits and MISS otherwise, X-Cache-Detail lists the lookups per cache.
+
+    Args:
+        statuses: The tracked cache lookups, see track_cache_statuses.
+
+    Returns:
+        The headers, empty if no cache was consulted.
+    """
+    if not statuses:
+        return {}
+    return {
+        "X-Cache": "HIT" if all(status == "HIT" for status in statuses.values()) else "MISS",
+        "X-Cache-Detail": ", ".join(f"{name}={status}" for name, status in statuses.items()),
+    }
+
+
+class LruCache:
+    """
+    An in-memory least recently used cache that is bounded by the total size of its entries and supports per-entry TTLs.
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Args:
+            max_bytes: The maximum total size of all entries (in bytes).
+        """
+        self._max_bytes = max_bytes
+        self._entries: OrderedDict[str, tuple[Any, int, float | None]] = OrderedDict()
+        self._size = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    @property
+    def size(self) -> int:
+        """The total size of all entries (in bytes)."""
+        return self._size
+
+    def get(self, key: str) -> Any | None:
+        """Returns the value for the provided key and marks it as recently used.
+
+        Args:
+            key: The key of the entry.
+
+        Returns:
+            The value, or None if there's no entry for the key or it is expired.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, _, expires_at = entry
+        if expires_at is not None and time.monotonic() >= expires_at:
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any, size: int, ttl_seconds: float | None = None) -> None:
+        """Stores the value for the provided key, evicting the least recently used entries if the cache gets too big.
+
+        Values bigger than the whole cache are not stored.
+
+        Args:
+            key: The key of the entry.
+            value: The value to be stored.
+            size: The size of the value (in bytes).
+            ttl_seconds: How long the entry is valid, or None if it doesn't expire.
+        """
+        self._remove(key)
+        if size > self._max_bytes:
+            return
+        expires_at = None if ttl_seconds is None else time.monotonic() + ttl_seconds
+        self._entries[key] = (value, size, expires_at)
+        self._size += size
+        while self._size > self._max_bytes:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self._size -= evicted_size
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        """Removes the entry for the provided key, if there is one."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+
+class SqliteCache:
+    """
+    A persistent cache backed by a SQLite database, which survives restarts and supports per-entry TTLs.
+
+    The database can be shared by multiple processes, e.g. the workers of a server. Every process opens its own
+    connection, also if the cache was created before the process was forked. As the cache is optional and its calls block,
+    they wait only briefly for the lock of another process: a failed read is a miss and a failed write is skipped.
+    """
+    _PURGE_INTERVAL = 100
+
+    def __init__(self, path: str, lock_timeout_seconds: float = 0.05):
+        """
+        Args:
+            path: The path of the SQLite database file, created if it doesn't exist.
+            lock_timeout_seconds: How long reads and writes wait for the lock of the database.
+        """
+        self._path = path
+        self._lock_timeout_seconds = lock_timeout_seconds
+        self._connection_pid: int | None = None
+        self._sets_since_purge = 0
+        # the number of reads and writes that failed, e.g. as the lock wasn't acquired in time
+        self.failures: int = 0
+        self._connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)")
+        try:
+            self._purge()
+        except sqlite3.OperationalError as exception:
+            self._failed("purging", exception)
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        """The connection of the current process, opened on first use, as connections must not be used across forks."""
+        if self._connection_pid != os.getpid():
+            self._current_connection = sqlite3.connect(self._path, timeout=self._lock_timeout_seconds, isolation_level=None, check_same_thread=False)
+            self._current_connection.execute("PRAGMA journal_mode=WAL")
+            self._connection_pid = os.getpid()
+        return self._current_connection
+
+    def get(self, key: str) -> tuple[bytes, float | None] | None:
+        """Returns the value for the provided key together with its expiry.
+
+        Args:
+            key: The key of the entry.
+
+        Returns:
+            The value and the time it expires at as unix timestamp (None if it doesn't expire),
+            or None if there's no entry for the key, it is expired or reading it failed.
+        """
+        try:
+            row = self._connection.execute(
+                "SELECT value, expires_at FROM entries WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, time.time())).fetchone()
+        except sqlite3.OperationalError as exception:
+            self._failed("reading", exception)
+            return None
+        return None if row is None else (bytes(row[0]), row[1])
+
+    def set(self, key: str, value: bytes, ttl_seconds: float | None = None) -> None:
+        """Stores the value for the provided key, unless writing it fails.
+
+        Args:
+            key: The key of the entry.
+            value: The value to be stored.
+            ttl_seconds: How long the entry is valid, or None if it doesn't expire.
+        """
+        expires_at = None if ttl_seconds is None else time.time() + ttl_seconds
+        try:
+            self._connection.execute("INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)", (key, value, expires_at))
+            self._sets_since_purge += 1
+            if self._sets_since_purge >= self._PURGE_INTERVAL:
+                self._purge()
+        except sqlite3.OperationalError as exception:
+            self._failed("writing", exception)
+
+    def _purge(self) -> None:
+        """Deletes all expired entries."""
+        self._connection.execute("DELETE FROM entries WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+        self._sets_since_purge = 0
+
+    def _failed(self, action: str, exception: sqlite3.OperationalError) -> None:
+        """Records that an access of the database failed, which the cache tolerates."""
+        self.failures += 1
+        logger.warning("%s the cache failed: %r", action, exception)
+
+
+class FileCache:
+    """
+    A persistent cache storing each entry as a file in a directory, bounded by the total size of its files.
+
+    Entries are returned as read-only memory mapped views of their files, so they are served without being copied into Python objects.
+    The least recently used files are deleted if the cache gets too big.
+
+    The directory can be shared by multiple processes, e.g. the workers of a server: files written by one process are served
+    by all, and the modification time of a file is its last use, so that every process rescanning the directory evicts
+    the least recently used files of all processes.
+    """
+    _RESCAN_INTERVAL = 100
+
+    def __init__(self, directory: str, max_bytes: int):
+        """
+        Args:
+            directory: The directory the files are stored in, created if it doesn't exist.
+            max_bytes: The maximum total size of all files (in bytes).
+        """
+        self._directory = directory
+        self._max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._sizes: OrderedDict[str, int] = OrderedDict()
+        self._size = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self._sets_since_scan = 0
+        self._scan()
+        self._evict()
+
+    @property
+    def size(self) -> int:
+        """The total size of all files (in bytes)."""
+        return self._size
+
+    def get(self, key: str) -> memoryview | None:
+        """Returns a memory mapped view of the file for the provided key and marks it as recently used.
+
+        Args:
+            key: The key of the entry, which has to be a valid file name.
+
+        Returns:
+            The view, or None if there's no file for the key.
+        """
+        try:
+            with open(self._path(key), "rb") as file:
+                # the mapping stays valid after the file is closed or deleted
+                view = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        except (FileNotFoundError, ValueError):
+            self._size -= self._sizes.pop(key, 0)
+            self.misses += 1
+            return None
+        if key in self._sizes:
+            self._sizes.move_to_end(key)
+        else:
+            # written by another process
+            self._sizes[key] = len(view)
+            self._size += len(view)
+        try:
+            # marks the file as recently used for the other processes
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return view
+
+    def set(self, key: str, value: bytes) -> None:
+        """Stores the value for the provided key in a file, evicting the least recently used files if the cache gets too big.
+
+        Values bigger than the whole cache are not stored.
+
+        Args:
+            key: The key of the entry, which has to be a valid file name.
+            value: The value to be stored.
+        """
+        if len(value) > self._max_bytes:
+            return
+        # written to a temporary file first, so that readers never see partially written files
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self._directory, prefix=".")
+        with os.fdopen(file_descriptor, "wb") as file:
+            file.write(value)
+        os.replace(temporary_path, self._path(key))
+        self._size += len(value) - self._sizes.pop(key, 0)
+        self._sizes[key] = len(value)
+        self._sets_since_scan += 1
+        if self._sets_since_scan >= self._RESCAN_INTERVAL:
+            self._scan()
+        self._evict()
+
+    def _scan(self) -> None:
+        """Rebuilds the index from the files in the directory, least recently used first, which includes the files of other processes."""
+        self._sizes.clear()
+        self._size = 0
+        entries = []
+        for entry in os.scandir(self._directory):
+            try:
+                if entry.is_file() and not entry.name.startswith("."):
+                    entries.append((entry.stat().st_mtime, entry.name, entry.stat().st_size))
+            except FileNotFoundError:
+                # deleted by another process meanwhile
+                pass
+        for _, name, size in sorted(entries):
+            self._sizes[name] = size
+            self._size += size
+        self._sets_since_scan = 0
+
+    def _evict(self) -> None:
+        """Deletes the least recently used files until the cache is small enough."""
+        while self._size > self._max_bytes:
+            key, size = self._sizes.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _path(self, key: str) -> str:
+        """Returns the path of the file for the provided key."""
+        return os.path.join(self._directory, key)
+
+
+class BytesCache:
+    """
+    Caches binary values in memory and optionally on disk.
+
+    Values found on disk are returned as memory mapped views and not copied to the memory tier.
+    """
+
+    def __init__(self, memory: LruCache, disk: FileCache | None = None):
+        """
+        Args:
+            memory: The in-memory tier.
+            disk: The optional on-disk tier.
+        """
+        self._memory = memory
+        self._disk = disk
+        self.hits: int = 0
+        self.misses: int = 0
+
+    @property
+    def evictions(self) -> int:
+        """The number of entries evicted from any tier."""
+        return self._memory.evictions + (0 if self._disk is None else self._disk.evictions)
+
+    def get(self, key: str) -> bytes | memoryview | None:
+        """Returns the value for the provided key.
+
+        Args:
+            key: The key of the entry, which has to be a valid file name.
+
+        Returns:
+            The value, or None if it isn't cached.
+        """
+        value = self._memory.get(key)
+        if value is None and self._disk is not None:
+            value = self._disk.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: bytes) -> None:
+        """Stores the value for the provided key in all tiers.
+
+        Args:
+            key: The key of the entry, which has to be a valid file name.
+            value: The value to be stored.
+        """
+        self._memory.set(key, value, len(value))
+        if self._disk is not None:
+            self._disk.set(key, value)
+
+
+@dataclass
+class _Variants:
+    """The variants cached for a key, and the index of the variant to serve next."""
+    values: list[str]
+    next: int = 0
+
+
+class VariantCache:
+    """
+    Caches up to a configurable number of text variants per key, in memory and optionally persistently.
+
+    Lookups are misses until all variants of a key have been stored, afterwards the variants are served round-robin.
+    """
+
+    def __init__(self, memory: LruCache, ttl_seconds: float | None, variants: int = 1, persistent: SqliteCache | None = None):
+        """
+        Args:
+            memory: The in-memory tier.
+            ttl_seconds: How long the variants of a key are valid after the last one was stored, or None if they don't expire.
+            variants: The number of variants served per key.
+            persistent: The optional persistent tier.
+        """
+        self._memory = memory
+        self._ttl_seconds = ttl_seconds
+        self._variants = variants
+        self._persistent = persistent
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def get(self, key: str) -> str | None:
+        """Returns the next variant for the provided key.
+
+        Args:
+            key: The key of the variants.
+
+        Returns:
+            The variant, or None if not all variants of the key are cached yet.
+        """
+        variants = self._load(key)
+        if variants is None or len(variants.values) < self._variants:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value = variants.values[variants.next % len(variants.values)]
+        variants.next += 1
+        return value
+
+    def put(self, key: str, value: str) -> None:
+        """Adds a variant for the provided key, unless all its variants are already cached.
+
+        Args:
+            key: The key of the variants.
+            value: The variant to be added.
+        """
+        variants = self._load(key) or _Variants([])
+        if len(variants.values) >= self._variants:
+            return
+        variants.values.append(value)
+        self._store(key, variants, self._ttl_seconds)
+        if self._persistent is not None:
+            self._persistent.set(key, json.dumps(variants.values).encode("UTF-8"), self._ttl_seconds)
+
+    def _load(self, key: str) -> _Variants | None:
+        """Loads the variants for the provided key from memory, or from the persistent tier into memory.
+
+        Incomplete variants are reloaded from the persistent tier, as other processes sharing it might have added variants.
+        """
+        variants: _Variants | None = self._memory.get(key)
+        if self._persistent is None or (variants is not None and len(variants.values) >= self._variants):
+            return variants
+        entry = self._persistent.get(key)
+        if entry is None or (variants is not None and len(json.loads(entry[0])) <= len(variants.values)):
+            return variants
+        data, expires_at = entry
+        variants = _Variants(json.loads(data))
+        self._store(key, variants, None if expires_at is None else expires_at - time.time())
+        return variants
+
+    def _store(self, key: str, variants: _Variants, ttl_seconds: float | None) -> None:
+        """Stores the variants for the provided key in memory."""
+        size = sum(len(value.encode("UTF-8")) for value in variants.values)
+        self._memory.set(key, variants, size, ttl_seconds)
@@ -0,0 +1,196 @@
+import asyncio
+import functools
+import logging
+import weakref
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Generic, TypeVar
+import google.auth
+import grpc
+from google.auth.credentials import Credentials
+from constants import GRPC_KEEPALIVE_SECONDS, GRPC_KEEPALIVE_TIMEOUT_SECONDS, GRPC_MAX_STREAMS_PER_CHANNEL, GRPC_MAX_CHANNELS
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Creates the channel of a client, as passed to the `channel` argument of the gRPC asyncio transports of the Google clients.
+ChannelInit = Callable[..., grpc.aio.Channel]
+
+# The OAuth scope requested by the Google clients.
+_CLOUD_PLATFORM_SCOPE = "https://www.googleapis.com/auth/cloud-platform"
+
+
+@functools.cache
+def default_credentials() -> Credentials:
+    """Returns the application default credentials, resolved once and shared by the clients of all pools and event loops.
+
+    Resolving them blocks, e.g. while reading the key file or querying the metadata server, so the pools call it in a thread.
+    """
+    credentials, _ = google.auth.default(scopes=[_CLOUD_PLATFORM_SCOPE])
+    return credentials
+
+
+def channel_options(keepalive_seconds: float = GRPC_KEEPALIVE_SECONDS, keepalive_timeout_seconds: float = GRPC_KEEPALIVE_TIMEOUT_SECONDS) -> list[tuple[str, int]]:
+    """Returns the options of the pooled gRPC channels.
+
+    Args:
+        keepalive_seconds: After how long without activity the connection is pinged, so that dead connections are noticed.
+        keepalive_timeout_seconds: How long a ping may take before the connection is considered dead and reconnected.
+    """
+    return [
+        # every channel gets its own connection, instead of sharing the connection of channels with the same target and options
+        ("grpc.use_local_subchannel_pool", 1),
+        ("grpc.keepalive_time_ms", int(keepalive_seconds * 1000)),
+        ("grpc.keepalive_timeout_ms", int(keepalive_timeout_seconds * 1000)),
+        # pinging only while calls are in flight, as Google's frontends close connections that are pinged too often while idle
+        ("grpc.keepalive_permit_without_calls", 0),
+        ("grpc.http2.max_pings_without_data", 0),
+    ]
+
+
+@dataclass
+class _PooledClient(Generic[T]):
+    client: T
+    # None for clients without gRPC channel, e.g. fakes
+    channel: grpc.aio.Channel | None = None
+    in_flight: int = 0
+
+    @property
+    def state(self) -> grpc.ChannelConnectivity | None:
+        """The connectivity state of the channel, without triggering a connection."""
+        return None if self.channel is None else self.channel.get_state(try_to_connect=False)
+
+
+@dataclass
+class _LoopClients(Generic[T]):
+    # the clients calls are spread over
+    active: list[_PooledClient[T]]
+    # created ahead of time and activated once all active channels carry the maximum number of streams, not connected before
+    spare: list[_PooledClient[T]] = field(default_factory=list)
+
+
+class ClientPool(Generic[T]):
+    """
+    Provides the clients of an upstream from a small pool of clients per event loop, each with its own gRPC channel.
+
+    gRPC asyncio channels belong to the event loop they were created on, so every event loop (e.g. of a test or of another thread)
+    gets its own clients. Calls lease the client with the fewest calls in flight, so that the concurrent calls are spread over
+    multiple HTTP/2 connections instead of being multiplexed over a single one. If all channels carry the maximum number of streams,
+    further channels are added up to the maximum number of channels. Channels failing to connect are avoided while others
+    are healthy, and channels that were shut down are replaced.
+
+    The clients of an event loop, including the ones added under load, are all created when the event loop first needs them, e.g. by
+    the warm-up, so that calls don't wait for it. What blocks, e.g. resolving the credentials, is prepared once in a thread before,
+    whereas the clients themselves are created on the event loop, as gRPC asyncio channels can't be created in other threads.
+    """
+
+    def __init__(self, name: str, factory: Callable[[Callable[[type], ChannelInit]], T], size: int,
+                 max_size: int = GRPC_MAX_CHANNELS, max_streams_per_channel: int = GRPC_MAX_STREAMS_PER_CHANNEL, options: list[tuple[str, Any]] | None = None,
+                 prepare: Callable[[], Any] | None = None):
+        """
+        Args:
+            name: The name of the upstream, used in logs and metrics.
+            factory: Creates a client, given a function that returns the channel init for the gRPC asyncio transport class of the client.
+            size: The number of clients used per event loop.
+            max_size: The maximum number of clients per event loop.
+            max_streams_per_channel: The number of calls in flight per channel beyond which further channels are added.
+            options: The options of the gRPC channels, see channel_options if not given.
+            prepare: Prepares what the factory needs and blocks, e.g. default_credentials, called in a thread before the first clients are created.
+        """
+        self.name = name
+        self._factory = factory
+        self._size = size
+        self._max_size = max(size, max_size)
+        self._max_streams_per_channel = max_streams_per_channel
+        self._options = channel_options() if options is None else options
+        self._prepare = prepare
+        self._clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _LoopClients[T]] = weakref.WeakKeyDictionary()
+        self._creating: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Task] = weakref.WeakKeyDictionary()
+        self.created: int = 0
+        self.replaced: int = 0
+
+    @asynccontextmanager
+    async def lease(self) -> AsyncIterator[T]:
+        """Provides the least loaded healthy client of the current event loop while the context is active.
+
+        Returns:
+            The client.
+        """
+        clients = await self._loop_clients()
+        active = clients.active
+        for index, pooled in enumerate(active):
+            if pooled.state == grpc.ChannelConnectivity.SHUTDOWN and not pooled.in_flight:
+                logger.info("replacing the shut down channel of %s", self.name)
+                # prepared already, so creating a client doesn't block
+                active[index] = clients.spare.pop() if clients.spare else self._create()
+                self.replaced += 1
+        healthy = [pooled for pooled in active if pooled.state != grpc.ChannelConnectivity.TRANSIENT_FAILURE] or active
+        pooled = min(healthy, key=lambda pooled: pooled.in_flight)
+        if pooled.in_flight >= self._max_streams_per_channel and clients.spare:
+            pooled = clients.spare.pop()
+            active.append(pooled)
+        pooled.in_flight += 1
+        try:
+            yield pooled.client
+        finally:
+            pooled.in_flight -= 1
+
+    async def warm_up(self) -> None:
+        """Creates the clients of the current event loop and starts connecting the channels of the active ones, so that the first calls don't wait for it."""
+        for pooled in (await self._loop_clients()).active:
+            if pooled.channel is not None:
+                pooled.channel.get_state(try_to_connect=True)
+
+    async def close(self) -> None:
+        """Closes the channels of the current event loop, waiting for the calls in flight to finish."""
+        clients = self._clients.pop(asyncio.get_running_loop(), None)
+        if clients is None:
+            return
+        await asyncio.gather(*[pooled.channel.close(grace=None) for pooled in [*clients.active, *clients.spare] if pooled.channel is not None])
+
+    def states(self) -> dict[str, int]:
+        """Returns the number of active channels per connectivity state (e.g. "READY"), across all event loops."""
+        states: dict[str, int] = {}
+        for clients in list(self._clients.values()):
+            for pooled in clients.active:
+                state = "NONE" if pooled.state is None else pooled.state.name
+                states[state] = states.get(state, 0) + 1
+        return states
+
+    async def _loop_clients(self) -> _LoopClients[T]:
+        """Returns the clients of the current event loop, creating them on first use, once for concurrent calls."""
+        loop = asyncio.get_running_loop()
+        clients = self._clients.get(loop)
+        if clients is None:
+            creating = self._creating.get(loop)
+            if creating is None:
+                creating = self._creating[loop] = loop.create_task(self._create_loop_clients(loop))
+            clients = await asyncio.shield(creating)
+        return clients
+
+    async def _create_loop_clients(self, loop: asyncio.AbstractEventLoop) -> _LoopClients[T]:
+        """Prepares the factory in a thread if not done yet and creates the clients of the provided (current) event loop."""
+        try:
+            if self._prepare is not None:
+                await asyncio.to_thread(self._prepare)
+                self._prepare = None
+            created = [self._create() for _ in range(self._max_size)]
+            clients = self._clients[loop] = _LoopClients(created[:self._size], created[self._size:])
+            return clients
+        finally:
+            self._creating.pop(loop, None)
+
+    def _create(self) -> _PooledClient[T]:
+        """Creates a client, recording the channel its transport creates."""
+        pooled: _PooledClient[T] = _PooledClient(None)
+
+        def channel_init(transport_class: type) -> ChannelInit:
+            def create_channel(host: str, options: list[tuple[str, Any]] = (), **kwargs) -> grpc.aio.Channel:
+                pooled.channel = transport_class.create_channel(host, options=[*options, *self._options], **kwargs)
+                return pooled.channel
+            return create_channel
+
+        pooled.client = self._factory(channel_init)
+        self.created += 1
+        return pooled
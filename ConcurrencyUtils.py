@@ -0,0 +1,315 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Awaitable, Callable, Generic, Hashable, TypeVar
+from connexion.exceptions import ProblemException
+from google.api_core.exceptions import ResourceExhausted, ServiceUnavailable, DeadlineExceeded
+from RetryUtils import deadline_scope, request_deadline
+from constants import REQUEST_TIMEOUT_SECONDS
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+PRIORITY_LOW = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+# The priority of work nobody is waiting for, e.g. pre-generating poems, which yields to all requests.
+PRIORITY_BACKGROUND = -1
+
+# The priority of the upstream calls of the current request, set per operation.
+request_priority: ContextVar[int] = ContextVar("request_priority", default=PRIORITY_NORMAL)
+
+# Errors by which the upstream signals that it is overloaded or out of quota.
+_OVERLOAD_ERRORS = (ResourceExhausted, ServiceUnavailable, DeadlineExceeded)
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into a single call, whose result or error is shared by all callers.
+
+    The shared call runs in its own task, so a caller being cancelled, e.g. because its client disconnected,
+    doesn't cancel the call for the other callers. It runs with the default request timeout instead of the deadline of
+    the leading request, every caller waiting until its own deadline, and with the highest priority of the callers.
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, tuple[asyncio.Task, contextvars.Context]] = {}
+        self.leaders: int = 0
+        self.coalesced: int = 0
+
+    @property
+    def in_flight(self) -> int:
+        """The number of calls currently in flight."""
+        return len(self._calls)
+
+    async def do(self, key: Hashable, function: Callable[[], Awaitable[T]]) -> T:
+        """Calls the provided function, unless a call with the same key is already in flight, and returns its result.
+
+        Args:
+            key: The key identifying identical calls.
+            function: The function to be called, which is only called by the first of the concurrent callers (the leader).
+
+        Returns:
+            The result of the shared call.
+
+        Raises:
+            Any error raised by the shared call.
+            GatewayTimeout if the deadline of the caller's request is exceeded before the shared call finished.
+        """
+        call = self._calls.get(key)
+        if call is None:
+            self.leaders += 1
+            context = contextvars.copy_context()
+            if request_deadline.get() is not None:
+                # the deadline of a request with the default timeout, as later callers can't have a later deadline
+                context.run(request_deadline.set, time.monotonic() + REQUEST_TIMEOUT_SECONDS)
+            task = asyncio.get_running_loop().create_task(function(), context=context)
+            self._calls[key] = (task, context)
+            task.add_done_callback(lambda done: self._on_done(key, done))
+        else:
+            self.coalesced += 1
+            task, context = call
+            if request_priority.get() > context.get(request_priority, PRIORITY_NORMAL):
+                # applies to the upstream calls the shared call didn't make yet
+                context.run(request_priority.set, request_priority.get())
+        async with deadline_scope():
+            return await asyncio.shield(task)
+
+    def _on_done(self, key: Hashable, task: asyncio.Task) -> None:
+        """Removes the finished call, so that later calls with the same key start a new one."""
+        if key in self._calls and self._calls[key][0] is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # retrieved so that it isn't reported as unhandled if all callers were cancelled
+            task.exception()
+
+
+class MicroBatcher(Generic[T, R]):
+    """
+    Collects the calls arriving within a short window into a batch, which is processed by a single call of the batch function.
+
+    A batch is processed once the window since its first call has passed or it has reached the maximum size. It is processed
+    in its own task with an empty context, as it serves multiple requests, so a caller being cancelled doesn't cancel it.
+    """
+
+    def __init__(self, function: Callable[[list[T]], Awaitable[list[R | Exception]]], window_seconds: float, max_size: int):
+        """
+        Args:
+            function: Processes a batch, returning the result or the error per item, in the order of the items.
+            window_seconds: How long a batch waits for further calls after its first call.
+            max_size: The maximum number of calls of a batch.
+        """
+        self._function = function
+        self._window_seconds = window_seconds
+        self._max_size = max_size
+        self._pending: list[tuple[T, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self.batches: int = 0
+        self.items: int = 0
+
+    async def submit(self, item: T) -> R:
+        """Adds the provided item to the current batch and returns its result once the batch was processed.
+
+        Args:
+            item: The item to be processed.
+
+        Returns:
+            The result of the item.
+
+        Raises:
+            The error of the item, or the error of the batch function.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self._max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._window_seconds, self._flush)
+        return await asyncio.shield(future)
+
+    def _flush(self) -> None:
+        """Starts processing the current batch."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._process(batch), context=contextvars.Context())
+            # referenced until done, as the event loop only keeps weak references to tasks
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, batch: list[tuple[T, asyncio.Future]]) -> None:
+        """Processes the provided batch and passes the results on to the waiting calls."""
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            results = await self._function([item for item, _ in batch])
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as exception:
+            results = [exception] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+                # retrieved so that it isn't reported as unhandled if the caller was cancelled
+                future.exception()
+            else:
+                future.set_result(result)
+
+
+class Overloaded(ProblemException):
+    """Signals that a request was shed because an upstream is saturated, with a Retry-After hint for the client."""
+
+    def __init__(self, upstream: str, retry_after_seconds: int):
+        """
+        Args:
+            upstream: The name of the saturated upstream.
+            retry_after_seconds: After how many seconds the client should retry.
+        """
+        super().__init__(status=503, title="Service Unavailable",
+                         detail=f"too many concurrent requests to {upstream}, please retry later",
+                         headers={"Retry-After": str(retry_after_seconds)})
+
+
+class AdaptiveLimiter:
+    """
+    Limits the number of concurrent calls to an upstream, adapting the limit to the observed latency (AIMD).
+
+    The limit is increased additively while calls complete within the latency target and the limit is used up,
+    and decreased multiplicatively when calls exceed the latency target or the upstream signals overload.
+    Calls exceeding the limit wait in a bounded queue, ordered by priority. If the queue is full, the call with the
+    lowest priority is rejected with Overloaded, as are calls that waited longer than the queue timeout.
+    """
+
+    def __init__(self, name: str, initial_limit: int, max_limit: int, latency_target_seconds: float, queue_size: int,
+                 queue_timeout_seconds: float, min_limit: int = 1, backoff_ratio: float = 0.9):
+        """
+        Args:
+            name: The name of the upstream, used in error messages.
+            initial_limit: The initial number of concurrent calls.
+            max_limit: The maximum number of concurrent calls.
+            latency_target_seconds: The latency above which the limit is decreased.
+            queue_size: The maximum number of waiting calls.
+            queue_timeout_seconds: How long calls wait at most.
+            min_limit: The minimum number of concurrent calls.
+            backoff_ratio: The factor the limit is multiplied with when it is decreased.
+        """
+        self._name = name
+        self._limit = float(initial_limit)
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._latency_target_seconds = latency_target_seconds
+        self._queue_size = queue_size
+        self._queue_timeout_seconds = queue_timeout_seconds
+        self._backoff_ratio = backoff_ratio
+        self._average_latency_seconds = latency_target_seconds / 2
+        self._in_flight = 0
+        # heap of (-priority, sequence number, future) so that the highest priority, then the longest waiting call is woken first
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self.accepted: int = 0
+        self.rejected: int = 0
+
+    @property
+    def limit(self) -> int:
+        """The current number of concurrent calls."""
+        return max(self._min_limit, int(self._limit))
+
+    @property
+    def in_flight(self) -> int:
+        """The number of calls currently in flight."""
+        return self._in_flight
+
+    @property
+    def queued(self) -> int:
+        """The number of calls currently waiting."""
+        return len(self._waiters)
+
+    @asynccontextmanager
+    async def acquire(self, priority: int | None = None) -> AsyncIterator[None]:
+        """Waits until the call may be made and holds the slot while the context is active.
+
+        Args:
+            priority: The priority of the call, the priority of the current request (see request_priority) if not given.
+
+        Raises:
+            Overloaded if the call was shed because the queue is full or it waited too long.
+        """
+        await self._acquire(request_priority.get() if priority is None else priority)
+        start = time.monotonic()
+        outcome: str | None = None
+        try:
+            yield
+            outcome = "success"
+        except _OVERLOAD_ERRORS:
+            outcome = "overload"
+            raise
+        finally:
+            self._release(time.monotonic() - start, outcome)
+
+    async def _acquire(self, priority: int) -> None:
+        """Takes a slot, waiting in the queue if there's none available."""
+        if self._in_flight < self.limit and not self._waiters:
+            self._in_flight += 1
+            self.accepted += 1
+            return
+        if len(self._waiters) >= self._queue_size:
+            lowest = max(self._waiters)
+            if -lowest[0] >= priority:
+                raise self._overloaded()
+            self._waiters.remove(lowest)
+            heapq.heapify(self._waiters)
+            lowest[2].set_exception(self._overloaded())
+        entry = (-priority, next(self._sequence), asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiters, entry)
+        try:
+            async with asyncio.timeout(self._queue_timeout_seconds):
+                await entry[2]
+        except (TimeoutError, asyncio.CancelledError) as exception:
+            if entry[2].done() and not entry[2].cancelled() and entry[2].exception() is None:
+                # the slot was granted concurrently, pass it on
+                self._release(0, None)
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            if isinstance(exception, TimeoutError):
+                raise self._overloaded() from exception
+            raise
+        self.accepted += 1
+
+    def _release(self, latency_seconds: float, outcome: str | None) -> None:
+        """Frees a slot, adapts the limit to the outcome of the call and wakes the waiting calls that fit into the limit.
+
+        Args:
+            latency_seconds: The duration of the call.
+            outcome: "success", "overload", or None if the outcome tells nothing about the upstream's load.
+        """
+        self._in_flight -= 1
+        if outcome is not None:
+            self._average_latency_seconds = 0.9 * self._average_latency_seconds + 0.1 * latency_seconds
+        if outcome == "overload" or (outcome == "success" and latency_seconds > self._latency_target_seconds):
+            self._limit = max(self._min_limit, self._limit * self._backoff_ratio)
+        elif outcome == "success" and (self._waiters or self._in_flight + 1 >= self.limit):
+            self._limit = min(self._max_limit, self._limit + 1 / self._limit)
+        while self._waiters and self._in_flight < self.limit:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._in_flight += 1
+                future.set_result(None)
+
+    def _overloaded(self) -> Overloaded:
+        """Builds the error for a shed call, estimating when the queue will have drained."""
+        self.rejected += 1
+        retry_after_seconds = math.ceil(max(1.0, self._average_latency_seconds * (len(self._waiters) + 1) / self.limit))
+        return Overloaded(self._name, retry_after_seconds)
@@ -0,0 +1,167 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from constants import PROJECT_ID, LOG_LEVEL, LOG_LEVELS, LOG_FORMAT, LOG_PAYLOAD_SAMPLE_RATE
+
+# The id of the current request, None outside of requests.
+request_id: ContextVar[str | None] = ContextVar("request_id", default=None)
+# The Cloud Trace id of the current request, None if the request isn't traced.
+request_trace: ContextVar[str | None] = ContextVar("request_trace", default=None)
+# The monotonic time at which the current request arrived.
+request_started_at: ContextVar[float | None] = ContextVar("request_started_at", default=None)
+# Whether the payloads (prompts, responses, poems) of the current request are logged, see log_payload.
+payload_sampled: ContextVar[bool] = ContextVar("payload_sampled", default=True)
+
+# The attributes every LogRecord has, anything else was passed via extra and is logged as field.
+_RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {"message", "asctime", "request_id", "trace", "elapsed_ms"}
+
+_listener: logging.handlers.QueueListener | None = None
+
+@atexit.register
+def _stop_listener() -> None:
+    """Stops the current listener, writing the records still queued, registered once for whichever listener is current at exit."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class _ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueues records together with the fields of the current request, leaving the formatting to the listener thread.
+
+    The standard QueueHandler formats the message before enqueueing it, which would stringify the arguments on the event loop.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        started_at = request_started_at.get()
+        record.request_id = request_id.get()
+        record.trace = request_trace.get()
+        record.elapsed_ms = None if started_at is None else round((time.monotonic() - started_at) * 1000, 1)
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as single line json objects, as understood by Cloud Logging."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "severity": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None) is not None:
+            entry["request_id"] = record.request_id
+            entry["elapsed_ms"] = record.elapsed_ms
+        if getattr(record, "trace", None) is not None:
+            entry["logging.googleapis.com/trace"] = record.trace
+        for name, value in record.__dict__.items():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Formats records as human readable lines, for running locally."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        if getattr(record, "request_id", None) is None:
+            record.request_id = "-"
+        return super().format(record)
+
+
+def configure_logging(level: str = LOG_LEVEL, levels: dict[str, str] = LOG_LEVELS, log_format: str = LOG_FORMAT) -> None:
+    """Routes all logging through a queue to a thread writing to stdout, so that no I/O happens on the event loop.
+
+    Calling it again replaces the previous configuration.
+
+    Args:
+        level: The level of the root logger.
+        levels: The levels of single loggers by logger name (i.e. module name), overriding the root level.
+        log_format: "json" for json lines as understood by Cloud Logging, "text" for human readable lines.
+    """
+    global _listener
+    _stop_listener()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(TextFormatter() if log_format == "text" else JsonFormatter())
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in [handler for handler in root.handlers if isinstance(handler, _ContextQueueHandler)]:
+        root.removeHandler(handler)
+    root.addHandler(_ContextQueueHandler(log_queue))
+    root.setLevel(level.upper())
+    for name, logger_level in levels.items():
+        logging.getLogger(name).setLevel(logger_level.upper())
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+
+def log_payload(logger: logging.Logger, message: str, *args) -> None:
+    """Logs a payload, e.g. a prompt or a response, at debug level if the current request is sampled for payload logging.
+
+    Payloads are large, so they are only logged for the share LOG_PAYLOAD_SAMPLE_RATE of the requests,
+    and the arguments are only formatted if the record is actually written.
+
+    Args:
+        logger: The logger to log with.
+        message: The message, formatted %-style with the provided arguments.
+    """
+    if payload_sampled.get() and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(message, *args)
+
+
+class RequestContextMiddleware:
+    """
+    ASGI middleware setting the id, the start time and the payload sampling of every request and logging it when it finished.
+
+    The request id is taken from the X-Request-Id header or the trace id of the X-Cloud-Trace-Context header,
+    or generated otherwise, and returned in the X-Request-Id header.
+    """
+
+    def __init__(self, app, payload_sample_rate: float = LOG_PAYLOAD_SAMPLE_RATE):
+        self._app = app
+        self._payload_sample_rate = payload_sample_rate
+        self._logger = logging.getLogger(__name__)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self._app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        trace_id = headers.get(b"x-cloud-trace-context", b"").decode("latin-1").split("/")[0] or None
+        current_id = headers.get(b"x-request-id", b"").decode("latin-1") or trace_id or uuid.uuid4().hex
+        request_id.set(current_id)
+        request_trace.set(None if trace_id is None else f"projects/{PROJECT_ID}/traces/{trace_id}")
+        request_started_at.set(time.monotonic())
+        payload_sampled.set(random.random() < self._payload_sample_rate)
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", current_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self._app(scope, receive, send_with_id)
+        finally:
+            # the path only, as the query contains the api key
+            self._logger.info("%s %s %s", scope["method"], scope["path"], status,
+                              extra={"status": status, "duration_ms": round((time.monotonic() - request_started_at.get()) * 1000, 1)})
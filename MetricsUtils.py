@@ -0,0 +1,313 @@
+import abc
+import asyncio
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, TypeVar
+from constants import TRACING_EXPORTER, TRACING_FILE_PATH
+
+logger = logging.getLogger(__name__)
+
+# the span export is optional, it is only done if OpenTelemetry is installed
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+# The default buckets of latency histograms (in seconds), from cache hits to slow generations.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Metric(abc.ABC):
+    """A metric family in the Prometheus text format, with a value per combination of label values."""
+
+    type: str = "untyped"
+
+    def __init__(self, name: str, description: str, label_names: Iterable[str] = ()):
+        """
+        Args:
+            name: The name of the metric.
+            description: The help text of the metric.
+            label_names: The names of the labels whose values have to be passed when the metric is updated.
+        """
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+
+    def _labels(self, labels: dict[str, str]) -> Labels:
+        """Orders the provided label values by the label names, checking that all labels are given."""
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects the labels {self.label_names}, got {tuple(labels)}")
+        return tuple((name, str(labels[name])) for name in self.label_names)
+
+    @abc.abstractmethod
+    def samples(self) -> Iterable[tuple[str, Labels, float]]:
+        """Returns the current samples as (name suffix, labels, value)."""
+
+
+class Counter(Metric):
+    """A value that only increases, e.g. the number of errors."""
+
+    type = "counter"
+
+    def __init__(self, name: str, description: str, label_names: Iterable[str] = ()):
+        super().__init__(name, description, label_names)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Increases the value for the provided labels by the provided amount."""
+        key = self._labels(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        """Returns the current value for the provided labels."""
+        return self._values.get(self._labels(labels), 0)
+
+    def samples(self) -> Iterable[tuple[str, Labels, float]]:
+        return [("_total", labels, value) for labels, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """A value that goes up and down, e.g. the number of calls in flight."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, description: str, label_names: Iterable[str] = ()):
+        super().__init__(name, description, label_names)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Increases the value for the provided labels by the provided amount."""
+        key = self._labels(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        """Decreases the value for the provided labels by the provided amount."""
+        self.inc(-amount, **labels)
+
+    def value(self, **labels: str) -> float:
+        """Returns the current value for the provided labels."""
+        return self._values.get(self._labels(labels), 0)
+
+    def samples(self) -> Iterable[tuple[str, Labels, float]]:
+        return [("", labels, value) for labels, value in self._values.items()]
+
+
+class Histogram(Metric):
+    """
+    Counts observations, e.g. latencies, in buckets, from which quantiles like p50, p95 and p99 are computed
+    via histogram_quantile, also across instances.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, label_names: Iterable[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS):
+        """
+        Args:
+            name: The name of the metric.
+            description: The help text of the metric.
+            label_names: The names of the labels whose values have to be passed when the metric is updated.
+            buckets: The upper bounds of the buckets, in increasing order.
+        """
+        super().__init__(name, description, label_names)
+        self._buckets = tuple(buckets)
+        # per labels the counts per bucket (not cumulative, the last one for +Inf), the sum and the count of the observations
+        self._counts: dict[Labels, list[int]] = {}
+        self._sums: dict[Labels, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Records an observation for the provided labels."""
+        key = self._labels(labels)
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self._buckets) + 1)
+            self._sums[key] = 0.0
+        counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sums[key] += value
+
+    def count(self, **labels: str) -> int:
+        """Returns the number of observations for the provided labels."""
+        return sum(self._counts.get(self._labels(labels), ()))
+
+    def samples(self) -> Iterable[tuple[str, Labels, float]]:
+        samples = []
+        for labels, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip([*self._buckets, float("inf")], counts):
+                cumulative += count
+                samples.append(("_bucket", (*labels, ("le", _format_value(bound))), cumulative))
+            samples.append(("_sum", labels, self._sums[labels]))
+            samples.append(("_count", labels, cumulative))
+        return samples
+
+
+class CallbackMetric(Metric):
+    """A metric whose values are read at scrape time, e.g. from the counters of the caches, so that the hot paths aren't touched."""
+
+    def __init__(self, name: str, description: str, metric_type: str, label_names: Iterable[str], function: Callable[[], dict[tuple[str, ...], float]]):
+        """
+        Args:
+            name: The name of the metric.
+            description: The help text of the metric.
+            metric_type: "counter" or "gauge".
+            label_names: The names of the labels.
+            function: Returns the current values by label values, which are ordered like the label names.
+        """
+        super().__init__(name, description, label_names)
+        self.type = metric_type
+        self._function = function
+
+    def samples(self) -> Iterable[tuple[str, Labels, float]]:
+        suffix = "_total" if self.type == "counter" else ""
+        return [(suffix, tuple(zip(self.label_names, label_values)), value) for label_values, value in self._function().items()]
+
+
+M = TypeVar("M", bound=Metric)
+
+class Registry:
+    """Holds metrics and renders them in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: M) -> M:
+        """Adds the provided metric, replacing a metric with the same name.
+
+        Returns:
+            The provided metric.
+        """
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Renders the current values of all metrics in the Prometheus text format (version 0.0.4)."""
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                samples = metric.samples()
+            except Exception:
+                logger.exception("collecting the metric %s failed", metric.name)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in samples:
+                label_part = ",".join(f'{name}="{_escape(label_value)}"' for name, label_value in labels)
+                lines.append(f"{metric.name}{suffix}{{{label_part}}} {_format_value(value)}" if label_part else f"{metric.name}{suffix} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    """Escapes a label value for the Prometheus text format."""
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    """Formats a sample value or bucket bound for the Prometheus text format."""
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+# The registry exposed on /metrics.
+REGISTRY = Registry()
+
+STAGE_DURATION = REGISTRY.register(Histogram("poem_stage_duration_seconds", "The duration of the pipeline stages", ["stage"]))
+STAGE_IN_FLIGHT = REGISTRY.register(Gauge("poem_stage_in_flight", "The number of pipeline stages currently running", ["stage"]))
+STAGE_ERRORS = REGISTRY.register(Counter("poem_stage_errors", "The number of failed pipeline stages by error type", ["stage", "error"]))
+UPSTREAM_ERRORS = REGISTRY.register(Counter("poem_upstream_errors", "The number of failed upstream calls by reason, e.g. the finish reason of a generation", ["upstream", "reason"]))
+REQUEST_DURATION = REGISTRY.register(Histogram("poem_request_duration_seconds", "The duration of the requests, until the response was completely sent", ["path", "status"]))
+REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge("poem_requests_in_flight", "The number of requests currently being processed"))
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Times the enclosed stage of the pipeline, counts it as in flight while it runs and counts its errors.
+
+    If tracing is configured, the stage is also recorded as span.
+
+    Args:
+        name: The name of the stage, e.g. "gemini".
+    """
+    span = None if trace is None else trace.get_tracer(__name__).start_span(name)
+    STAGE_IN_FLIGHT.inc(stage=name)
+    started_at = time.perf_counter()
+    try:
+        yield
+    except (Exception, asyncio.CancelledError) as exception:
+        STAGE_ERRORS.inc(stage=name, error=type(exception).__name__)
+        if span is not None:
+            span.record_exception(exception)
+        raise
+    finally:
+        STAGE_IN_FLIGHT.dec(stage=name)
+        STAGE_DURATION.observe(time.perf_counter() - started_at, stage=name)
+        if span is not None:
+            # ended but never made current, as stages may span the yields of generators
+            span.end()
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every request until its response was completely sent, and recording it as span if tracing is configured.
+
+    Requests of paths that weren't found are labelled with the path "other", to bound the number of series.
+    """
+
+    def __init__(self, app):
+        self._app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self._app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        started_at = time.perf_counter()
+        try:
+            if trace is None:
+                await self._app(scope, receive, send_with_status)
+            else:
+                with trace.get_tracer(__name__).start_as_current_span(f"{scope['method']} {scope['path']}", kind=trace.SpanKind.SERVER) as span:
+                    await self._app(scope, receive, send_with_status)
+                    span.set_attribute("http.status_code", status)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            path = "other" if status == 404 else scope["path"]
+            REQUEST_DURATION.observe(time.perf_counter() - started_at, path=path, status=str(status))
+
+
+def configure_tracing(exporter: str | None = TRACING_EXPORTER, file_path: str | None = TRACING_FILE_PATH) -> None:
+    """Exports the spans of the requests and their stages, if the OpenTelemetry SDK is installed.
+
+    Args:
+        exporter: "otlp" for exporting to a collector configured via the OTEL_EXPORTER_OTLP_* environment variables
+                  (requires opentelemetry-exporter-otlp), "file" for writing them as json to the provided file, None for not exporting spans.
+        file_path: The file spans are written to with the "file" exporter.
+    """
+    if exporter is None:
+        return
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+        if exporter == "otlp":
+            from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+            span_exporter = OTLPSpanExporter()
+        else:
+            span_exporter = ConsoleSpanExporter(out=open(file_path, "a"), formatter=lambda span: span.to_json(indent=None) + "\n")
+    except ImportError as exception:
+        logger.warning("spans are not exported, as OpenTelemetry isn't installed: %r", exception)
+        return
+    provider = TracerProvider(resource=Resource.create({"service.name": "poem-api"}))
+    # exported in batches by a background thread, so that exporting doesn't block the event loop
+    provider.add_span_processor(BatchSpanProcessor(span_exporter))
+    trace.set_tracer_provider(provider)
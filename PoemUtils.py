@@ -1,30 +1,296 @@
-import vertexai
-from vertexai.preview.generative_models import GenerativeModel, GenerationResponse, Candidate
-import google.cloud.aiplatform_v1beta1.types.content as types
-from constants import PROJECT_ID, GENERATIVE_MODEL_LOCATION, GENERATIVE_MODEL_NAME 
+import asyncio
+import contextlib
+import functools
+import hashlib
+import json
+import logging
+import re
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, AsyncIterator
+from constants import PROJECT_ID, GENERATIVE_MODEL_LOCATION, GENERATIVE_MODEL_NAME, GEMINI_CHANNELS, POEM_CACHE_ENABLED, POEM_CACHE_MEMORY_BYTES, POEM_CACHE_TTL_SECONDS, POEM_CACHE_VARIANTS, POEM_CACHE_PATH, POEM_CACHE_LOCK_TIMEOUT_SECONDS, POEM_STREAM_MAX_LINES_PER_CHUNK, GEMINI_CONCURRENCY_INITIAL, GEMINI_CONCURRENCY_MAX, GEMINI_LATENCY_TARGET_SECONDS, GEMINI_QUEUE_SIZE, GEMINI_QUEUE_TIMEOUT_SECONDS, RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY_SECONDS, RETRY_MAX_DELAY_SECONDS, GEMINI_HEDGING_ENABLED, GEMINI_HEDGE_QUANTILE, GEMINI_BATCHING_ENABLED, GEMINI_BATCH_WINDOW_SECONDS, GEMINI_BATCH_MAX_SIZE
 from connexion.exceptions import InternalServerError
+from ClientUtils import ClientPool, ChannelInit
+from CacheUtils import LruCache, SqliteCache, VariantCache, record_cache_status
+from ConcurrencyUtils import SingleFlight, AdaptiveLimiter, MicroBatcher, request_priority
+from RetryUtils import RetryPolicy, Hedger, TRANSIENT_ERRORS, retry, deadline_scope, request_deadline
+from LoggingUtils import log_payload
+from MetricsUtils import UPSTREAM_ERRORS, stage
+
+logger = logging.getLogger(__name__)
+
+# vertexai and the aiplatform types take seconds to import, so they are only imported when the model is prepared,
+# which allows the server to start listening before.
+if TYPE_CHECKING:
+    from vertexai.preview.generative_models import GenerativeModel, GenerationResponse, Candidate
+
+@functools.cache
+def _finish_reason():
+    """Returns the FinishReason enum of the aiplatform types, imported on first use."""
+    from google.cloud.aiplatform_v1beta1.types.content import Candidate
+    return Candidate.FinishReason
+
+@functools.cache
+def _retryable_finish_reasons() -> tuple:
+    """Returns the finish reasons after which generating the same poem again is likely to succeed."""
+    finish_reason = _finish_reason()
+    return (finish_reason.FINISH_REASON_UNSPECIFIED, finish_reason.MAX_TOKENS, finish_reason.RECITATION, finish_reason.OTHER)
+
+def _finish_reason_name(finish_reason) -> str:
+    """Returns the name of the provided finish reason, for labelling metrics."""
+    return getattr(finish_reason, "name", str(finish_reason))
+
+class RetryableGenerationError(InternalServerError):
+    """Signals that the generation failed with a finish reason after which a retry is likely to succeed."""
+
+@dataclass(frozen=True)
+class _BatchItem:
+    """A generation waiting to be batched, with the deadline and priority of its request, which the batch inherits."""
+    prompt: str
+    deadline: float | None
+    priority: int
 
 class PoemUtils:
     """
     Provides means to generate poems via the Google Cloud Vertex AI Gemini API.
     """
-        
-    _generative_model: GenerativeModel = None
 
-    async def generate_poem(self, language: str, max_length: int, topic: str | None) -> str:
+    _vertexai_initialized: bool = False
+
+    def __init__(self, cache: VariantCache | None = None, limiter: AdaptiveLimiter | None = None, retry_policy: RetryPolicy | None = None, hedger: Hedger | None = None,
+                 batcher: MicroBatcher | None = None, models: ClientPool["GenerativeModel"] | None = None):
+        """
+        Args:
+            cache: The cache for generated poems. If not given, a cache configured via the POEM_CACHE_* constants is used if POEM_CACHE_ENABLED is set.
+            limiter: The concurrency limiter for the calls to the generative model. If not given, a limiter configured via the GEMINI_* constants is used.
+            retry_policy: The policy for retrying failed generations. If not given, a policy configured via the RETRY_* constants is used.
+            hedger: The hedger for slow generations. If not given, a hedger configured via the GEMINI_HEDGE_* constants is used if GEMINI_HEDGING_ENABLED is set.
+            batcher: The batcher of concurrent generations, whose batch function has to be _generate_batch.
+                     If not given, a batcher configured via the GEMINI_BATCH_* constants is used if GEMINI_BATCHING_ENABLED is set.
+            models: The pool of generative models, each with its own gRPC channel. If not given, a pool of GEMINI_CHANNELS models is used.
+        """
+        if cache is None and POEM_CACHE_ENABLED:
+            persistent = None if POEM_CACHE_PATH is None else SqliteCache(POEM_CACHE_PATH, POEM_CACHE_LOCK_TIMEOUT_SECONDS)
+            cache = VariantCache(LruCache(POEM_CACHE_MEMORY_BYTES), POEM_CACHE_TTL_SECONDS, POEM_CACHE_VARIANTS, persistent)
+        # its counters tell how many generations were served from the cache
+        self.cache = cache
+        # coalesces concurrent generations of the same poem, its counters tell leading from coalesced requests
+        self.single_flight = SingleFlight()
+        self.limiter = limiter or AdaptiveLimiter("Gemini", GEMINI_CONCURRENCY_INITIAL, GEMINI_CONCURRENCY_MAX, GEMINI_LATENCY_TARGET_SECONDS, GEMINI_QUEUE_SIZE, GEMINI_QUEUE_TIMEOUT_SECONDS)
+        self.retry_policy = retry_policy or RetryPolicy(RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY_SECONDS, RETRY_MAX_DELAY_SECONDS)
+        if hedger is None and GEMINI_HEDGING_ENABLED:
+            hedger = Hedger(GEMINI_HEDGE_QUANTILE)
+        self.hedger = hedger
+        if batcher is None and GEMINI_BATCHING_ENABLED:
+            batcher = MicroBatcher(self._generate_batch, GEMINI_BATCH_WINDOW_SECONDS, GEMINI_BATCH_MAX_SIZE)
+        self.batcher = batcher
+        # the number of prompts answered by batched generations, and of those falling back to individual generations
+        self.batched_prompts: int = 0
+        self.batch_fallbacks: int = 0
+        self.models = models or ClientPool("gemini", self._create_generative_model, GEMINI_CHANNELS, prepare=self._prepare_generative_model)
+
+    async def generate_poem(self, language: str, max_length: int, topic: str | None, fresh: bool = False) -> str:
         """Generates a poem in the provided language with the provided maximum length, optionally about the provided topic.
 
         Args:
             language: The language as IETF language tag.
             max_length: The maximum length of the poem (in lines).
             topic: The topic the poem should be about. (optional)
+            fresh: Whether a new poem is generated that is neither served from nor added to the cache nor shared, e.g. for the poem pool.
+
+        Returns:
+            The generated poem, which might be served from the cache or shared with concurrent identical requests.
+        """
+        with stage("prompt"):
+            prompt = self._build_prompt(language, max_length, topic)
+            key = self._cache_key(prompt)
+        if fresh:
+            return await self._generate(prompt)
+        if self.cache is not None:
+            poem = self.cache.get(key)
+            record_cache_status("poem", poem is not None)
+            if poem is not None:
+                return poem
+        return await self.single_flight.do(key, lambda: self._generate_and_cache(key, prompt))
+
+    async def _generate_and_cache(self, key: str, prompt: str) -> str:
+        """Generates a poem with the provided prompt and caches it under the provided key.
+
+        Args:
+            key: The cache key of the prompt.
+            prompt: The prompt for querying the model.
 
         Returns:
             The generated poem.
+
+        Raises:
+            InternalServerError if the generation failed, retryable failures only after all attempts failed.
+        """
+        poem = await self._generate(prompt)
+        if self.cache is not None:
+            self.cache.put(key, poem)
+        return poem
+
+    async def _generate(self, prompt: str) -> str:
+        """Queries the generative model with the provided prompt, batching or hedging slow and retrying failed generations.
+
+        Args:
+            prompt: The prompt for querying the model.
+
+        Returns:
+            The generated poem.
+
+        Raises:
+            InternalServerError if the generation failed, retryable failures only after all attempts failed.
+        """
+        query = lambda: self._query_generative_model(prompt)
+        if self.batcher is not None:
+            query = lambda: self._submit(prompt)
+        elif self.hedger is not None:
+            query = lambda: self.hedger.run(lambda: self._query_generative_model(prompt))
+        return await retry(query, self.retry_policy, self._is_retryable)
+
+    async def _submit(self, prompt: str) -> str:
+        """Submits the provided prompt to the batcher, waiting for the result until the deadline of the request."""
+        async with deadline_scope():
+            return await self.batcher.submit(_BatchItem(prompt, request_deadline.get(), request_priority.get()))
+
+    async def _generate_batch(self, items: list[_BatchItem]) -> list[str | Exception]:
+        """Generates the poems of a batch via a single prompt, falling back to individual generations if that fails.
+
+        Runs in the context of the batcher, in which the latest deadline and the highest priority of the items are set.
+
+        Args:
+            items: The batched generations.
+
+        Returns:
+            The poem or the error per item.
+        """
+        deadlines = [item.deadline for item in items]
+        request_deadline.set(None if None in deadlines else max(deadlines))
+        request_priority.set(max(item.priority for item in items))
+        if len(items) > 1:
+            try:
+                text = await self._query_generative_model(self._build_batch_prompt([item.prompt for item in items]))
+                poems = self._parse_batch(text, len(items))
+                self.batched_prompts += len(items)
+                return poems
+            except (InternalServerError, ValueError) as exception:
+                # e.g. a topic violating the safety settings, which shouldn't fail the other poems, or a malformed answer
+                logger.info("batched generation of %d poems failed, generating them individually: %r", len(items), exception)
+                self.batch_fallbacks += len(items)
+            except Exception as exception:
+                # e.g. Overloaded, individual generations would only add to the load
+                return [exception] * len(items)
+        return await asyncio.gather(*[self._query_generative_model(item.prompt) for item in items], return_exceptions=True)
+
+    def _build_batch_prompt(self, prompts: list[str]) -> str:
+        """Builds a prompt asking for the poems of the provided prompts as json array."""
+        numbered_prompts = "\n".join(f"{number}. {prompt}" for number, prompt in enumerate(prompts, 1))
+        return (f"Fulfill each of the following {len(prompts)} requests.\n{numbered_prompts}\n"
+                f"Answer with a JSON array of exactly {len(prompts)} strings, the poems in the order of the requests "
+                f"with their lines separated by newlines, and nothing else.")
+
+    def _parse_batch(self, text: str, size: int) -> list[str]:
+        """Parses the answer of a batch prompt.
+
+        Args:
+            text: The answer, a json array of poems, optionally in a markdown code block.
+            size: The number of expected poems.
+
+        Returns:
+            The poems.
+
+        Raises:
+            ValueError if the answer isn't a json array of the expected number of non-empty strings.
+        """
+        text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text.strip())
+        poems = json.loads(text)
+        if not isinstance(poems, list) or len(poems) != size or not all(isinstance(poem, str) and poem.strip() for poem in poems):
+            raise ValueError(f"expected a json array of {size} poems")
+        return poems
+
+
+    async def stream_poem(self, language: str, max_length: int, topic: str | None) -> AsyncIterator[str]:
+        """Generates a poem like generate_poem, but yields the text in chunks while it is being generated.
+
+        A poem served from the cache is yielded as a single chunk.
+
+        Args:
+            language: The language as IETF language tag.
+            max_length: The maximum length of the poem (in lines).
+            topic: The topic the poem should be about. (optional)
+
+        Returns:
+            The chunks of the generated poem, which concatenated result in the whole poem.
+
+        Raises:
+            InternalServerError if the model fails to generate a text, possibly after some chunks have been yielded.
         """
         prompt = self._build_prompt(language, max_length, topic)
-        return await self._query_generative_model(prompt)
+        if self.cache is None:
+            async for chunk in self._stream_generative_model(prompt):
+                yield chunk
+            return
+        key = self._cache_key(prompt)
+        poem = self.cache.get(key)
+        record_cache_status("poem", poem is not None)
+        if poem is not None:
+            yield poem
+            return
+        chunks: list[str] = []
+        async for chunk in self._stream_generative_model(prompt):
+            chunks.append(chunk)
+            yield chunk
+        self.cache.put(key, "".join(chunks))
+
+    async def stream_lines(self, language: str, max_length: int, topic: str | None) -> AsyncIterator[str]:
+        """Generates a poem like stream_poem, but yields it line by line as soon as a line is complete.
+
+        Args:
+            language: The language as IETF language tag.
+            max_length: The maximum length of the poem (in lines).
+            topic: The topic the poem should be about. (optional)
+
+        Returns:
+            The lines of the generated poem without line breaks, including the empty lines between stanzas.
+
+        Raises:
+            InternalServerError if the model fails to generate a text, possibly after some lines have been yielded.
+        """
+        pending = ""
+        async for chunk in self.stream_poem(language, max_length, topic):
+            *lines, pending = (pending + chunk).split("\n")
+            for line in lines:
+                yield line
+        if pending:
+            yield pending
 
+    async def stream_stanzas(self, language: str, max_length: int, topic: str | None, max_lines: int = POEM_STREAM_MAX_LINES_PER_CHUNK) -> AsyncIterator[str]:
+        """Generates a poem like stream_poem, but yields it stanza by stanza as soon as a stanza is complete.
+
+        Stanzas longer than max_lines lines are split into chunks of max_lines lines.
+
+        Args:
+            language: The language as IETF language tag.
+            max_length: The maximum length of the poem (in lines).
+            topic: The topic the poem should be about. (optional)
+            max_lines: The maximum number of lines per yielded chunk.
+
+        Returns:
+            The stanzas of the generated poem, stripped from surrounding whitespace.
+
+        Raises:
+            InternalServerError if the model fails to generate a text, possibly after some stanzas have been yielded.
+        """
+        lines: list[str] = []
+        async for line in self.stream_lines(language, max_length, topic):
+            if line.strip():
+                lines.append(line.strip())
+            if lines and (not line.strip() or len(lines) == max_lines):
+                yield "\n".join(lines)
+                lines = []
+        if lines:
+            yield "\n".join(lines)
 
     def _build_prompt(self, language: str, max_length: int, topic: str | None) -> str:
         """Builds the prompt for querying the generative model.
@@ -40,6 +306,22 @@ class PoemUtils:
         topic_part = "" if topic is None else f"about '{topic}' "
         return f"Generate a poem {topic_part}that rhymes in the language represented by the IETF language tag '{language}' with the maximum length of {max_length} lines."
         
+    def _is_retryable(self, exception: Exception) -> bool:
+        """Tells whether a generation that failed with the provided error should be retried."""
+        return isinstance(exception, (RetryableGenerationError, *TRANSIENT_ERRORS))
+
+    def _cache_key(self, prompt: str) -> str:
+        """Builds the cache key for the provided prompt, which is insensitive to case and whitespace.
+
+        Args:
+            prompt: The prompt for querying the model.
+
+        Returns:
+            The cache key.
+        """
+        normalized_prompt = " ".join(prompt.split()).casefold()
+        return hashlib.sha256(normalized_prompt.encode("UTF-8")).hexdigest()
+
     async def _query_generative_model(self, prompt: str) -> str:
         """Queries the generative model with the provided prompt and returns the resulting text.
 
@@ -51,24 +333,106 @@ class PoemUtils:
 
         Raises:
             InternalServerError if the model fails to generate a text, e.g. because response doesn't contain any candidates or the FinishReason is not STOP.
+            RetryableGenerationError if the FinishReason is one after which a retry is likely to succeed.
+            Overloaded if the call was shed by the concurrency limiter.
+            GatewayTimeout if the deadline of the request is exceeded.
         """
-        print (f"querying generative model with prompt '{prompt}'")
-        self._prepare_generative_model()    
-        response: GenerationResponse = await self._generative_model.generate_content_async(prompt)
-        print ("response: ", response)
+        log_payload(logger, "querying generative model with prompt '%s'", prompt)
+        async with deadline_scope(), self.limiter.acquire(), self.models.lease() as model:
+            with stage("gemini"):
+                response: "GenerationResponse" = await model.generate_content_async(prompt)
+        log_payload(logger, "response: %s", response)
         if not response.candidates:
+            UPSTREAM_ERRORS.inc(upstream="gemini", reason="NO_CANDIDATES")
             raise InternalServerError("generation failed, no candidates were returned")
-        candidate: Candidate = response.candidates[0]
-        if not candidate.finish_reason == types.Candidate.FinishReason.STOP:
+        candidate: "Candidate" = response.candidates[0]
+        if candidate.finish_reason != _finish_reason().STOP:
+            UPSTREAM_ERRORS.inc(upstream="gemini", reason=_finish_reason_name(candidate.finish_reason))
+        if candidate.finish_reason in _retryable_finish_reasons():
+            raise RetryableGenerationError(f"generation failed, finish reason is not STOP but {candidate.finish_reason}")
+        if not candidate.finish_reason == _finish_reason().STOP:
             raise InternalServerError(f"generation failed, finish reason is not STOP but {candidate.finish_reason}")
         return candidate.text
 
+    async def _stream_generative_model(self, prompt: str) -> AsyncIterator[str]:
+        """Queries the generative model with the provided prompt and yields the resulting text in chunks while it is being generated.
+
+        Args:
+            prompt: The prompt for querying the model
+
+        Returns:
+            The chunks of the resulting text.
+
+        Raises:
+            InternalServerError if the model fails to generate a text, e.g. because a response doesn't contain any candidates or the final FinishReason is not STOP.
+            Overloaded if the call was shed by the concurrency limiter.
+            GatewayTimeout if the deadline of the request is exceeded.
+        """
+        log_payload(logger, "streaming generative model with prompt '%s'", prompt)
+        finish_reason = _finish_reason().FINISH_REASON_UNSPECIFIED
+        # the deadline only applies to the awaits of the upstream, as it would otherwise expire while the consumer of a chunk is suspended,
+        # cancelling the consumer instead of failing the generation
+        async with contextlib.AsyncExitStack() as stack:
+            async with deadline_scope():
+                # the slot is held until the whole text is generated
+                await stack.enter_async_context(self.limiter.acquire())
+            model: "GenerativeModel" = await stack.enter_async_context(self.models.lease())
+            with stage("gemini_stream"):
+                async with deadline_scope():
+                    responses: AsyncIterator["GenerationResponse"] = await model.generate_content_async(prompt, stream=True)
+                while True:
+                    async with deadline_scope():
+                        response: "GenerationResponse | None" = await anext(responses, None)
+                    if response is None:
+                        break
+                    if not response.candidates:
+                        UPSTREAM_ERRORS.inc(upstream="gemini", reason="NO_CANDIDATES")
+                        raise InternalServerError("generation failed, no candidates were returned")
+                    candidate: "Candidate" = response.candidates[0]
+                    finish_reason = candidate.finish_reason
+                    if finish_reason not in (_finish_reason().FINISH_REASON_UNSPECIFIED, _finish_reason().STOP):
+                        break
+                    if candidate.content.parts and candidate.text:
+                        yield candidate.text
+        if not finish_reason == _finish_reason().STOP:
+            UPSTREAM_ERRORS.inc(upstream="gemini", reason=_finish_reason_name(finish_reason))
+            raise InternalServerError(f"generation failed, finish reason is not STOP but {finish_reason}")
+
+    async def preload_model(self) -> None:
+        """Initializes vertexai and connects the generative models at startup, so that the first request doesn't have to wait for it."""
+        # the pool initializes vertexai in a thread, as importing it blocks for seconds
+        await self.models.warm_up()
+
     def _prepare_generative_model(self):
-        """Intitializes the GenerativeModel if not yet done."""
-        if self._generative_model is None:
-            print("initializing generative model")
+        """Intitializes vertexai and resolves its credentials if not yet done, which blocks and is therefore called in a thread by the pool of models."""
+        if not PoemUtils._vertexai_initialized:
+            logger.info("initializing generative model")
+            import vertexai
+            from google.cloud.aiplatform import initializer
             vertexai.init(project=PROJECT_ID, location=GENERATIVE_MODEL_LOCATION)
-            self._generative_model = GenerativeModel(GENERATIVE_MODEL_NAME)
-            print("generative model initialized")
-        else:
-            print("generative model was already initialized")
+            # resolved on first access and kept by vertexai
+            initializer.global_config.credentials
+            PoemUtils._vertexai_initialized = True
+            logger.info("generative model initialized")
+
+    def _create_generative_model(self, channel: ChannelInit) -> "GenerativeModel":
+        """Creates a generative model whose calls are made via the provided channel, once vertexai is initialized.
+
+        vertexai creates the prediction client of a model on first use, with a channel of its own, and offers no way to pass a channel
+        or a transport, so the client is provided instead, with the credentials, the endpoint and the client info vertexai would use.
+        This relies on the private attribute the client is cached in, which is why the version of google-cloud-aiplatform is bounded in
+        requirements.txt and test_generative_model_uses_pooled_channel checks that there is still no public way.
+        """
+        from google.api_core.gapic_v1.client_info import ClientInfo
+        from google.cloud.aiplatform import __version__ as aiplatform_version, initializer
+        from google.cloud.aiplatform.constants.base import USER_AGENT_PRODUCT
+        from vertexai.preview.generative_models import GenerativeModel
+        from google.cloud.aiplatform_v1beta1.services.prediction_service import PredictionServiceAsyncClient
+        from google.cloud.aiplatform_v1beta1.services.prediction_service.transports import PredictionServiceGrpcAsyncIOTransport
+        model = GenerativeModel(GENERATIVE_MODEL_NAME)
+        client_options = initializer.global_config.get_client_options(location_override=GENERATIVE_MODEL_LOCATION, prediction_client=True)
+        client_info = ClientInfo(gapic_version=aiplatform_version, user_agent=f"{USER_AGENT_PRODUCT}/{aiplatform_version}")
+        transport = PredictionServiceGrpcAsyncIOTransport(host=client_options.api_endpoint, credentials=initializer.global_config.credentials,
+                                                          channel=channel(PredictionServiceGrpcAsyncIOTransport), client_info=client_info)
+        model._prediction_async_client = PredictionServiceAsyncClient(transport=transport, client_info=client_info)
+        return model
@@ -0,0 +1,227 @@
+import asyncio
+import heapq
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from CacheUtils import record_cache_status
+from ConcurrencyUtils import AdaptiveLimiter, request_priority, PRIORITY_BACKGROUND
+from PoemUtils import PoemUtils
+from TtsUtils import TtsUtils, AudioFormat
+from constants import POEM_POOL_AUDIO_ENABLED, POEM_POOL_TOP_KEYS, POEM_POOL_SIZE, POEM_POOL_MIN_REQUESTS, POEM_POOL_HALF_LIFE_SECONDS, POEM_POOL_GENERATIONS_PER_HOUR, POEM_POOL_CONCURRENCY, POEM_POOL_MAX_AGE_SECONDS, POEM_POOL_REFILL_INTERVAL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class PoolKey:
+    """The parameters of the requests a pooled poem can be served to."""
+    language: str
+    max_length: int
+    topic: str | None
+    # the voice and the format of the pre-synthesized audio, None for poems of print_poem
+    gender: str | None = None
+    audio_format: AudioFormat | None = None
+
+
+@dataclass
+class _Entry:
+    poem: str
+    audio: bytes | memoryview | None
+    created_at: float
+
+
+class PoemPool:
+    """
+    Keeps poems, optionally with their audio, pre-generated for the most requested keys, so that these are served without waiting for Gemini.
+
+    The popularity of a key is the number of its requests, each decaying with the configured half-life. A background loop
+    (see run) tops up the pool of the most popular keys while the upstreams are idle, within a budget of generations per hour.
+    Every pooled poem is served exactly once, and discarded if it isn't served within the maximum age.
+    """
+    # the number of keys whose popularity is tracked, the least popular ones are forgotten beyond it
+    _MAX_TRACKED_KEYS = 1000
+
+    def __init__(self, poem_utils: PoemUtils, tts_utils: TtsUtils, top_keys: int = POEM_POOL_TOP_KEYS, size: int = POEM_POOL_SIZE,
+                 min_requests: float = POEM_POOL_MIN_REQUESTS, half_life_seconds: float = POEM_POOL_HALF_LIFE_SECONDS,
+                 generations_per_hour: float = POEM_POOL_GENERATIONS_PER_HOUR, concurrency: int = POEM_POOL_CONCURRENCY,
+                 max_age_seconds: float = POEM_POOL_MAX_AGE_SECONDS, audio_enabled: bool = POEM_POOL_AUDIO_ENABLED):
+        """
+        Args:
+            poem_utils: The utils generating the poems.
+            tts_utils: The utils synthesizing the audio.
+            top_keys: For how many of the most popular keys poems are kept.
+            size: How many poems are kept per key.
+            min_requests: The popularity a key needs at least before poems are pre-generated for it.
+            half_life_seconds: After how long a request counts half for the popularity of its key.
+            generations_per_hour: The budget of pre-generations (including their audio) per hour.
+            concurrency: How many pre-generations run concurrently at most.
+            max_age_seconds: How long pre-generated poems are served.
+            audio_enabled: Whether audio is pre-synthesized for the keys of read_poem.
+        """
+        self._poem_utils = poem_utils
+        self._tts_utils = tts_utils
+        self._top_keys = top_keys
+        self._size = size
+        self._min_requests = min_requests
+        self._half_life_seconds = half_life_seconds
+        self._generations_per_second = generations_per_hour / 3600
+        self._concurrency = concurrency
+        self._max_age_seconds = max_age_seconds
+        self._audio_enabled = audio_enabled
+        # the popularity per key, as (decayed number of requests, time of the last request)
+        self._popularity: dict[PoolKey, tuple[float, float]] = {}
+        self._entries: dict[PoolKey, deque[_Entry]] = {}
+        # the number of pre-generations in flight per key
+        self._pending: dict[PoolKey, int] = {}
+        # starts empty, so that the pool doesn't spend the quota on a burst right after startup
+        self._budget = 0.0
+        self._budget_updated_at = time.monotonic()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.generated: int = 0
+        self.failed: int = 0
+        self.expired: int = 0
+
+    @property
+    def entries(self) -> int:
+        """The number of pooled poems."""
+        return sum(len(entries) for entries in self._entries.values())
+
+    def take_poem(self, language: str, max_length: int, topic: str | None) -> str | None:
+        """Takes a pooled poem for print_poem, counting the request for the popularity of its key.
+
+        Args:
+            language: The language as IETF language tag.
+            max_length: The maximum length of the poem (in lines).
+            topic: The topic the poem should be about.
+
+        Returns:
+            The poem, or None if none is pooled for the key.
+        """
+        entry = self._take(PoolKey(language, max_length, topic))
+        return None if entry is None else entry.poem
+
+    def take_audio(self, language: str, max_length: int, topic: str | None, gender: str, audio_format: AudioFormat) -> tuple[str, bytes | memoryview] | None:
+        """Takes the audio of a pooled poem for read_poem, counting the request for the popularity of its key.
+
+        Args:
+            language: The language as IETF language tag.
+            max_length: The maximum length of the poem (in lines).
+            topic: The topic the poem should be about.
+            gender: The gender of the TTS voice.
+            audio_format: The format of the audio.
+
+        Returns:
+            The poem and its audio, or None if none is pooled for the key or audio isn't pre-synthesized.
+        """
+        if not self._audio_enabled:
+            return None
+        entry = self._take(PoolKey(language, max_length, topic, gender, audio_format))
+        return None if entry is None else (entry.poem, entry.audio)
+
+    def _take(self, key: PoolKey) -> _Entry | None:
+        """Counts the request of the provided key and takes its oldest pooled entry that isn't expired."""
+        now = time.monotonic()
+        self._popularity[key] = (self._popularity_at(key, now) + 1, now)
+        if len(self._popularity) > self._MAX_TRACKED_KEYS:
+            self._forget_unpopular_keys(now)
+        entries = self._entries.get(key)
+        while entries:
+            entry = entries.popleft()
+            if now - entry.created_at < self._max_age_seconds:
+                self.hits += 1
+                # only hits are recorded, so that a miss of the pool doesn't turn a hit of the poem cache into X-Cache: MISS
+                record_cache_status("pool", True)
+                return entry
+            self.expired += 1
+        self.misses += 1
+        return None
+
+    def _popularity_at(self, key: PoolKey, now: float) -> float:
+        """Returns the popularity of the provided key at the provided time."""
+        requests, updated_at = self._popularity.get(key, (0.0, now))
+        return requests * 0.5 ** ((now - updated_at) / self._half_life_seconds)
+
+    def _forget_unpopular_keys(self, now: float) -> None:
+        """Forgets the less popular half of the tracked keys."""
+        keep = heapq.nlargest(self._MAX_TRACKED_KEYS // 2, self._popularity, key=lambda key: self._popularity_at(key, now))
+        self._popularity = {key: self._popularity[key] for key in keep}
+
+    def popular_keys(self) -> list[PoolKey]:
+        """Returns the most popular keys that are requested often enough for pre-generating poems, most popular first."""
+        now = time.monotonic()
+        popularity = {key: self._popularity_at(key, now) for key in self._popularity}
+        return [key for key in heapq.nlargest(self._top_keys, popularity, key=popularity.get) if popularity[key] >= self._min_requests]
+
+    async def run(self, refill_interval_seconds: float = POEM_POOL_REFILL_INTERVAL_SECONDS) -> None:
+        """Refills the pool periodically until cancelled.
+
+        Args:
+            refill_interval_seconds: How often the pool is refilled.
+        """
+        while True:
+            await asyncio.sleep(refill_interval_seconds)
+            try:
+                await self.refill()
+            except Exception:
+                logger.exception("refilling the poem pool failed")
+
+    async def refill(self) -> int:
+        """Pre-generates poems for the popular keys whose pool isn't full, as far as the budget allows and the upstreams are idle.
+
+        Returns:
+            The number of started pre-generations.
+        """
+        now = time.monotonic()
+        self._discard_expired(now)
+        self._budget = min(self._concurrency, self._budget + (now - self._budget_updated_at) * self._generations_per_second)
+        self._budget_updated_at = now
+        keys = []
+        for key in self.popular_keys():
+            missing = self._size - len(self._entries.get(key, ())) - self._pending.get(key, 0)
+            keys.extend([key] * max(0, missing))
+        keys = keys[:min(self._concurrency - sum(self._pending.values()), int(self._budget))]
+        if not keys or not self._idle():
+            return 0
+        self._budget -= len(keys)
+        for key in keys:
+            self._pending[key] = self._pending.get(key, 0) + 1
+        await asyncio.gather(*[self._generate(key) for key in keys])
+        return len(keys)
+
+    def _discard_expired(self, now: float) -> None:
+        """Discards the pooled entries that are older than the maximum age."""
+        for key, entries in list(self._entries.items()):
+            while entries and now - entries[0].created_at >= self._max_age_seconds:
+                entries.popleft()
+                self.expired += 1
+            if not entries:
+                del self._entries[key]
+
+    def _idle(self) -> bool:
+        """Tells whether the upstreams have capacity to spare, i.e. no call is waiting and less than half of the limit is used."""
+        limiters: list[AdaptiveLimiter] = [self._poem_utils.limiter]
+        if self._audio_enabled:
+            limiters.append(self._tts_utils.limiter)
+        return all(limiter.queued == 0 and limiter.in_flight < limiter.limit / 2 for limiter in limiters)
+
+    async def _generate(self, key: PoolKey) -> None:
+        """Generates a poem, and its audio for keys of read_poem, and adds it to the pool of the provided key."""
+        # yields to all requests in the queues of the limiters
+        request_priority.set(PRIORITY_BACKGROUND)
+        try:
+            poem = await self._poem_utils.generate_poem(key.language, key.max_length, key.topic, fresh=True)
+            audio = None
+            if key.audio_format is not None:
+                audio = await self._tts_utils.synthesize(poem, key.language, key.gender, key.audio_format)
+        except Exception as exception:
+            self.failed += 1
+            logger.warning("pre-generating a poem for %s failed: %r", key, exception)
+            return
+        finally:
+            self._pending[key] -= 1
+            if not self._pending[key]:
+                del self._pending[key]
+        self.generated += 1
+        self._entries.setdefault(key, deque()).append(_Entry(poem, audio, time.monotonic()))
@@ -0,0 +1,187 @@
+import logging
+import math
+import os
+import sqlite3
+import time
+from connexion.exceptions import ProblemException
+from AuthorizationUtils import ApiKey
+from constants import RATE_LIMIT_TOKENS_PER_MINUTE, RATE_LIMIT_BURST, RATE_LIMIT_PATH, RATE_LIMIT_LOCK_TIMEOUT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def _refill(tokens: float, updated_at: float, now: float, tokens_per_second: float, burst: float) -> float:
+    """Returns the tokens of a bucket that had the provided tokens at the provided time, refilled until now."""
+    return min(burst, tokens + max(0.0, now - updated_at) * tokens_per_second)
+
+
+class MemoryBucketStore:
+    """Keeps the token buckets in the memory of the current process, taking tokens in O(1)."""
+
+    def __init__(self):
+        # the tokens per bucket, as (tokens, time they were counted at)
+        self._buckets: dict[str, tuple[float, float]] = {}
+
+    def take(self, key: str, cost: float, tokens_per_second: float, burst: float) -> tuple[bool, float]:
+        """Takes the provided number of tokens from the bucket of the provided key, if it has enough tokens left.
+
+        Args:
+            key: The key of the bucket, a full bucket is created for an unknown key.
+            cost: The number of tokens to take.
+            tokens_per_second: The rate the bucket is refilled with.
+            burst: The size of the bucket.
+
+        Returns:
+            Whether the tokens were taken, and the tokens left in the bucket.
+        """
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (burst, now))
+        tokens = _refill(tokens, updated_at, now, tokens_per_second, burst)
+        taken = tokens >= cost
+        if taken:
+            tokens -= cost
+        self._buckets[key] = (tokens, now)
+        return taken, tokens
+
+
+class SqliteBucketStore:
+    """
+    Keeps the token buckets in a SQLite database, which is shared by multiple processes, e.g. the workers of a server,
+    so that a key's rate limit applies to all of them together. Tokens are taken in a single short transaction.
+
+    As the transaction blocks the event loop, it waits only briefly for the lock of the database. If other processes
+    hold it longer, the tokens are taken from a bucket in the memory of the current process instead.
+    """
+
+    def __init__(self, path: str, lock_timeout_seconds: float = RATE_LIMIT_LOCK_TIMEOUT_SECONDS):
+        """
+        Args:
+            path: The path of the SQLite database file, created with its directory if it doesn't exist.
+            lock_timeout_seconds: How long taking tokens waits for the lock of the database.
+        """
+        self._path = path
+        self._lock_timeout_seconds = lock_timeout_seconds
+        self._fallback = MemoryBucketStore()
+        # the number of times the lock wasn't acquired in time
+        self.lock_timeouts: int = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection_pid: int | None = None
+        self._connection.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)")
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        """The connection of the current process, opened on first use, as connections must not be used across forks."""
+        if self._connection_pid != os.getpid():
+            self._current_connection = sqlite3.connect(self._path, timeout=self._lock_timeout_seconds, isolation_level=None, check_same_thread=False)
+            self._current_connection.execute("PRAGMA journal_mode=WAL")
+            self._connection_pid = os.getpid()
+        return self._current_connection
+
+    def take(self, key: str, cost: float, tokens_per_second: float, burst: float) -> tuple[bool, float]:
+        """Takes the provided number of tokens from the bucket of the provided key, see MemoryBucketStore.take."""
+        connection = self._connection
+        try:
+            # locks the database for writing right away, so that concurrent processes don't take the same tokens
+            connection.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as exception:
+            self.lock_timeouts += 1
+            logger.warning("locking the rate limits failed, taking tokens from the bucket of this process: %r", exception)
+            return self._fallback.take(key, cost, tokens_per_second, burst)
+        try:
+            now = time.time()
+            row = connection.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens = burst if row is None else _refill(row[0], row[1], now, tokens_per_second, burst)
+            taken = tokens >= cost
+            if taken:
+                tokens -= cost
+            connection.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)", (key, tokens, now))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return taken, tokens
+
+
+class RateLimited(ProblemException):
+    """Signals that a request was rejected because its api key exceeded its rate limit, with a Retry-After hint for the client."""
+
+    def __init__(self, name: str, retry_after_seconds: int, headers: dict[str, str]):
+        """
+        Args:
+            name: The name of the api key.
+            retry_after_seconds: After how many seconds the bucket has enough tokens for the request.
+            headers: The RateLimit headers of the api key.
+        """
+        super().__init__(status=429, title="Too Many Requests", detail=f"the api key {name} exceeded its rate limit, please retry later",
+                         headers={**headers, "Retry-After": str(retry_after_seconds)})
+
+
+class CostExceedsBurst(ProblemException):
+    """Signals that a request costs more tokens than the bucket of its api key can hold, so that it could never be accepted."""
+
+    def __init__(self, name: str, cost: float, burst: float):
+        """
+        Args:
+            name: The name of the api key.
+            cost: The number of tokens the request costs.
+            burst: The bucket size of the api key.
+        """
+        super().__init__(status=413, title="Content Too Large",
+                         detail=f"the request costs {cost:g} tokens, more than the {burst:g} tokens the api key {name} can spend at once, please split it")
+
+
+class RateLimiter:
+    """
+    Limits the requests per api key via token buckets: every request takes the tokens its operation costs from the bucket of its key,
+    which is refilled at the key's rate up to its burst. Requests finding too few tokens are rejected with RateLimited.
+    """
+
+    def __init__(self, store: MemoryBucketStore | SqliteBucketStore | None = None, tokens_per_minute: float = RATE_LIMIT_TOKENS_PER_MINUTE, burst: float = RATE_LIMIT_BURST):
+        """
+        Args:
+            store: The store of the token buckets. If not given, the buckets are shared via the database RATE_LIMIT_PATH if it is set, kept in memory otherwise.
+            tokens_per_minute: The rate of the keys that don't have their own rate limit, 0 for no rate limit.
+            burst: The bucket size of the keys that don't have their own rate limit.
+        """
+        if store is None:
+            store = MemoryBucketStore() if RATE_LIMIT_PATH is None else SqliteBucketStore(RATE_LIMIT_PATH)
+        self._store = store
+        self._tokens_per_minute = tokens_per_minute
+        self._burst = burst
+        # the number of accepted and rejected requests, not per api key, as the names of the keys mustn't be exposed via the metrics
+        self.accepted: int = 0
+        self.rejected: int = 0
+
+    def take(self, api_key: ApiKey, cost: float) -> dict[str, str]:
+        """Takes the provided number of tokens from the bucket of the provided api key.
+
+        Args:
+            api_key: The api key of the request.
+            cost: The number of tokens the request costs.
+
+        Returns:
+            The RateLimit headers telling the size of the bucket, the tokens left and the seconds until the bucket is full again,
+            no headers if the api key isn't rate limited.
+
+        Raises:
+            CostExceedsBurst if the cost exceeds the bucket size.
+            RateLimited if the bucket doesn't have enough tokens left.
+        """
+        tokens_per_minute = self._tokens_per_minute if api_key.tokens_per_minute is None else api_key.tokens_per_minute
+        if tokens_per_minute <= 0:
+            return {}
+        burst = self._burst if api_key.burst is None else api_key.burst
+        tokens_per_second = tokens_per_minute / 60
+        if cost > burst:
+            self.rejected += 1
+            logger.info("rejected a request of api key %s costing %g tokens, more than its burst", api_key.name, cost)
+            raise CostExceedsBurst(api_key.name, cost, burst)
+        taken, tokens = self._store.take(api_key.name, cost, tokens_per_second, burst)
+        headers = {"RateLimit-Limit": str(math.floor(burst)), "RateLimit-Remaining": str(math.floor(tokens)),
+                   "RateLimit-Reset": str(math.ceil((burst - tokens) / tokens_per_second))}
+        if not taken:
+            self.rejected += 1
+            logger.info("rejected a request of api key %s exceeding its rate limit", api_key.name)
+            raise RateLimited(api_key.name, math.ceil((cost - tokens) / tokens_per_second), headers)
+        self.accepted += 1
+        return headers
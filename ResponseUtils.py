@@ -0,0 +1,141 @@
+import re
+from typing import Mapping
+from starlette.responses import Response
+
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+def etag(key: str) -> str:
+    """Returns a strong ETag derived from the provided key of a content, a hash identifying it like its cache key,
+    so that the content needn't be produced or hashed to tell whether the client's copy is current."""
+    return f'"{key}"'
+
+
+def _matches(header: str, current_etag: str) -> bool:
+    """Tells whether an If-None-Match header lists the provided ETag, comparing weakly as required for If-None-Match."""
+    if header.strip() == "*":
+        return True
+    return any(candidate.strip().removeprefix("W/") == current_etag for candidate in header.split(","))
+
+
+def _byte_range(header: str, length: int) -> tuple[int, int] | None:
+    """Parses a Range header with a single byte range.
+
+    Args:
+        header: The Range header, e.g. "bytes=0-1023", "bytes=1024-" or "bytes=-1024" (the last 1024 bytes).
+        length: The length of the content.
+
+    Returns:
+        The start and the exclusive end of the range, clamped to the content.
+
+    Raises:
+        ValueError: If the header isn't a single byte range, in which case the whole content is sent.
+        IndexError: If the range doesn't overlap the content.
+    """
+    match = _RANGE.fullmatch(header.strip())
+    if match is None or match.group(1) == match.group(2) == "":
+        raise ValueError(f"unsupported range {header}")
+    if match.group(1) == "":
+        suffix = int(match.group(2))
+        if suffix == 0:
+            raise IndexError(f"empty range {header}")
+        return max(0, length - suffix), length
+    start = int(match.group(1))
+    end = length if match.group(2) == "" else min(length, int(match.group(2)) + 1)
+    if start >= length or start >= end:
+        raise IndexError(f"range {header} not satisfiable for {length} bytes")
+    return start, end
+
+
+def negotiate(accept: str | None, media_types: list[str]) -> str | None:
+    """Chooses the media type of a response by the Accept header of the request.
+
+    Args:
+        accept: The Accept header, e.g. "audio/ogg, audio/*;q=0.5", None if the request has none.
+        media_types: The available media types, the first one is preferred among equally acceptable ones.
+
+    Returns:
+        The acceptable media type with the highest quality, None if none is acceptable.
+    """
+    if accept is None:
+        return media_types[0]
+    # the quality per media range, a more specific range overrides a less specific one
+    qualities: dict[str, float] = {}
+    for media_range in accept.split(","):
+        media_type, *parameters = [part.strip() for part in media_range.split(";")]
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[media_type.lower()] = quality
+    best, best_quality = None, 0.0
+    for media_type in media_types:
+        quality = qualities.get(media_type, qualities.get(media_type.split("/")[0] + "/*", qualities.get("*/*", 0.0)))
+        if quality > best_quality:
+            best, best_quality = media_type, quality
+    return best
+
+
+def _validation_headers(headers: dict[str, str], current_etag: str, max_age_seconds: int) -> dict[str, str]:
+    """Returns the provided response headers with the ETag and the caching headers of a content."""
+    return {**headers, "ETag": current_etag, "Cache-Control": f"private, max-age={max_age_seconds}", "Accept-Ranges": "bytes"}
+
+
+def not_modified(request_headers: Mapping[str, str], current_etag: str, headers: dict[str, str], max_age_seconds: int) -> Response | None:
+    """Builds the response telling the client that its copy of a content is current, before the content is produced.
+
+    Args:
+        request_headers: The headers of the request, of which If-None-Match is evaluated.
+        current_etag: The ETag of the content.
+        headers: Further response headers, e.g. the X-Cache headers.
+        max_age_seconds: How long clients may reuse the response without revalidating it.
+
+    Returns:
+        304 if the If-None-Match header lists the ETag, None otherwise.
+    """
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None and _matches(if_none_match, current_etag):
+        return Response(status_code=304, headers=_validation_headers(headers, current_etag, max_age_seconds))
+    return None
+
+
+def content_response(content: bytes | memoryview, media_type: str, request_headers: Mapping[str, str], headers: dict[str, str], max_age_seconds: int,
+                     current_etag: str) -> Response:
+    """Builds the response of a complete content, e.g. synthesized audio, supporting conditional and range requests.
+
+    The content is sent as it is, so that memory mapped contents of the caches are sent without being copied,
+    and ranges are sent as slices of it.
+
+    Args:
+        content: The content.
+        media_type: The content type.
+        request_headers: The headers of the request, of which If-None-Match, Range and If-Range are evaluated.
+        headers: Further response headers, e.g. the X-Cache headers.
+        max_age_seconds: How long clients may reuse the response without revalidating it.
+        current_etag: The ETag of the content, see etag.
+
+    Returns:
+        304 if the client's copy is current, 206 with the requested range, 416 if the range isn't satisfiable, 200 with the content otherwise.
+    """
+    response = not_modified(request_headers, current_etag, headers, max_age_seconds)
+    if response is not None:
+        return response
+    headers = _validation_headers(headers, current_etag, max_age_seconds)
+    range_header = request_headers.get("range")
+    if_range = request_headers.get("if-range")
+    # a range of another version of the content would be spliced into the client's copy, so the whole content is sent instead
+    if range_header is not None and (if_range is None or if_range.strip() == current_etag):
+        try:
+            start, end = _byte_range(range_header, len(content))
+        except ValueError:
+            pass
+        except IndexError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{len(content)}"})
+        else:
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{len(content)}"
+            return Response(memoryview(content)[start:end], status_code=206, media_type=media_type, headers=headers)
+    return Response(content, media_type=media_type, headers=headers)
@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, TypeVar
+from connexion.exceptions import ProblemException
+from google.api_core import exceptions as google_exceptions
+from constants import REQUEST_TIMEOUT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# The monotonic time by which the current request has to be answered, None if it has no deadline.
+request_deadline: ContextVar[float | None] = ContextVar("request_deadline", default=None)
+
+# Transport errors after which a call to an upstream may be retried.
+TRANSIENT_ERRORS = (google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError, google_exceptions.Aborted)
+
+
+class GatewayTimeout(ProblemException):
+    """Signals that the deadline of the request was exceeded before the upstreams answered."""
+
+    def __init__(self):
+        super().__init__(status=504, title="Gateway Timeout", detail="the request deadline was exceeded")
+
+
+def timeout_seconds(header: str | bytes | None, default_timeout_seconds: float = REQUEST_TIMEOUT_SECONDS) -> float:
+    """Returns the timeout requested via the provided X-Request-Timeout header, which can only shorten the default timeout.
+
+    Args:
+        header: The value of the header (in seconds), ignored if missing or invalid.
+        default_timeout_seconds: The timeout if the header doesn't request a shorter one.
+    """
+    try:
+        if header is not None:
+            return min(default_timeout_seconds, float(header))
+    except ValueError:
+        pass
+    return default_timeout_seconds
+
+
+class DeadlineMiddleware:
+    """
+    ASGI middleware setting the deadline of every request.
+
+    The deadline is REQUEST_TIMEOUT_SECONDS after the request arrived, or earlier if the client sends a shorter
+    timeout (in seconds) in the X-Request-Timeout header. Requests to the exempt paths get no deadline, e.g. batches,
+    whose items set their own deadlines.
+    """
+
+    def __init__(self, app, default_timeout_seconds: float = REQUEST_TIMEOUT_SECONDS, exempt_paths: tuple[str, ...] = ()):
+        self._app = app
+        self._default_timeout_seconds = default_timeout_seconds
+        self._exempt_paths = exempt_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope.get("path") not in self._exempt_paths:
+            header = dict(scope["headers"]).get(b"x-request-timeout")
+            request_deadline.set(time.monotonic() + timeout_seconds(header, self._default_timeout_seconds))
+        await self._app(scope, receive, send)
+
+
+def remaining_seconds() -> float | None:
+    """Returns how much time is left until the deadline of the current request, None if it has no deadline."""
+    deadline = request_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+@asynccontextmanager
+async def deadline_scope() -> AsyncIterator[None]:
+    """Cancels the enclosed upstream call when the deadline of the current request is exceeded.
+
+    Raises:
+        GatewayTimeout if the deadline is exceeded.
+    """
+    remaining = remaining_seconds()
+    if remaining is None:
+        yield
+        return
+    if remaining <= 0:
+        raise GatewayTimeout()
+    try:
+        async with asyncio.timeout(remaining):
+            yield
+    except TimeoutError as exception:
+        raise GatewayTimeout() from exception
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """How often and after which delays failed upstream calls are retried."""
+    max_attempts: int
+    base_delay_seconds: float
+    max_delay_seconds: float
+
+    def backoff_seconds(self, attempt: int) -> float:
+        """Returns the delay before the retry after the provided attempt, exponential backoff with full jitter.
+
+        Args:
+            attempt: The number of the failed attempt, starting at 0.
+        """
+        return random.uniform(0, min(self.max_delay_seconds, self.base_delay_seconds * 2 ** attempt))
+
+async def retry(function: Callable[[], Awaitable[T]], policy: RetryPolicy, is_retryable: Callable[[Exception], bool]) -> T:
+    """Calls the provided function and retries it with jittered exponential backoff if it fails with a retryable error.
+
+    No retry is made if it couldn't finish before the deadline of the current request.
+
+    Args:
+        function: The function to be called.
+        policy: The retry policy.
+        is_retryable: Tells whether an error is retryable.
+
+    Returns:
+        The result of the first successful call.
+
+    Raises:
+        The error of the last call if all attempts failed, or the first error that isn't retryable.
+    """
+    attempt = 0
+    while True:
+        try:
+            return await function()
+        except Exception as exception:
+            if attempt + 1 >= policy.max_attempts or not is_retryable(exception):
+                raise
+            delay_seconds = policy.backoff_seconds(attempt)
+            remaining = remaining_seconds()
+            if remaining is not None and delay_seconds >= remaining:
+                raise
+            logger.warning("attempt %d failed with %r, retrying in %.2fs", attempt + 1, exception, delay_seconds)
+            await asyncio.sleep(delay_seconds)
+            attempt += 1
+
+
+class Hedger:
+    """
+    Hedges slow upstream calls: if a call didn't finish after the configured quantile of the observed latencies,
+    a second identical call is made and the result of whichever succeeds first is used.
+    """
+
+    def __init__(self, quantile: float = 0.95, window: int = 1000, min_samples: int = 20):
+        """
+        Args:
+            quantile: The quantile of the observed latencies after which a second call is made.
+            window: The number of most recent latencies the quantile is computed from.
+            min_samples: The number of latencies that have to be observed before calls are hedged.
+        """
+        self._quantile = quantile
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._min_samples = min_samples
+        self._delay_seconds: float | None = None
+        self._samples_since_update = 0
+        self.hedged: int = 0
+        self.hedge_wins: int = 0
+
+    @property
+    def delay_seconds(self) -> float | None:
+        """The delay after which a second call is made, None while too few latencies were observed."""
+        return self._delay_seconds
+
+    async def run(self, function: Callable[[], Awaitable[T]]) -> T:
+        """Calls the provided function, hedged by a second call if the first one is slow.
+
+        Args:
+            function: The function to be called.
+
+        Returns:
+            The result of the first successful call.
+
+        Raises:
+            The error of the first call if it fails before the second call is made, otherwise the error of the call failing last.
+        """
+        first = asyncio.ensure_future(self._timed(function))
+        tasks = {first}
+        try:
+            if self._delay_seconds is not None:
+                done, _ = await asyncio.wait(tasks, timeout=self._delay_seconds)
+                if not done:
+                    self.hedged += 1
+                    tasks.add(asyncio.ensure_future(self._timed(function)))
+            pending = set(tasks)
+            error: BaseException | None = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _timed(self, function: Callable[[], Awaitable[T]]) -> T:
+        """Calls the provided function and records its latency if it succeeds."""
+        start = time.monotonic()
+        result = await function()
+        self._record(time.monotonic() - start)
+        return result
+
+    def _record(self, latency_seconds: float) -> None:
+        """Records a latency, recomputing the hedging delay every few samples."""
+        self._latencies.append(latency_seconds)
+        self._samples_since_update += 1
+        if len(self._latencies) >= self._min_samples and (self._delay_seconds is None or self._samples_since_update >= self._min_samples):
+            latencies = sorted(self._latencies)
+            self._delay_seconds = latencies[min(len(latencies) - 1, int(self._quantile * len(latencies)))]
+            self._samples_since_update = 0
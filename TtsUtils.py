@@ -1,15 +1,90 @@
-
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from contextlib import aclosing
+from dataclasses import dataclass
+from typing import AsyncGenerator, AsyncIterator
 from google.cloud.texttospeech import TextToSpeechAsyncClient, SynthesisInput, VoiceSelectionParams, AudioConfig, AudioEncoding, ListVoicesResponse, SynthesizeSpeechResponse, SsmlVoiceGender, Voice
+from google.cloud.texttospeech_v1.services.text_to_speech.transports import TextToSpeechGrpcAsyncIOTransport
 from connexion.exceptions import InternalServerError
+from constants import TTS_CHANNELS, VOICE_CATALOG_REFRESH_SECONDS, VOICE_CATALOG_MAX_LANGUAGES, TTS_STREAM_CONCURRENCY, TTS_CONCURRENCY_INITIAL, TTS_CONCURRENCY_MAX, TTS_LATENCY_TARGET_SECONDS, TTS_QUEUE_SIZE, TTS_QUEUE_TIMEOUT_SECONDS, RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY_SECONDS, RETRY_MAX_DELAY_SECONDS, AUDIO_CACHE_MEMORY_BYTES, AUDIO_CACHE_PATH, AUDIO_CACHE_DISK_BYTES
+from ClientUtils import ClientPool, ChannelInit, default_credentials
+from CacheUtils import BytesCache, LruCache, FileCache, record_cache_status
+from ConcurrencyUtils import SingleFlight, AdaptiveLimiter
+from RetryUtils import RetryPolicy, TRANSIENT_ERRORS, retry, deadline_scope, remaining_seconds
+from LoggingUtils import log_payload
+from MetricsUtils import stage
+
+logger = logging.getLogger(__name__)
+
+# The supported audio encodings by name, and the media types of the audio they produce.
+AUDIO_ENCODINGS: dict[str, AudioEncoding] = {"mp3": AudioEncoding.MP3, "ogg_opus": AudioEncoding.OGG_OPUS, "linear16": AudioEncoding.LINEAR16}
+AUDIO_MEDIA_TYPES: dict[str, str] = {"mp3": "audio/mpeg", "ogg_opus": "audio/ogg", "linear16": "audio/wav"}
+
+
+@dataclass(frozen=True)
+class AudioFormat:
+    """The encoding, sample rate and speaking rate audio is synthesized with."""
+    # one of AUDIO_ENCODINGS
+    encoding: str = "mp3"
+    # None for the natural sample rate of the voice
+    sample_rate_hertz: int | None = None
+    speaking_rate: float = 1.0
+
+    @property
+    def media_type(self) -> str:
+        """The media type of the audio."""
+        return AUDIO_MEDIA_TYPES[self.encoding]
+
+
+def _normalize_language(language: str) -> str:
+    """Returns the canonical case of the provided IETF language tag, e.g. "en-US" for "EN_us", so that differently spelled tags share their voices."""
+    subtags = language.strip().replace("_", "-").split("-")
+    return "-".join([subtags[0].lower()] + [subtag.upper() if len(subtag) == 2 else subtag.title() if len(subtag) == 4 else subtag.lower() for subtag in subtags[1:]])
+
 
 class TtsUtils:
     """
     Provides means to synthesize a text via the google cloud TTS service.
+
+    The voice catalog of a language is loaded once, on first use or via preload_voices, and turned into an index
+    of the best voice per (language, gender). It is refreshed in the background once it is older than the configured refresh interval.
+    Only languages that have voices are indexed, and only the most recently used ones, so that arbitrary language tags don't grow the index.
+    Synthesized audio is cached by text, voice and audio config.
     """
-    _tts_client: TextToSpeechAsyncClient = None
-    _audio_config: AudioConfig = None
 
-    async def synthesize(self, text: str, language: str, gender: str) -> bytes:
+    def __init__(self, voice_catalog_refresh_seconds: float = VOICE_CATALOG_REFRESH_SECONDS, audio_cache: BytesCache | None = None, limiter: AdaptiveLimiter | None = None, retry_policy: RetryPolicy | None = None,
+                 clients: ClientPool[TextToSpeechAsyncClient] | None = None, voice_catalog_max_languages: int = VOICE_CATALOG_MAX_LANGUAGES):
+        """
+        Args:
+            voice_catalog_refresh_seconds: How long the voice catalog of a language is used before it is refreshed.
+            audio_cache: The cache for synthesized audio. If not given, a cache configured via the AUDIO_CACHE_* constants is used.
+            limiter: The concurrency limiter for the syntheses. If not given, a limiter configured via the TTS_* constants is used.
+            retry_policy: The policy for retrying syntheses failing with transport errors. If not given, a policy configured via the RETRY_* constants is used.
+            clients: The pool of TTS clients, each with its own gRPC channel. If not given, a pool of TTS_CHANNELS clients is used.
+            voice_catalog_max_languages: For how many languages the voices are indexed at most, the least recently used ones are evicted beyond it.
+        """
+        self._voice_catalog_refresh_seconds = voice_catalog_refresh_seconds
+        self._voice_catalog_max_languages = voice_catalog_max_languages
+        if audio_cache is None:
+            disk = None if AUDIO_CACHE_PATH is None else FileCache(AUDIO_CACHE_PATH, AUDIO_CACHE_DISK_BYTES)
+            audio_cache = BytesCache(LruCache(AUDIO_CACHE_MEMORY_BYTES), disk)
+        # its counters tell how many syntheses were served from the cache
+        self.audio_cache = audio_cache
+        # coalesces concurrent syntheses of the same audio, its counters tell leading from coalesced requests
+        self.single_flight = SingleFlight()
+        self.limiter = limiter or AdaptiveLimiter("TTS", TTS_CONCURRENCY_INITIAL, TTS_CONCURRENCY_MAX, TTS_LATENCY_TARGET_SECONDS, TTS_QUEUE_SIZE, TTS_QUEUE_TIMEOUT_SECONDS)
+        self.retry_policy = retry_policy or RetryPolicy(RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY_SECONDS, RETRY_MAX_DELAY_SECONDS)
+        # the best voice per gender by normalized language, with the time the catalog was loaded at, in the order of their last use
+        self._voice_index: OrderedDict[str, tuple[float, dict[SsmlVoiceGender, VoiceSelectionParams]]] = OrderedDict()
+        self._voice_loads: dict[str, asyncio.Task] = {}
+        # built once per audio format, as building and serializing them for the cache keys isn't free
+        self._audio_configs: dict[AudioFormat, AudioConfig] = {}
+        self.clients = clients or ClientPool("tts", self._create_client, TTS_CHANNELS, prepare=default_credentials)
+
+    async def synthesize(self, text: str, language: str, gender: str, audio_format: AudioFormat = AudioFormat()) -> bytes | memoryview:
         """
         Synthesizes the provided text with a voice matching the provided language and gender.
 
@@ -17,42 +92,201 @@ class TtsUtils:
             text: The text to be synthesized.
             language: The language as IETF language tag.
             gender: The gender of the TTS voice to use ("female", "male" or "unspecified").
-                    This is not a hard constraint, if a voice of the specified gender is not found, 
+                    This is not a hard constraint, if a voice of the specified gender is not found,
                     a voice of another gender might be used as fallback.
-        
+            audio_format: The format of the audio, mp3 at the natural sample rate of the voice by default.
+
         Returns:
-            The poem as bytes representing the mp3 data.
+            The poem as bytes representing the audio data, or as memory mapped view if it is served from the disk tier of the audio cache.
 
         Raises:
             InternalServerError if no voice can be found for the provided language.
+            Overloaded if the synthesis was shed by the concurrency limiter.
+            GatewayTimeout if the deadline of the request is exceeded.
         """
-        self._prepare_tts()
-        ssml_voice_gender = self._map_gender(gender)
-        print(f"synthesizing the following text in language {language} with voice of gender {ssml_voice_gender}")
-        print(text)
-        voice: Voice = await self._find_voice(language, ssml_voice_gender)
-        if voice is not None:
-            print(f"found voice {voice.name}")
-            voice: VoiceSelectionParams = VoiceSelectionParams(language_code=voice.language_codes[0], name=voice.name)
-        else:
+        log_payload(logger, "synthesizing the following text in language %s with voice of gender %s:\n%s", language, gender, text)
+        voice, audio_config, key = await self._voice_and_key(text, language, gender, audio_format)
+        audio = self.audio_cache.get(key)
+        record_cache_status("audio", audio is not None)
+        if audio is not None:
+            return audio
+        return await self.single_flight.do(key, lambda: self._synthesize_and_cache(key, text, voice, audio_config))
+
+    async def audio_key(self, text: str, language: str, gender: str, audio_format: AudioFormat = AudioFormat()) -> str:
+        """
+        Returns the key identifying the audio synthesize returns for the provided arguments, without synthesizing it, e.g. to derive an ETag from.
+
+        Args:
+            text: The text to be synthesized.
+            language: The language as IETF language tag.
+            gender: The gender of the TTS voice to use ("female", "male" or "unspecified").
+            audio_format: The format of the audio.
+
+        Returns:
+            The audio cache key, a hash of the text, the voice and the audio config.
+
+        Raises:
+            InternalServerError if no voice can be found for the provided language.
+        """
+        _, _, key = await self._voice_and_key(text, language, gender, audio_format)
+        return key
+
+    async def _voice_and_key(self, text: str, language: str, gender: str, audio_format: AudioFormat) -> tuple[VoiceSelectionParams, AudioConfig, str]:
+        """Finds the voice and builds the audio config and the audio cache key of a synthesis, see synthesize.
+
+        Raises:
+            InternalServerError if no voice can be found for the provided language.
+        """
+        with stage("voice_lookup"):
+            voice: VoiceSelectionParams | None = await self._find_voice(language, self._map_gender(gender))
+        if voice is None:
             raise InternalServerError(f"didn't find voice for language {language}")
+        audio_config = self._audio_config(audio_format)
+        return voice, audio_config, self._audio_cache_key(text, voice, audio_config)
+
+    async def _synthesize_and_cache(self, key: str, text: str, voice: VoiceSelectionParams, audio_config: AudioConfig) -> bytes:
+        """
+        Synthesizes the provided text and caches the resulting audio under the provided key.
+
+        Args:
+            key: The audio cache key of the text, voice and audio config.
+            text: The text to be synthesized.
+            voice: The voice to synthesize the text with.
+            audio_config: The audio config to synthesize the text with.
+
+        Returns:
+            The audio as bytes.
+        """
         synthesis_input = SynthesisInput(text=text)
-        response: SynthesizeSpeechResponse = await self._tts_client.synthesize_speech(input=synthesis_input, voice=voice, audio_config=self._audio_config)
+        response: SynthesizeSpeechResponse = await retry(lambda: self._synthesize_speech(synthesis_input, voice, audio_config), self.retry_policy,
+                                                         lambda exception: isinstance(exception, TRANSIENT_ERRORS))
+        self.audio_cache.set(key, response.audio_content)
         return response.audio_content
-    
-    def _prepare_tts(self) -> None:
-        """Intitializes the TextToSpeechClient and AudioConfig if not yet done."""
-        if self._tts_client is None:
-            print("initializing TTS")
-            self._tts_client = TextToSpeechAsyncClient()
-            self._audio_config: AudioConfig = AudioConfig(audio_encoding=AudioEncoding.MP3)
-            print("TTS initialized")
-        else:
-            print("TTS was already initialized")
+
+    async def synthesize_stream(self, texts: AsyncGenerator[str, None], language: str, gender: str, concurrency: int = TTS_STREAM_CONCURRENCY,
+                                audio_format: AudioFormat = AudioFormat()) -> AsyncIterator[bytes | memoryview]:
+        """
+        Synthesizes the provided texts as they arrive and yields the audio of each text in the order of the texts.
+
+        Up to `concurrency` texts are synthesized concurrently, so later texts are synthesized while earlier ones are still being consumed.
+
+        Args:
+            texts: The texts to be synthesized, e.g. the stanzas of a poem while it is being generated.
+            language: The language as IETF language tag.
+            gender: The gender of the TTS voice to use ("female", "male" or "unspecified"), see synthesize.
+            concurrency: The maximum number of concurrent syntheses.
+            audio_format: The format of the audio, which has to be one whose files can be concatenated, i.e. mp3 or ogg_opus.
+
+        Returns:
+            The audio of the texts, see synthesize.
+
+        Raises:
+            InternalServerError if no voice can be found for the provided language.
+            Any error raised while iterating the texts.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        syntheses: asyncio.Queue[asyncio.Future | None] = asyncio.Queue()
+
+        async def synthesize(text: str) -> bytes | memoryview:
+            async with semaphore:
+                return await self.synthesize(text, language, gender, audio_format)
+
+        async def schedule() -> None:
+            try:
+                async with aclosing(texts):
+                    async for text in texts:
+                        syntheses.put_nowait(asyncio.ensure_future(synthesize(text)))
+            except Exception as exception:
+                failure = asyncio.get_running_loop().create_future()
+                failure.set_exception(exception)
+                syntheses.put_nowait(failure)
+            finally:
+                syntheses.put_nowait(None)
+
+        scheduler = asyncio.ensure_future(schedule())
+        try:
+            while (synthesis := await syntheses.get()) is not None:
+                yield await synthesis
+        finally:
+            # the consumer stopped early, e.g. because the client disconnected or a synthesis failed
+            scheduler.cancel()
+            while not syntheses.empty():
+                synthesis = syntheses.get_nowait()
+                if synthesis is not None and not synthesis.cancel() and not synthesis.cancelled():
+                    synthesis.exception()  # retrieved so that it isn't reported as unhandled
+
+    async def _synthesize_speech(self, synthesis_input: SynthesisInput, voice: VoiceSelectionParams, audio_config: AudioConfig) -> SynthesizeSpeechResponse:
+        """
+        Calls the TTS service within the concurrency limit, passing the deadline of the request on to the service.
+
+        Args:
+            synthesis_input: The input to be synthesized.
+            voice: The voice to synthesize the input with.
+            audio_config: The audio config to synthesize the input with.
+
+        Returns:
+            The response of the TTS service.
+
+        Raises:
+            Overloaded if the synthesis was shed by the concurrency limiter.
+            GatewayTimeout if the deadline of the request is exceeded.
+        """
+        remaining = remaining_seconds()
+        timeout = {} if remaining is None else {"timeout": remaining}
+        async with deadline_scope(), self.limiter.acquire():
+            async with self.clients.lease() as client:
+                with stage("tts"):
+                    return await client.synthesize_speech(input=synthesis_input, voice=voice, audio_config=audio_config, **timeout)
+
+    async def preload_voices(self, languages: list[str]) -> None:
+        """
+        Loads the voice catalogs of the provided languages, e.g. at startup, so that requests don't have to wait for them.
+
+        Args:
+            languages: The languages as IETF language tags.
+        """
+        await self.clients.warm_up()
+        await asyncio.gather(*[asyncio.shield(self._load_voices(_normalize_language(language))) for language in languages])
+
+    def _create_client(self, channel: ChannelInit) -> TextToSpeechAsyncClient:
+        """Creates a TTS client whose calls are made via the provided channel."""
+        return TextToSpeechAsyncClient(transport=TextToSpeechGrpcAsyncIOTransport(credentials=default_credentials(), channel=channel(TextToSpeechGrpcAsyncIOTransport)))
+
+    def _audio_config(self, audio_format: AudioFormat) -> AudioConfig:
+        """Returns the AudioConfig of the provided audio format, built on first use.
+
+        Only the fields differing from the defaults are set, so that the audio cache keys of the default format stay the same.
+        """
+        audio_config = self._audio_configs.get(audio_format)
+        if audio_config is None:
+            audio_config = AudioConfig(audio_encoding=AUDIO_ENCODINGS[audio_format.encoding])
+            if audio_format.sample_rate_hertz is not None:
+                audio_config.sample_rate_hertz = audio_format.sample_rate_hertz
+            if audio_format.speaking_rate != 1.0:
+                audio_config.speaking_rate = audio_format.speaking_rate
+            self._audio_configs[audio_format] = audio_config
+        return audio_config
+
+    def _audio_cache_key(self, text: str, voice: VoiceSelectionParams, audio_config: AudioConfig) -> str:
+        """Builds the audio cache key, a hash of the text, the voice and the audio config.
+
+        Args:
+            text: The text to be synthesized.
+            voice: The voice to synthesize the text with.
+            audio_config: The audio config to synthesize the text with.
+
+        Returns:
+            The cache key.
+        """
+        digest = hashlib.sha256()
+        for part in (text.encode("UTF-8"), VoiceSelectionParams.serialize(voice), AudioConfig.serialize(audio_config)):
+            digest.update(len(part).to_bytes(8, "big"))
+            digest.update(part)
+        return digest.hexdigest()
 
     def _map_gender(self, gender: str) -> SsmlVoiceGender:
         """Maps a gender string ("female", "male" or "unspecified") to the corresponding SsmlVoiceGender.
-        
+
         Args:
             gender: The gender string to be mapped.
 
@@ -65,36 +299,103 @@ class TtsUtils:
             return SsmlVoiceGender.MALE
         else:
             return SsmlVoiceGender.SSML_VOICE_GENDER_UNSPECIFIED
-    
 
-    async def _find_voice(self, language: str, gender: SsmlVoiceGender) -> Voice | None:
+
+    async def _find_voice(self, language: str, gender: SsmlVoiceGender) -> VoiceSelectionParams | None:
         """
-        Finds a TTS Voice matching the provided language and potentially the provided gender.
-        
-        If available, Neural or Wavenet voices are preferred due to their better quality.
-        Voices are ranked by the fact whether they are for the requested gender and whether they are Neural/Wavenet voices, in that order.
+        Finds a TTS Voice matching the provided language and potentially the provided gender via the voice index.
+
+        The voice catalog of the language is loaded if it isn't yet, or refreshed in the background if it is outdated.
 
         Args:
             language: The language as IETF language tag
             gender: The gender of the TTS voice to use.
-                    This is not a hard constraint, if a voice of the specified gender is not found, 
+                    This is not a hard constraint, if a voice of the specified gender is not found,
                     a voice of another gender might be used as fallback.
-        
+
+        Returns:
+            The selection params of the best matching voice (see _rank_voice), or None if no voice for the provided language is available.
+        """
+        language = _normalize_language(language)
+        entry = self._voice_index.get(language)
+        if entry is None:
+            # shielded so that a cancelled request doesn't cancel the load other requests are waiting for
+            await asyncio.shield(self._load_voices(language))
+            entry = self._voice_index.get(language)
+            if entry is None:
+                return None
+        elif time.monotonic() - entry[0] >= self._voice_catalog_refresh_seconds:
+            self._load_voices(language)
+        self._voice_index.move_to_end(language)
+        return entry[1][gender]
+
+    def _load_voices(self, language: str) -> asyncio.Task:
+        """
+        Starts loading the voice catalog of the provided language unless a load is already in flight.
+
+        Args:
+            language: The language as IETF language tag
+
         Returns:
-            The voice best that matches the requirements explained above, or None if no voice for the provided language is available.
+            The task loading the catalog, shared by all callers while it is running.
+        """
+        task = self._voice_loads.get(language)
+        if task is None:
+            task = asyncio.ensure_future(self._index_voices(language))
+            task.add_done_callback(lambda done: self._on_voices_loaded(language, done))
+            self._voice_loads[language] = task
+        return task
+
+    def _on_voices_loaded(self, language: str, task: asyncio.Task) -> None:
+        """Clears the in-flight load of the provided language and reports failures of loads nobody is waiting for."""
+        del self._voice_loads[language]
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("loading the voices for language %s failed: %r", language, task.exception())
+
+    async def _index_voices(self, language: str) -> None:
+        """
+        Loads the voice catalog of the provided language and stores the best voice for every gender in the voice index,
+        evicting the least recently used language if the index is full. A language without voices isn't indexed.
+
+        Args:
+            language: The normalized language as IETF language tag
         """
-        response: ListVoicesResponse = await self._tts_client.list_voices(language_code=language)
+        async with self.clients.lease() as client:
+            response: ListVoicesResponse = await client.list_voices(language_code=language)
         voices: list[Voice] = list(response.voices)
-        voices_matching_gender: list[Voice] = list(filter(lambda voice: gender == SsmlVoiceGender.SSML_VOICE_GENDER_UNSPECIFIED or voice.ssml_gender == gender, voices))
-        hq_voices: list[Voice] = list(filter(lambda voice: "Neural" in voice.name or "Wavenet" in voice.name, voices))
-        hq_voices_matching_gender: list[Voice] = list(filter(lambda voice: voice in voices_matching_gender, hq_voices))
-        if hq_voices_matching_gender:
-            return hq_voices_matching_gender[0]
-        elif voices_matching_gender:
-            return voices_matching_gender[0]
-        elif hq_voices:
-            return hq_voices[0]
-        elif voices:
-            return voices[0]
-        else:
-            return None
+        if not voices:
+            self._voice_index.pop(language, None)
+            return
+        best_voices = {gender: self._rank_voice(voices, gender) for gender in SsmlVoiceGender}
+        self._voice_index[language] = (time.monotonic(), {gender: VoiceSelectionParams(language_code=voice.language_codes[0], name=voice.name)
+                                                          for gender, voice in best_voices.items()})
+        self._voice_index.move_to_end(language)
+        while len(self._voice_index) > self._voice_catalog_max_languages:
+            self._voice_index.popitem(last=False)
+
+    def _rank_voice(self, voices: list[Voice], gender: SsmlVoiceGender) -> Voice | None:
+        """
+        Finds the voice best matching the provided gender.
+
+        If available, Neural or Wavenet voices are preferred due to their better quality.
+        Voices are ranked by the fact whether they are for the requested gender and whether they are Neural/Wavenet voices, in that order.
+        Among equally ranked voices, the first one in the catalog is chosen.
+
+        Args:
+            voices: The voice catalog of a language.
+            gender: The gender of the TTS voice to use.
+
+        Returns:
+            The voice that best matches the requirements explained above, or None if the catalog is empty.
+        """
+        best_voice: Voice | None = None
+        best_rank = -1
+        for voice in voices:
+            matches_gender = gender == SsmlVoiceGender.SSML_VOICE_GENDER_UNSPECIFIED or voice.ssml_gender == gender
+            is_hq = "Neural" in voice.name or "Wavenet" in voice.name
+            rank = 2 * matches_gender + is_hq
+            if rank > best_rank:
+                best_voice, best_rank = voice, rank
+                if rank == 3:
+                    break
+        return best_voice
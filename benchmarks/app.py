@@ -0,0 +1,24 @@
+"""
+The app with fake backends, for benchmarking server configurations without network, e.g. via
+
+    gunicorn -w 4 -k uvicorn.workers.UvicornWorker benchmarks.app:app
+    python -m benchmarks.harness --url http://localhost:8000
+
+The latency of the fake backends is configured via BENCHMARK_{GEMINI,TTS,SECRET}_LATENCY ("<median>,<p99>" in seconds)
+and their error rate via BENCHMARK_ERROR_RATE.
+"""
+import os
+import main
+from benchmarks.fakes import Latency, FakeGenerativeModel, FakeTextToSpeechClient, FakeSecretManagerClient, install_fakes
+
+def _latency(name: str) -> Latency:
+    """Reads the latency distribution from the provided environment variable."""
+    return Latency(*[float(value) for value in os.environ.get(name, "0,0").split(",")])
+
+_error_rate = float(os.environ.get("BENCHMARK_ERROR_RATE", 0))
+install_fakes(main.poem_utils, main.tts_utils, main.authorization_utils,
+              FakeGenerativeModel(_latency("BENCHMARK_GEMINI_LATENCY"), _error_rate),
+              FakeTextToSpeechClient(_latency("BENCHMARK_TTS_LATENCY"), _error_rate),
+              FakeSecretManagerClient(_latency("BENCHMARK_SECRET_LATENCY"), _error_rate))
+
+app = main.app
@@ -0,0 +1,154 @@
+import asyncio
+import hashlib
+import json
+import math
+import random
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import AsyncIterator
+from google.api_core.exceptions import ServiceUnavailable
+from google.cloud.aiplatform_v1beta1.types.content import Candidate
+from google.cloud.texttospeech import ListVoicesResponse, SynthesizeSpeechResponse, Voice, SsmlVoiceGender
+from google.cloud.secretmanager import AccessSecretVersionResponse, SecretPayload
+from google_crc32c import Checksum
+from ClientUtils import ClientPool
+from PoemUtils import PoemUtils
+from TtsUtils import TtsUtils
+from AuthorizationUtils import AuthorizationUtils
+
+# The api key served by the fake Secret Manager.
+API_KEY = "benchmark"
+
+
+@dataclass(frozen=True)
+class Latency:
+    """A log-normal latency distribution, given by its median and its 99th percentile (in seconds)."""
+    median_seconds: float = 0.0
+    p99_seconds: float = 0.0
+
+    def sample(self) -> float:
+        """Returns a random latency from the distribution."""
+        if self.median_seconds <= 0 or self.p99_seconds <= self.median_seconds:
+            return max(0.0, self.median_seconds)
+        # 2.326 is the 99th percentile of the standard normal distribution
+        sigma = math.log(self.p99_seconds / self.median_seconds) / 2.326
+        return self.median_seconds * math.exp(random.gauss(0, sigma))
+
+
+class _FakeBackend:
+    """Waits for a sampled latency and fails with ServiceUnavailable at the configured rate, like a remote call."""
+
+    def __init__(self, latency: Latency = Latency(), error_rate: float = 0.0):
+        """
+        Args:
+            latency: The latency distribution of the calls.
+            error_rate: The share of calls failing with ServiceUnavailable.
+        """
+        self._latency = latency
+        self._error_rate = error_rate
+        self.calls: int = 0
+
+    async def _call(self, latency_share: float = 1.0) -> None:
+        """Waits for the provided share of a sampled latency, then fails at the error rate."""
+        self.calls += 1
+        await asyncio.sleep(self._latency.sample() * latency_share)
+        if random.random() < self._error_rate:
+            raise ServiceUnavailable("fake backend failure")
+
+
+class FakeGenerativeModel(_FakeBackend):
+    """Stands in for vertexai's GenerativeModel, generating a poem that is unique per prompt."""
+
+    def __init__(self, latency: Latency = Latency(), error_rate: float = 0.0, lines: int = 12, chunks: int = 4):
+        """
+        Args:
+            latency: The latency distribution of the generations, for streamed generations until the last chunk.
+            error_rate: The share of generations failing with ServiceUnavailable.
+            lines: The number of lines of the generated poems.
+            chunks: The number of chunks streamed generations are split into.
+        """
+        super().__init__(latency, error_rate)
+        self._lines = lines
+        self._chunks = chunks
+
+    def _poem(self, prompt: str) -> str:
+        seed = hashlib.sha256(prompt.encode("UTF-8")).hexdigest()[:8]
+        return "\n".join(f"Line {line} of the poem {seed} about roses and the evening light" for line in range(self._lines))
+
+    async def generate_content_async(self, prompt: str, stream: bool = False):
+        if stream:
+            return self._stream(prompt)
+        await self._call()
+        return _response(self._poem(prompt), Candidate.FinishReason.STOP)
+
+    async def _stream(self, prompt: str) -> AsyncIterator:
+        lines = self._poem(prompt).split("\n")
+        size = math.ceil(len(lines) / self._chunks)
+        for start in range(0, len(lines), size):
+            if start == 0:
+                await self._call(1 / self._chunks)
+            else:
+                await asyncio.sleep(self._latency.sample() / self._chunks)
+            last = start + size >= len(lines)
+            text = "\n".join(lines[start:start + size]) + ("" if last else "\n")
+            yield _response(text, Candidate.FinishReason.STOP if last else Candidate.FinishReason.FINISH_REASON_UNSPECIFIED)
+
+
+def _response(text: str, finish_reason) -> SimpleNamespace:
+    """Builds an object shaped like a GenerationResponse with a single candidate."""
+    candidate = SimpleNamespace(text=text, finish_reason=finish_reason, content=SimpleNamespace(parts=[text]))
+    return SimpleNamespace(candidates=[candidate])
+
+
+class FakeTextToSpeechClient(_FakeBackend):
+    """Stands in for the TextToSpeechAsyncClient, synthesizing audio of a size proportional to the text."""
+
+    def __init__(self, latency: Latency = Latency(), error_rate: float = 0.0, bytes_per_character: int = 250):
+        """
+        Args:
+            latency: The latency distribution of the syntheses.
+            error_rate: The share of syntheses failing with ServiceUnavailable.
+            bytes_per_character: The size of the synthesized audio per character of the text, about 250 for mp3.
+        """
+        super().__init__(latency, error_rate)
+        self._bytes_per_character = bytes_per_character
+
+    async def synthesize_speech(self, input, voice, audio_config, timeout: float | None = None) -> SynthesizeSpeechResponse:
+        await self._call()
+        return SynthesizeSpeechResponse(audio_content=bytes(len(input.text) * self._bytes_per_character))
+
+    async def list_voices(self, language_code: str) -> ListVoicesResponse:
+        await self._call()
+        return ListVoicesResponse(voices=[Voice(language_codes=[language_code], name=f"{language_code}-Neural2-{gender.name}", ssml_gender=gender)
+                                          for gender in (SsmlVoiceGender.FEMALE, SsmlVoiceGender.MALE)])
+
+
+class FakeSecretManagerClient(_FakeBackend):
+    """Stands in for the SecretManagerServiceAsyncClient, serving API_KEY without rate limit, so that the server's throughput is measured."""
+
+    async def access_secret_version(self, name: str) -> AccessSecretVersionResponse:
+        await self._call()
+        data = json.dumps({API_KEY: {"name": "benchmark", "tokens_per_minute": 0}}).encode("UTF-8")
+        crc32c = Checksum()
+        crc32c.update(data)
+        return AccessSecretVersionResponse(name=name, payload=SecretPayload(data=data, data_crc32c=int(crc32c.hexdigest(), 16)))
+
+
+def install_fakes(poem_utils: PoemUtils, tts_utils: TtsUtils, authorization_utils: AuthorizationUtils,
+                  gemini: FakeGenerativeModel | None = None, tts: FakeTextToSpeechClient | None = None, secret_manager: FakeSecretManagerClient | None = None) -> None:
+    """Replaces the clients of the provided utils by fake backends, so that no network is needed.
+
+    Args:
+        poem_utils: The utils whose generative model is replaced.
+        tts_utils: The utils whose TTS client is replaced.
+        authorization_utils: The utils whose Secret Manager client is replaced.
+        gemini: The fake generative model, one without latency and errors if not given.
+        tts: The fake TTS client, one without latency and errors if not given.
+        secret_manager: The fake Secret Manager client, one without latency and errors if not given.
+    """
+    gemini = gemini or FakeGenerativeModel()
+    tts = tts or FakeTextToSpeechClient()
+    secret_manager = secret_manager or FakeSecretManagerClient()
+    poem_utils.models = ClientPool("gemini", lambda channel: gemini, size=1)
+    tts_utils.clients = ClientPool("tts", lambda channel: tts, size=1)
+    authorization_utils.clients = ClientPool("secret_manager", lambda channel: secret_manager, size=1)
@@ -0,0 +1,159 @@
+"""
+Drives the api at fixed concurrency levels and reports throughput, latency percentiles and memory.
+
+By default the app runs in-process with fake backends (see fakes.py), so no network is needed:
+
+    python -m benchmarks.harness --paths /print_poem /read_poem --concurrency 1 8 32 --duration 10 --gemini-latency 0.5 2
+
+With --url, a running server is driven instead, e.g. one serving benchmarks.app:app with some worker configuration.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import resource
+import sys
+import time
+from dataclasses import dataclass, asdict
+import httpx
+from benchmarks.fakes import API_KEY, Latency, FakeGenerativeModel, FakeTextToSpeechClient, FakeSecretManagerClient, install_fakes
+
+
+@dataclass
+class Result:
+    """The outcome of driving one path at one concurrency level."""
+    path: str
+    concurrency: int
+    requests: int
+    errors: int
+    rps: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+    # the peak resident memory of the process (in MiB), only measured for the in-process app
+    max_rss_mib: float | None
+
+
+def percentile(sorted_values: list[float], quantile: float) -> float:
+    """Returns the provided quantile of the provided sorted values, 0.0 if there are none."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(quantile * len(sorted_values)))]
+
+
+async def run_level(client: httpx.AsyncClient, path: str, concurrency: int, duration_seconds: float, topics: int, api_key: str, in_process: bool) -> Result:
+    """Sends requests to the provided path from the provided number of concurrent workers for the provided duration.
+
+    Args:
+        client: The client to send the requests with.
+        path: The path of the operation, e.g. "/print_poem".
+        concurrency: The number of concurrent workers, each sending its next request as soon as the previous one was answered.
+        duration_seconds: How long requests are sent.
+        topics: The number of distinct topics the requests cycle through, which determines how many are served from caches.
+        api_key: The api key sent with the requests.
+        in_process: Whether the app runs in this process, so that its memory can be measured.
+
+    Returns:
+        The result of the level.
+    """
+    latencies: list[float] = []
+    errors = 0
+    counter = itertools.count()
+    deadline = time.perf_counter() + duration_seconds
+
+    async def worker() -> None:
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            params = {"language": "en", "topic": f"topic {next(counter) % topics}", "api_key": api_key}
+            started_at = time.perf_counter()
+            try:
+                response = await client.get(path, params=params)
+                failed = response.status_code != 200
+            except httpx.HTTPError:
+                failed = True
+            latencies.append(time.perf_counter() - started_at)
+            errors += failed
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started_at
+    latencies.sort()
+    max_rss_mib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if in_process else None
+    return Result(path, concurrency, len(latencies), errors, len(latencies) / elapsed,
+                  percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000, percentile(latencies, 0.99) * 1000,
+                  (latencies[-1] if latencies else 0.0) * 1000, max_rss_mib)
+
+
+async def run(paths: list[str], concurrency_levels: list[int], duration_seconds: float, topics: int = 1000, url: str | None = None,
+              api_key: str = API_KEY, gemini: FakeGenerativeModel | None = None, tts: FakeTextToSpeechClient | None = None,
+              secret_manager: FakeSecretManagerClient | None = None) -> list[Result]:
+    """Drives every provided path at every provided concurrency level.
+
+    Args:
+        paths: The paths of the operations.
+        concurrency_levels: The numbers of concurrent workers.
+        duration_seconds: How long every level is driven.
+        topics: The number of distinct topics the requests cycle through.
+        url: The base url of a running server, the app is run in-process with fake backends if not given.
+        api_key: The api key sent with the requests.
+        gemini: The fake generative model of the in-process app.
+        tts: The fake TTS client of the in-process app.
+        secret_manager: The fake Secret Manager client of the in-process app.
+
+    Returns:
+        The results per path and level.
+    """
+    in_process = url is None
+    if in_process:
+        import main
+        install_fakes(main.poem_utils, main.tts_utils, main.authorization_utils, gemini, tts, secret_manager)
+        transport = httpx.ASGITransport(app=main.app)
+        url = "http://benchmark"
+    else:
+        transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=max(concurrency_levels)))
+    results = []
+    async with httpx.AsyncClient(transport=transport, base_url=url, timeout=None) as client:
+        for path, concurrency in itertools.product(paths, concurrency_levels):
+            results.append(await run_level(client, path, concurrency, duration_seconds, topics, api_key, in_process))
+    return results
+
+
+def format_results(results: list[Result]) -> str:
+    """Formats the provided results as table."""
+    header = f"{'path':<14}{'conc':>6}{'requests':>10}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'rss MiB':>10}"
+    lines = [header]
+    for result in results:
+        rss = "-" if result.max_rss_mib is None else f"{result.max_rss_mib:.0f}"
+        lines.append(f"{result.path:<14}{result.concurrency:>6}{result.requests:>10}{result.errors:>8}{result.rps:>10.1f}"
+                     f"{result.p50_ms:>10.1f}{result.p95_ms:>10.1f}{result.p99_ms:>10.1f}{result.max_ms:>10.1f}{rss:>10}")
+    return "\n".join(lines)
+
+
+def main(argv: list[str]) -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks the poem api at fixed concurrency levels.")
+    parser.add_argument("--paths", nargs="+", default=["/print_poem", "/read_poem"], help="the paths of the operations to drive")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32], help="the concurrency levels")
+    parser.add_argument("--duration", type=float, default=10, help="how long every level is driven (in seconds)")
+    parser.add_argument("--topics", type=int, default=1000, help="the number of distinct topics, fewer topics result in more cache hits")
+    parser.add_argument("--url", help="the base url of a running server, the app is run in-process with fake backends if not given")
+    parser.add_argument("--api-key", default=API_KEY, help="the api key for a running server")
+    parser.add_argument("--gemini-latency", nargs=2, type=float, default=[0.0, 0.0], metavar=("MEDIAN", "P99"), help="the latency of the fake Gemini (in seconds)")
+    parser.add_argument("--tts-latency", nargs=2, type=float, default=[0.0, 0.0], metavar=("MEDIAN", "P99"), help="the latency of the fake TTS (in seconds)")
+    parser.add_argument("--secret-latency", nargs=2, type=float, default=[0.0, 0.0], metavar=("MEDIAN", "P99"), help="the latency of the fake Secret Manager (in seconds)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="the share of fake backend calls failing with ServiceUnavailable")
+    parser.add_argument("--json", help="the file the results are written to as json, e.g. for comparing them with a baseline")
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run(args.paths, args.concurrency, args.duration, args.topics, args.url, args.api_key,
+                              FakeGenerativeModel(Latency(*args.gemini_latency), args.error_rate),
+                              FakeTextToSpeechClient(Latency(*args.tts_latency), args.error_rate),
+                              FakeSecretManagerClient(Latency(*args.secret_latency), args.error_rate)))
+    print(format_results(results))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump([asdict(result) for result in results], file, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
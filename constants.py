@@ -1,8 +1,149 @@
+import os
 
 PROJECT_ID = "poem-api-410415"
 
 SECRET_NAME="api-key"
-SECRET_VERSION=1
+# The version of the secret holding the api keys, "latest" so that a rotated secret is picked up without a redeployment.
+SECRET_VERSION = os.environ.get("SECRET_VERSION", "latest")
+
+# How long the api key fetched from the Secret Manager is cached in memory (in seconds).
+# A new version of the secret takes effect after at most this duration, unless SECRET_VERSION pins a version.
+API_KEY_CACHE_TTL_SECONDS = float(os.environ.get("API_KEY_CACHE_TTL_SECONDS", 300))
+# How long before the cached api key expires a background refresh is started (in seconds).
+API_KEY_REFRESH_MARGIN_SECONDS = float(os.environ.get("API_KEY_REFRESH_MARGIN_SECONDS", 30))
 
 GENERATIVE_MODEL_LOCATION = "us-central1"
-GENERATIVE_MODEL_NAME = "gemini-pro"
\ No newline at end of file
+GENERATIVE_MODEL_NAME = "gemini-pro"
+
+# How long the voice catalog of a language is used before it is refreshed in the background (in seconds).
+VOICE_CATALOG_REFRESH_SECONDS = float(os.environ.get("VOICE_CATALOG_REFRESH_SECONDS", 24 * 60 * 60))
+# For how many languages the best voices are kept in memory at most, the least recently used ones are evicted beyond it.
+VOICE_CATALOG_MAX_LANGUAGES = int(os.environ.get("VOICE_CATALOG_MAX_LANGUAGES", 256))
+
+# The number of worker processes serving the app, set by gunicorn.conf.py. The memory tiers of the caches are divided among them by default.
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", 1))
+# The directory of the cache tiers shared by the worker processes (the SQLite database of the poems and the audio files),
+# set to a directory in /dev/shm by gunicorn.conf.py if there are multiple workers.
+CACHE_DIRECTORY = os.environ.get("CACHE_DIRECTORY")
+
+# The poem cache is opt-in, as it trades the variety of generated poems for latency and cost.
+POEM_CACHE_ENABLED = os.environ.get("POEM_CACHE_ENABLED", "false").lower() == "true"
+# The maximum total size of the poems cached in memory (in bytes).
+POEM_CACHE_MEMORY_BYTES = int(os.environ.get("POEM_CACHE_MEMORY_BYTES", 16 * 1024 * 1024 // WORKERS))
+# How long cached poems are served (in seconds).
+POEM_CACHE_TTL_SECONDS = float(os.environ.get("POEM_CACHE_TTL_SECONDS", 24 * 60 * 60))
+# How many different poems are cached per language, maximum length and topic and served round-robin.
+POEM_CACHE_VARIANTS = int(os.environ.get("POEM_CACHE_VARIANTS", 1))
+# The path of the SQLite database persisting cached poems across restarts and sharing them between workers, no persistence if not set.
+POEM_CACHE_PATH = os.environ.get("POEM_CACHE_PATH", None if CACHE_DIRECTORY is None else os.path.join(CACHE_DIRECTORY, "poems.sqlite3"))
+# How long reading and writing cached poems waits for other workers holding the lock of the database (in seconds), as it blocks the event loop.
+# If the lock isn't acquired in time, the poem is generated or isn't persisted.
+POEM_CACHE_LOCK_TIMEOUT_SECONDS = float(os.environ.get("POEM_CACHE_LOCK_TIMEOUT_SECONDS", 0.05))
+
+# The maximum total size of the synthesized audio cached in memory (in bytes), 0 disables the memory tier.
+AUDIO_CACHE_MEMORY_BYTES = int(os.environ.get("AUDIO_CACHE_MEMORY_BYTES", 64 * 1024 * 1024 // WORKERS))
+# The directory synthesized audio is cached in on disk and shared between workers, no disk tier if not set.
+AUDIO_CACHE_PATH = os.environ.get("AUDIO_CACHE_PATH", None if CACHE_DIRECTORY is None else os.path.join(CACHE_DIRECTORY, "audio"))
+# The maximum total size of the synthesized audio cached on disk (in bytes).
+AUDIO_CACHE_DISK_BYTES = int(os.environ.get("AUDIO_CACHE_DISK_BYTES", 1024 * 1024 * 1024))
+# How long clients may reuse a synthesized audio without revalidating it via its ETag (in seconds).
+AUDIO_RESPONSE_MAX_AGE_SECONDS = int(os.environ.get("AUDIO_RESPONSE_MAX_AGE_SECONDS", 3600))
+
+# The default rate limit of the api keys, i.e. the tokens per minute that refill the token bucket of a key and the size of the bucket,
+# which the secret can override per key. A rate of 0 disables rate limiting.
+RATE_LIMIT_TOKENS_PER_MINUTE = float(os.environ.get("RATE_LIMIT_TOKENS_PER_MINUTE", 120))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", 60))
+# The tokens a request takes from the bucket of its api key per operation, overridable e.g. by "read_poem=8,print_poem=2".
+# A poem of a batch costs like print_poem, or like read_poem if it is synthesized.
+RATE_LIMIT_COSTS = {"print_poem": 1.0, "stream_poem": 1.0, "read_poem": 4.0,
+                    **{operation.strip(): float(cost) for operation, cost in (entry.split("=", 1) for entry in os.environ.get("RATE_LIMIT_COSTS", "").split(",") if "=" in entry)}}
+# The path of the SQLite database sharing the token buckets of the api keys between the workers, kept in memory per worker if not set.
+RATE_LIMIT_PATH = os.environ.get("RATE_LIMIT_PATH", None if CACHE_DIRECTORY is None else os.path.join(CACHE_DIRECTORY, "rate_limits.sqlite3"))
+# How long taking tokens waits for other workers holding the lock of the database (in seconds), as it blocks the event loop.
+# If the lock isn't acquired in time, the tokens are taken from a bucket of the worker.
+RATE_LIMIT_LOCK_TIMEOUT_SECONDS = float(os.environ.get("RATE_LIMIT_LOCK_TIMEOUT_SECONDS", 0.05))
+
+# The poem pool is opt-in, as it spends Gemini (and TTS) quota on poems nobody might ask for: it keeps poems (and audio) pre-generated
+# for the most requested keys, which are served without waiting for a generation.
+POEM_POOL_ENABLED = os.environ.get("POEM_POOL_ENABLED", "false").lower() == "true"
+# Whether audio is pre-synthesized for the most requested keys of read_poem, besides the poems of print_poem.
+POEM_POOL_AUDIO_ENABLED = os.environ.get("POEM_POOL_AUDIO_ENABLED", "false").lower() == "true"
+# For how many of the most requested keys, and how many poems per key, are kept.
+POEM_POOL_TOP_KEYS = int(os.environ.get("POEM_POOL_TOP_KEYS", 20))
+POEM_POOL_SIZE = int(os.environ.get("POEM_POOL_SIZE", 2))
+# The popularity a key needs at least before poems are pre-generated for it, i.e. its number of requests, each decaying
+# with the half-life POEM_POOL_HALF_LIFE_SECONDS (after how long a request counts half).
+POEM_POOL_MIN_REQUESTS = float(os.environ.get("POEM_POOL_MIN_REQUESTS", 3))
+POEM_POOL_HALF_LIFE_SECONDS = float(os.environ.get("POEM_POOL_HALF_LIFE_SECONDS", 600))
+# The budget of pre-generations per hour, divided among the workers by default, and how many run concurrently at most.
+POEM_POOL_GENERATIONS_PER_HOUR = float(os.environ.get("POEM_POOL_GENERATIONS_PER_HOUR", 600 / WORKERS))
+POEM_POOL_CONCURRENCY = int(os.environ.get("POEM_POOL_CONCURRENCY", 2))
+# How long pre-generated poems are served (in seconds), and how often the pool is refilled (in seconds).
+POEM_POOL_MAX_AGE_SECONDS = float(os.environ.get("POEM_POOL_MAX_AGE_SECONDS", 60 * 60))
+POEM_POOL_REFILL_INTERVAL_SECONDS = float(os.environ.get("POEM_POOL_REFILL_INTERVAL_SECONDS", 5))
+
+# The maximum number of lines of a poem that are synthesized at once when streaming audio.
+POEM_STREAM_MAX_LINES_PER_CHUNK = int(os.environ.get("POEM_STREAM_MAX_LINES_PER_CHUNK", 4))
+# The maximum number of chunks of a poem that are synthesized concurrently when streaming audio.
+TTS_STREAM_CONCURRENCY = int(os.environ.get("TTS_STREAM_CONCURRENCY", 4))
+
+# The default and maximum number of items of a batch that are processed concurrently.
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 8))
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", 32))
+
+# The adaptive concurrency limits of the calls to Gemini and to TTS: the initial and the maximum number of concurrent calls,
+# the latency above which the limit is decreased (in seconds), and how many calls may wait for how long (in seconds) before they are shed.
+GEMINI_CONCURRENCY_INITIAL = int(os.environ.get("GEMINI_CONCURRENCY_INITIAL", 16))
+GEMINI_CONCURRENCY_MAX = int(os.environ.get("GEMINI_CONCURRENCY_MAX", 64))
+GEMINI_LATENCY_TARGET_SECONDS = float(os.environ.get("GEMINI_LATENCY_TARGET_SECONDS", 15))
+GEMINI_QUEUE_SIZE = int(os.environ.get("GEMINI_QUEUE_SIZE", 64))
+GEMINI_QUEUE_TIMEOUT_SECONDS = float(os.environ.get("GEMINI_QUEUE_TIMEOUT_SECONDS", 10))
+TTS_CONCURRENCY_INITIAL = int(os.environ.get("TTS_CONCURRENCY_INITIAL", 16))
+TTS_CONCURRENCY_MAX = int(os.environ.get("TTS_CONCURRENCY_MAX", 64))
+TTS_LATENCY_TARGET_SECONDS = float(os.environ.get("TTS_LATENCY_TARGET_SECONDS", 5))
+TTS_QUEUE_SIZE = int(os.environ.get("TTS_QUEUE_SIZE", 64))
+TTS_QUEUE_TIMEOUT_SECONDS = float(os.environ.get("TTS_QUEUE_TIMEOUT_SECONDS", 10))
+
+# How long requests may take at most (in seconds), clients can request a shorter timeout via the X-Request-Timeout header.
+REQUEST_TIMEOUT_SECONDS = float(os.environ.get("REQUEST_TIMEOUT_SECONDS", 120))
+# How often failed upstream calls are attempted at most, and the base and maximum delay of the exponential backoff (in seconds).
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", 3))
+RETRY_BASE_DELAY_SECONDS = float(os.environ.get("RETRY_BASE_DELAY_SECONDS", 0.5))
+RETRY_MAX_DELAY_SECONDS = float(os.environ.get("RETRY_MAX_DELAY_SECONDS", 4))
+# Whether slow generations are hedged by a second generation after the GEMINI_HEDGE_QUANTILE of the observed latencies.
+GEMINI_HEDGING_ENABLED = os.environ.get("GEMINI_HEDGING_ENABLED", "false").lower() == "true"
+GEMINI_HEDGE_QUANTILE = float(os.environ.get("GEMINI_HEDGE_QUANTILE", 0.95))
+# Whether generations arriving within GEMINI_BATCH_WINDOW_SECONDS (in seconds) are batched into a single prompt asking for up to
+# GEMINI_BATCH_MAX_SIZE poems, which saves round trips and per-call overhead at high load. Hedging isn't done for batched generations.
+GEMINI_BATCHING_ENABLED = os.environ.get("GEMINI_BATCHING_ENABLED", "false").lower() == "true"
+GEMINI_BATCH_WINDOW_SECONDS = float(os.environ.get("GEMINI_BATCH_WINDOW_SECONDS", 0.005))
+GEMINI_BATCH_MAX_SIZE = int(os.environ.get("GEMINI_BATCH_MAX_SIZE", 8))
+
+# The number of gRPC channels (each with its own HTTP/2 connection) per upstream and worker, over which the concurrent calls are spread.
+GEMINI_CHANNELS = int(os.environ.get("GEMINI_CHANNELS", 2))
+TTS_CHANNELS = int(os.environ.get("TTS_CHANNELS", 2))
+SECRET_MANAGER_CHANNELS = int(os.environ.get("SECRET_MANAGER_CHANNELS", 1))
+# The number of concurrent calls per channel beyond which further channels are opened, up to GRPC_MAX_CHANNELS per upstream and worker.
+# Google's frontends allow 100 concurrent streams per HTTP/2 connection, further calls would wait for a stream.
+GRPC_MAX_STREAMS_PER_CHANNEL = int(os.environ.get("GRPC_MAX_STREAMS_PER_CHANNEL", 100))
+GRPC_MAX_CHANNELS = int(os.environ.get("GRPC_MAX_CHANNELS", 8))
+# After how long without activity a connection with calls in flight is pinged, and how long the ping may take before the connection is
+# considered dead and reconnected (in seconds), so that calls don't hang on connections silently dropped by the network.
+GRPC_KEEPALIVE_SECONDS = float(os.environ.get("GRPC_KEEPALIVE_SECONDS", 60))
+GRPC_KEEPALIVE_TIMEOUT_SECONDS = float(os.environ.get("GRPC_KEEPALIVE_TIMEOUT_SECONDS", 20))
+
+# The languages whose TTS voice catalogs are loaded at startup, comma separated.
+PRELOAD_LANGUAGES = [language.strip() for language in os.environ.get("PRELOAD_LANGUAGES", "en").split(",") if language.strip()]
+
+# The log level, and the levels of single modules overriding it, e.g. "PoemUtils=DEBUG,TtsUtils=WARNING".
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_LEVELS = dict(entry.strip().split("=", 1) for entry in os.environ.get("LOG_LEVELS", "").split(",") if "=" in entry)
+# "json" for json lines as understood by Cloud Logging, "text" for human readable lines.
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+# The share of requests whose payloads (prompts, responses, poems) are logged at debug level.
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", 1.0))
+
+# Where spans of the requests and their stages are exported to: "otlp" for a collector configured via the OTEL_EXPORTER_OTLP_* variables,
+# "file" for the file TRACING_FILE_PATH, not exported if not set. Requires the OpenTelemetry SDK.
+TRACING_EXPORTER = os.environ.get("TRACING_EXPORTER")
+TRACING_FILE_PATH = os.environ.get("TRACING_FILE_PATH", "spans.jsonl")
@@ -0,0 +1,74 @@
+"""
+The configuration of gunicorn, see https://docs.gunicorn.org/en/stable/settings.html.
+
+One uvicorn worker process is started per available CPU, each serving any number of requests concurrently on its event loop.
+The application is imported once before the workers are forked, which shares the imported modules' memory between
+them, and the workers share the persistent tiers of the poem and audio caches via CACHE_DIRECTORY.
+"""
+import math
+import os
+import tempfile
+
+
+def cpu_limit(cgroup_root: str = "/sys/fs/cgroup") -> int:
+    """Returns the number of CPUs the process may use, which is bounded by its CPU affinity and the CPU quota of its cgroup.
+
+    Containers usually see all CPUs of the host, while their cgroup quota (e.g. the CPU limit of the Cloud Run service)
+    allows them to only use a few.
+
+    Args:
+        cgroup_root: The mount point of the cgroup file system.
+
+    Returns:
+        The number of usable CPUs, rounded up and at least 1.
+    """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    quota = _cgroup_quota(cgroup_root)
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+
+def _cgroup_quota(cgroup_root: str) -> float | None:
+    """Returns the CPU quota of the cgroup in CPUs, None if it is unlimited or unknown."""
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open(os.path.join(cgroup_root, "cpu.max")) as file:
+            quota, period = file.read().split()
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1: a quota of -1 means unlimited
+        with open(os.path.join(cgroup_root, "cpu", "cpu.cfs_quota_us")) as file:
+            quota = int(file.read())
+        with open(os.path.join(cgroup_root, "cpu", "cpu.cfs_period_us")) as file:
+            period = int(file.read())
+        return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        return None
+
+
+workers = int(os.environ.get("WEB_CONCURRENCY", cpu_limit()))
+# read by constants.py, which divides the memory tiers of the caches among the workers
+os.environ["WEB_CONCURRENCY"] = str(workers)
+if workers > 1:
+    # shared by the workers, in memory if possible
+    os.environ.setdefault("CACHE_DIRECTORY", os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "poem-api"))
+
+worker_class = "uvicorn.workers.UvicornWorker"
+bind = f":{os.environ.get('PORT', 8080)}"
+# imports the application before forking the workers, so that a broken application fails at startup and the workers start fast
+preload_app = True
+# disabled, as the workers are async and Cloud Run scales the instances
+timeout = 0
+# how long the workers may finish the requests in flight after SIGTERM, Cloud Run kills the instance 10 seconds after sending it
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 8))
+# longer than the idle timeout of the load balancer in front, so that it never reuses a connection the server is closing
+keepalive = int(os.environ.get("KEEPALIVE", 650))
+
+
+def post_fork(server, worker):
+    # the thread writing the logs isn't inherited by the forked worker
+    from LoggingUtils import configure_logging
+    configure_logging()
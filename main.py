@@ -1,15 +1,149 @@
-from connexion import AsyncApp
+import time
+# taken before the remaining imports, so that the time spent importing is reported by the readiness endpoint
+_imports_started_at = time.perf_counter()
+import asyncio
+import base64
+import json
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable
+from connexion import AsyncApp, request
+from connexion.context import context
+from connexion.middleware import MiddlewarePosition
+from connexion.exceptions import ProblemException, BadRequestProblem
+from starlette.responses import Response, StreamingResponse
 from PoemUtils import PoemUtils
-from TtsUtils import TtsUtils
-from AuthorizationUtils import AuthorizationUtils
+from TtsUtils import TtsUtils, AudioFormat, AUDIO_MEDIA_TYPES
+from AuthorizationUtils import AuthorizationUtils, ApiKey
+from RateLimitUtils import RateLimiter
+from PoolUtils import PoemPool
+from CacheUtils import track_cache_statuses, cache_headers
+from ResponseUtils import content_response, etag, negotiate, not_modified
+from ConcurrencyUtils import request_priority, PRIORITY_HIGH, PRIORITY_LOW
+from RetryUtils import DeadlineMiddleware, request_deadline, timeout_seconds
+from LoggingUtils import RequestContextMiddleware, configure_logging
+from MetricsUtils import REGISTRY, CallbackMetric, MetricsMiddleware, configure_tracing, stage
+from constants import BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY, PRELOAD_LANGUAGES, AUDIO_RESPONSE_MAX_AGE_SECONDS, POEM_POOL_ENABLED, RATE_LIMIT_COSTS
 
-app = AsyncApp(__name__)
+import_seconds = time.perf_counter() - _imports_started_at
+
+configure_logging()
+configure_tracing()
+logger = logging.getLogger(__name__)
 
 poem_utils = PoemUtils()
 tts_utils = TtsUtils()
 authorization_utils = AuthorizationUtils()
+rate_limiter = RateLimiter()
+poem_pool = PoemPool(poem_utils, tts_utils) if POEM_POOL_ENABLED else None
+
+# how long the steps of the warm-up took (in seconds), and the steps that failed
+warm_up_seconds: dict[str, float] = {}
+warm_up_failures: list[str] = []
+warm_up_task: asyncio.Task | None = None
+
+@asynccontextmanager
+async def lifespan(_app: Any) -> AsyncIterator[None]:
+    """Starts warming up the clients and refilling the poem pool when the server starts, while the server already accepts requests,
+    and stops both and closes the channels of the clients on shutdown."""
+    global warm_up_task
+    warm_up_task = asyncio.ensure_future(_warm_up())
+    pool_task = None if poem_pool is None else asyncio.ensure_future(poem_pool.run())
+    try:
+        yield
+    finally:
+        warm_up_task.cancel()
+        if pool_task is not None:
+            pool_task.cancel()
+        await asyncio.gather(poem_utils.models.close(), tts_utils.clients.close(), authorization_utils.clients.close())
+
+async def _warm_up() -> None:
+    """Prepares the clients, opening their channels, and preloads the api key and the voice catalogs concurrently."""
+    warm_up_seconds.clear()
+    warm_up_failures.clear()
+
+    async def step(name: str, preload: Awaitable[None]) -> None:
+        started_at = time.perf_counter()
+        try:
+            await preload
+        except Exception as exception:
+            # not fatal, the requests prepare what is missing themselves
+            logger.warning("warming up %s failed: %r", name, exception)
+            warm_up_failures.append(name)
+        warm_up_seconds[name] = time.perf_counter() - started_at
+
+    await asyncio.gather(step("generative_model", poem_utils.preload_model()),
+                         step("tts", tts_utils.preload_voices(PRELOAD_LANGUAGES)),
+                         step("api_key", authorization_utils.preload_key()))
+    logger.info("warm-up finished", extra={"warm_up_seconds": warm_up_seconds})
+
+app = AsyncApp(__name__, lifespan=lifespan)
+# batches can take far longer than a request, their items set their own deadlines instead
+app.add_middleware(DeadlineMiddleware, exempt_paths=("/poems:batch",))
+# outside of the exception handling, so that every request is seen with its final status, including failed authorizations
+app.add_middleware(RequestContextMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION)
+app.add_middleware(MetricsMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION)
+
+def _cache_counts() -> dict[str, tuple[int, int]]:
+    """Returns the hits and misses per cache."""
+    counts = {"api_key": (authorization_utils.cache_hits, authorization_utils.cache_misses),
+              "audio": (tts_utils.audio_cache.hits, tts_utils.audio_cache.misses)}
+    if poem_utils.cache is not None:
+        counts["poem"] = (poem_utils.cache.hits, poem_utils.cache.misses)
+    return counts
+
+def _upstreams() -> dict[str, PoemUtils | TtsUtils]:
+    """Returns the utils calling the upstreams, whose limiters and single flights are exported."""
+    return {"gemini": poem_utils, "tts": tts_utils}
+
+# read from the counters of the utils when scraped, as these are replaced in tests
+REGISTRY.register(CallbackMetric("poem_cache_lookups", "The number of cache lookups by result", "counter", ["cache", "result"],
+                                 lambda: {(cache, result): count for cache, (hits, misses) in _cache_counts().items() for result, count in (("hit", hits), ("miss", misses))}))
+REGISTRY.register(CallbackMetric("poem_cache_hit_ratio", "The share of cache lookups that were hits", "gauge", ["cache"],
+                                 lambda: {(cache,): hits / (hits + misses) for cache, (hits, misses) in _cache_counts().items() if hits + misses}))
+REGISTRY.register(CallbackMetric("poem_upstream_concurrency_limit", "The current adaptive concurrency limit of the upstream calls", "gauge", ["upstream"],
+                                 lambda: {(upstream,): utils.limiter.limit for upstream, utils in _upstreams().items()}))
+REGISTRY.register(CallbackMetric("poem_upstream_in_flight", "The number of upstream calls currently in flight", "gauge", ["upstream"],
+                                 lambda: {(upstream,): utils.limiter.in_flight for upstream, utils in _upstreams().items()}))
+REGISTRY.register(CallbackMetric("poem_upstream_queued", "The number of upstream calls currently waiting for the concurrency limit", "gauge", ["upstream"],
+                                 lambda: {(upstream,): utils.limiter.queued for upstream, utils in _upstreams().items()}))
+REGISTRY.register(CallbackMetric("poem_upstream_shed", "The number of upstream calls shed by the concurrency limit", "counter", ["upstream"],
+                                 lambda: {(upstream,): utils.limiter.rejected for upstream, utils in _upstreams().items()}))
+REGISTRY.register(CallbackMetric("poem_upstream_coalesced", "The number of upstream calls saved by coalescing identical calls", "counter", ["upstream"],
+                                 lambda: {(upstream,): utils.single_flight.coalesced for upstream, utils in _upstreams().items()}))
+REGISTRY.register(CallbackMetric("poem_upstream_channels", "The number of gRPC channels to the upstreams by connectivity state", "gauge", ["upstream", "state"],
+                                 lambda: {(pool.name, state): count for pool in (poem_utils.models, tts_utils.clients, authorization_utils.clients) for state, count in pool.states().items()}))
+
+REGISTRY.register(CallbackMetric("poem_gemini_batched_prompts", "The number of prompts generated in batches, by whether the batch succeeded or fell back to individual generations", "counter", ["result"],
+                                 lambda: {("batched",): poem_utils.batched_prompts, ("fallback",): poem_utils.batch_fallbacks}))
+REGISTRY.register(CallbackMetric("poem_pool_lookups", "The number of lookups of pre-generated poems by result", "counter", ["result"],
+                                 lambda: {} if poem_pool is None else {("hit",): poem_pool.hits, ("miss",): poem_pool.misses}))
+REGISTRY.register(CallbackMetric("poem_pool_generations", "The number of pre-generated poems by result, expired ones were never served", "counter", ["result"],
+                                 lambda: {} if poem_pool is None else {("success",): poem_pool.generated, ("failure",): poem_pool.failed, ("expired",): poem_pool.expired}))
+REGISTRY.register(CallbackMetric("poem_pool_entries", "The number of pre-generated poems waiting to be served", "gauge", [],
+                                 lambda: {} if poem_pool is None else {(): poem_pool.entries}))
+REGISTRY.register(CallbackMetric("poem_rate_limit_requests", "The number of requests by whether they were accepted or rejected by the rate limit of their api key", "counter", ["result"],
+                                 lambda: {("accepted",): rate_limiter.accepted, ("rejected",): rate_limiter.rejected}))
+
+async def metrics() -> tuple[str, int, dict[str, str]]:
+    """Returns the metrics in the Prometheus text format.
+
+    Returns:
+        The metrics, the response code and the content type header.
+    """
+    return REGISTRY.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+async def readiness() -> tuple[dict[str, Any], int]:
+    """Tells whether the warm-up has finished, so that the instance is ready to serve requests without delay.
 
-async def print_poem(language: str, max_length: int, topic: str = None) -> tuple[str, int]:
+    Returns:
+        The readiness with the import and warm-up durations and the failed warm-up steps, and the response code (200 if ready, 503 otherwise).
+    """
+    ready = warm_up_task is not None and warm_up_task.done()
+    body = {"ready": ready, "import_seconds": import_seconds, "warm_up_seconds": dict(warm_up_seconds), "warm_up_failures": list(warm_up_failures)}
+    return body, 200 if ready else 503
+
+async def print_poem(language: str, max_length: int, topic: str = None) -> tuple[str, int, dict[str, str]]:
     """Generates a poem and returns it as plain text.
 
     Args:
@@ -18,41 +152,211 @@ async def print_poem(language: str, max_length: int, topic: str = None) -> tuple
         topic: The topic the poem should be about.
 
     Returns:
-        The generated poem as plain text and the response code.
+        The generated poem as plain text, the response code and the RateLimit and X-Cache headers.
+
+    Raises:
+        RateLimited if the api key exceeded its rate limit.
+    """
+    rate_limit_headers = _rate_limit(RATE_LIMIT_COSTS["print_poem"])
+    request_priority.set(PRIORITY_HIGH)
+    cache_statuses = track_cache_statuses()
+    poem: str | None = None if poem_pool is None else poem_pool.take_poem(language, max_length, topic)
+    if poem is None:
+        poem = await poem_utils.generate_poem(language, max_length, topic)
+    return poem, 200, {**rate_limit_headers, **cache_headers(cache_statuses)}
+
+async def stream_poem(language: str, max_length: int, topic: str | None = None) -> StreamingResponse:
+    """Generates a poem and streams it line by line as server-sent events while it is being generated.
+
+    Args:
+        language: The language as IETF language tag.
+        max_length: The maximum length of the poem (in lines).
+        topic: The topic the poem should be about.
+
+    Returns:
+        A streaming response of "line" events, followed by a "done" event or by an "error" event if the generation fails.
+
+    Raises:
+        RateLimited if the api key exceeded its rate limit.
     """
-    return await poem_utils.generate_poem(language, max_length, topic), 200
+    rate_limit_headers = _rate_limit(RATE_LIMIT_COSTS["stream_poem"])
+    request_priority.set(PRIORITY_HIGH)
+    lines = poem_utils.stream_lines(language, max_length, topic)
+    return StreamingResponse(_server_sent_events(lines), media_type="text/event-stream", headers={**rate_limit_headers, "Cache-Control": "no-cache"})
 
-async def read_poem(language: str, max_length: int, gender: str, topic: str | None = None) -> tuple[bytes, int]:
-    """Generates a poem, synthesizes it via TTS and returns it as mp3.
+async def _server_sent_events(lines: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Formats the provided lines as server-sent events, see stream_poem."""
+    try:
+        async for line in lines:
+            data = line.rstrip("\r")
+            yield f"event: line\ndata: {data}\n\n"
+    except ProblemException as exception:
+        yield _server_sent_error(exception.status, exception.title, exception.detail)
+        return
+    except Exception as exception:
+        logger.exception("streaming the poem failed")
+        yield _server_sent_error(500, "Internal Server Error", "streaming the poem failed")
+        return
+    yield "event: done\ndata: \n\n"
+
+def _server_sent_error(status: int, title: str, detail: str) -> str:
+    """Formats an error as server-sent event whose data is a problem json object."""
+    return f"event: error\ndata: {json.dumps({'status': status, 'title': title, 'detail': detail})}\n\n"
+
+async def read_poem(language: str, max_length: int, gender: str, topic: str | None = None, stream: bool = False, format: str | None = None,
+                    sample_rate: int | None = None, speaking_rate: float = 1.0) -> Response:
+    """Generates a poem, synthesizes it via TTS and returns it as audio.
 
     Args:
         language: The language as IETF language tag.
         max_length: The maximum length of the poem (in lines).
         gender: The gender of the TTS voice to use ("female", "male" or "unspecified").
         topic: The topic the poem should be about.
+        stream: Whether the poem should be synthesized stanza by stanza while it is being generated and the audio data be streamed.
+        format: The audio encoding ("mp3", "ogg_opus" or "linear16"), negotiated via the Accept header if not given.
+        sample_rate: The sample rate of the audio (in Hz), the natural sample rate of the voice if not given.
+        speaking_rate: The speaking rate, 1.0 being the normal speed of the voice.
+
+    Returns:
+        The audio data with the RateLimit, X-Cache, ETag and Cache-Control headers, of which a single byte range is returned if requested via
+        the Range header (see content_response), nothing and without synthesizing it if the ETag is listed in the If-None-Match header,
+        or a streaming response of the audio data if streaming was requested.
+
+    Raises:
+        BadRequestProblem if linear16 audio should be streamed, as its chunks would be separate wav files.
+        RateLimited if the api key exceeded its rate limit.
+    """
+    headers = _rate_limit(RATE_LIMIT_COSTS["read_poem"])
+    # synthesizing is expensive, so generating text is prioritized when the upstreams are saturated
+    request_priority.set(PRIORITY_LOW)
+    cache_statuses = track_cache_statuses()
+    if format is None:
+        encodings = {media_type: encoding for encoding, media_type in AUDIO_MEDIA_TYPES.items() if not (stream and encoding == "linear16")}
+        # mp3 if nothing acceptable is available, rather than failing
+        format = encodings.get(negotiate(request.headers.get("accept"), list(encodings)), "mp3")
+        headers["Vary"] = "Accept"
+    elif stream and format == "linear16":
+        raise BadRequestProblem(detail="linear16 audio can't be streamed")
+    audio_format = AudioFormat(format, sample_rate, speaking_rate)
+    if stream:
+        stanzas = poem_utils.stream_stanzas(language, max_length, topic)
+        audio_chunks = tts_utils.synthesize_stream(stanzas, language, gender, audio_format=audio_format)
+        # awaited before responding, so that failing before the first chunk still results in an error response
+        first_chunk = await anext(audio_chunks, None)
+        return StreamingResponse(_prepend(first_chunk, audio_chunks), media_type=audio_format.media_type, headers={**headers, **cache_headers(cache_statuses)})
+    pooled: tuple[str, bytes | memoryview] | None = None if poem_pool is None else poem_pool.take_audio(language, max_length, topic, gender, audio_format)
+    audio: bytes | memoryview | None = None
+    if pooled is None:
+        poem: str = await poem_utils.generate_poem(language, max_length, topic)
+    else:
+        poem, audio = pooled
+    # derived from the key of the audio, so that a current copy of the client is confirmed without synthesizing or hashing the audio
+    current_etag = etag(await tts_utils.audio_key(poem, language, gender, audio_format))
+    response = not_modified(request.headers, current_etag, {**headers, **cache_headers(cache_statuses)}, AUDIO_RESPONSE_MAX_AGE_SECONDS)
+    if response is not None:
+        return response
+    if audio is None:
+        audio = await tts_utils.synthesize(poem, language, gender, audio_format)
+    # returned as response, so that the memory mapped audio of the cache is sent without being copied
+    return content_response(audio, audio_format.media_type, request.headers, {**headers, **cache_headers(cache_statuses)}, AUDIO_RESPONSE_MAX_AGE_SECONDS, current_etag)
+
+async def _prepend(first_chunk: bytes | memoryview | None, chunks: AsyncIterator[bytes | memoryview]) -> AsyncIterator[bytes | memoryview]:
+    """Yields the provided first chunk, unless it is None, followed by the provided chunks."""
+    if first_chunk is not None:
+        yield first_chunk
+    async for chunk in chunks:
+        yield chunk
+
+async def batch_poems(body: dict[str, Any]) -> StreamingResponse:
+    """Generates many poems, optionally synthesized via TTS, and streams the results as newline delimited json in completion order.
+
+    Args:
+        body: The batch, containing the specs of the poems as "items" and optionally the number of items processed concurrently as "concurrency".
+
+    Every item has its own deadline, starting when the item is processed, which the X-Request-Timeout header shortens as for other requests.
 
     Returns:
-        The poem as bytes representing the mp3 data and the response code.
+        A streaming response with one json object per item, containing the index of the item and either the poem
+        (and the base64 encoded mp3 data if audio was requested) or the error that occurred for the item.
+
+    Raises:
+        CostExceedsBurst if the batch costs more than the api key can spend at once, the batch costing as much as its items requested individually.
+        RateLimited if the api key exceeded its rate limit.
     """
-    poem: str = await poem_utils.generate_poem(language, max_length, topic)
-    audio: bytes = await tts_utils.synthesize(poem, language, gender)
-    return audio, 200
+    items: list[dict[str, Any]] = body["items"]
+    rate_limit_headers = _rate_limit(sum(RATE_LIMIT_COSTS["read_poem" if item.get("audio", False) else "print_poem"] for item in items))
+    request_priority.set(PRIORITY_LOW)
+    concurrency = min(body.get("concurrency", BATCH_CONCURRENCY), BATCH_MAX_CONCURRENCY)
+    item_timeout_seconds = timeout_seconds(request.headers.get("x-request-timeout"))
+    return StreamingResponse(_batch_results(items, concurrency, item_timeout_seconds), media_type="application/x-ndjson", headers=rate_limit_headers)
+
+async def _batch_results(items: list[dict[str, Any]], concurrency: int, item_timeout_seconds: float) -> AsyncIterator[str]:
+    """Processes the provided batch items with the provided concurrency and yields the results as json lines in completion order,
+    every item with the provided timeout."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(index: int, item: dict[str, Any]) -> dict[str, Any]:
+        async with semaphore:
+            # set in the task of the item only
+            request_deadline.set(time.monotonic() + item_timeout_seconds)
+            try:
+                return {"index": index, **await _batch_item(item)}
+            except ProblemException as exception:
+                return {"index": index, "error": {"status": exception.status, "title": exception.title, "detail": exception.detail}}
+            except Exception as exception:
+                logger.exception("processing batch item %d failed", index)
+                return {"index": index, "error": {"status": 500, "title": "Internal Server Error", "detail": "processing the item failed"}}
+
+    tasks = [asyncio.ensure_future(process(index, item)) for index, item in enumerate(items)]
+    try:
+        for result in asyncio.as_completed(tasks):
+            result = await result
+            with stage("serialization"):
+                line = json.dumps(result) + "\n"
+            yield line
+    finally:
+        # the client disconnected before all items were processed
+        for task in tasks:
+            task.cancel()
 
-async def apikey_auth(api_key: str)-> None:
+async def _batch_item(item: dict[str, Any]) -> dict[str, str]:
+    """Generates the poem specified by the provided batch item, synthesized via TTS if the item requests audio."""
+    language: str = item.get("language", "en")
+    poem: str = await poem_utils.generate_poem(language, item.get("max_length", 12), item.get("topic"))
+    result = {"poem": poem}
+    if item.get("audio", False):
+        audio: bytes | memoryview = await tts_utils.synthesize(poem, language, item.get("gender", "unspecified"))
+        with stage("serialization"):
+            result["audio"] = base64.b64encode(audio).decode("ascii")
+    return result
+
+async def apikey_auth(api_key: str) -> dict[str, Any]:
     """ Uses the provided api key to perform authorization.
 
     Args:
         api_key: The api key to be checked.
 
     Returns:
-        A dict conterning minimal rfc7662 information.
+        A dict conterning minimal rfc7662 information, with the name of the key's caller as subject and the key for rate limiting.
 
     Raises:
         Unauthorized if the api key is not valid.
     """
     # will throw an exception if not authorized
-    await authorization_utils.check_api_key(api_key)
-    return {"active": True}
+    key: ApiKey = await authorization_utils.check_api_key(api_key)
+    return {"active": True, "sub": key.name, "api_key": key}
+
+def _rate_limit(cost: float) -> dict[str, str]:
+    """Takes the provided cost from the token bucket of the api key of the current request.
+
+    Returns:
+        The RateLimit headers of the api key.
+
+    Raises:
+        CostExceedsBurst if the cost exceeds the bucket size of the api key.
+        RateLimited if the api key exceeded its rate limit.
+    """
+    return rate_limiter.take(context["token_info"]["api_key"], cost)
 
 app.add_api("poem_api.yaml")
 
@@ -1,6 +1,7 @@
 from unittest.mock import AsyncMock, patch, MagicMock
+import asyncio
 import pytest
-from AuthorizationUtils import AuthorizationUtils
+from AuthorizationUtils import AuthorizationUtils, ApiKey, parse_api_keys
 from google_crc32c import Checksum
 from connexion.exceptions import Unauthorized
 from google.cloud.secretmanager import SecretManagerServiceAsyncClient
@@ -20,7 +21,7 @@ async def test_generate_poem_ok(mock: AsyncMock):
     secret_payload = MagicMock(data = data, data_crc32c=checksum)
     mock.return_value  = MagicMock(payload=secret_payload)
 
-    await authorization_utils.check_api_key(key)
+    assert await authorization_utils.check_api_key(key) == ApiKey("default")
     mock.assert_called_once_with(name=SECRET_NAME)
 
 @patch("google.cloud.secretmanager.SecretManagerServiceAsyncClient.access_secret_version")
@@ -55,7 +56,92 @@ async def test_generate_poem_wrong_key(mock: AsyncMock):
         await authorization_utils.check_api_key("wrong key")  
     mock.assert_called_once_with(name=SECRET_NAME)
 
+@patch("google.cloud.secretmanager.SecretManagerServiceAsyncClient.access_secret_version")
+@pytest.mark.asyncio
+async def test_check_api_key_cached(mock: AsyncMock):
+    authorization_utils = AuthorizationUtils(ttl_seconds=60, refresh_margin_seconds=0)
+    mock.return_value = mock_secret_response("correct key")
+
+    await authorization_utils.check_api_key("correct key")
+    await authorization_utils.check_api_key("correct key")
+    with pytest.raises(Unauthorized):
+        await authorization_utils.check_api_key("wrong key")
+    mock.assert_called_once_with(name=SECRET_NAME)
+    assert authorization_utils.cache_hits == 2
+    assert authorization_utils.cache_misses == 1
+    assert authorization_utils.cache_hit_rate == 2 / 3
+
+@patch("google.cloud.secretmanager.SecretManagerServiceAsyncClient.access_secret_version")
+@pytest.mark.asyncio
+async def test_check_api_key_expired(mock: AsyncMock):
+    authorization_utils = AuthorizationUtils(ttl_seconds=0, refresh_margin_seconds=0)
+    mock.return_value = mock_secret_response("old key")
+    await authorization_utils.check_api_key("old key")
+
+    mock.return_value = mock_secret_response("rotated key")
+    await authorization_utils.check_api_key("rotated key")
+    assert mock.call_count == 2
+
+@patch("google.cloud.secretmanager.SecretManagerServiceAsyncClient.access_secret_version")
+@pytest.mark.asyncio
+async def test_check_api_key_background_refresh(mock: AsyncMock):
+    authorization_utils = AuthorizationUtils(ttl_seconds=60, refresh_margin_seconds=60)
+    mock.return_value = mock_secret_response("old key")
+    await authorization_utils.check_api_key("old key")
+
+    # the cached key is served while the refresh runs in the background
+    mock.return_value = mock_secret_response("rotated key")
+    await authorization_utils.check_api_key("old key")
+    await asyncio.sleep(0)
+    await authorization_utils.check_api_key("rotated key")
+    assert mock.call_count >= 2
+
+@patch("google.cloud.secretmanager.SecretManagerServiceAsyncClient.access_secret_version")
+@pytest.mark.asyncio
+async def test_check_api_key_single_flight(mock: AsyncMock):
+    authorization_utils = AuthorizationUtils()
+    mock.return_value = mock_secret_response("correct key")
+
+    await asyncio.gather(*[authorization_utils.check_api_key("correct key") for _ in range(10)])
+    mock.assert_called_once_with(name=SECRET_NAME)
+
+def mock_secret_response(key: str) -> MagicMock:
+    data = bytes(key, "utf-8")
+    secret_payload = MagicMock(data = data, data_crc32c=compute_checksum(data))
+    return MagicMock(payload=secret_payload)
+
 def compute_checksum(data):
     crc32c = Checksum()
     crc32c.update(data)
-    return int(crc32c.hexdigest(), 16)
\ No newline at end of file
+    return int(crc32c.hexdigest(), 16)
+
+@patch("google.cloud.secretmanager.SecretManagerServiceAsyncClient.access_secret_version")
+@pytest.mark.asyncio
+async def test_check_api_key_multiple_keys(mock: AsyncMock):
+    authorization_utils = AuthorizationUtils()
+    mock.return_value = mock_secret_response('{"key a": {"name": "team-a", "tokens_per_minute": 120, "burst": 40}, "key b": {"name": "team-b"}}')
+
+    assert await authorization_utils.check_api_key("key a") == ApiKey("team-a", 120, 40)
+    assert await authorization_utils.check_api_key("key b") == ApiKey("team-b")
+    with pytest.raises(Unauthorized):
+        await authorization_utils.check_api_key("key c")
+    mock.assert_called_once_with(name=SECRET_NAME)
+
+@patch("google.cloud.secretmanager.SecretManagerServiceAsyncClient.access_secret_version")
+@pytest.mark.asyncio
+async def test_check_api_key_malformed_keys(mock: AsyncMock):
+    authorization_utils = AuthorizationUtils()
+    mock.return_value = mock_secret_response('{"key a": {"tokens_per_minute": 120}}')
+
+    with pytest.raises(Unauthorized):
+        await authorization_utils.check_api_key("key a")
+
+@pytest.mark.parametrize("secret", ['{"key a": {"name": "team-a", "tokens_per_minute": "120"}}',
+                                    '{"key a": {"name": "team-a", "burst": -1}}',
+                                    # every request would be rejected, as it costs at least one token
+                                    '{"key a": {"name": "team-a", "tokens_per_minute": 120, "burst": 0}}',
+                                    '{"key a": {"name": "team-a", "burst": true}}',
+                                    '{"key a": {"name": "team"}, "key b": {"name": "team"}}'])
+def test_parse_api_keys_invalid(secret: str):
+    with pytest.raises(Unauthorized):
+        parse_api_keys(secret.encode("UTF-8"))
@@ -0,0 +1,162 @@
+import os
+import sqlite3
+import time
+from unittest.mock import patch
+from CacheUtils import LruCache, SqliteCache, FileCache, BytesCache, VariantCache, track_cache_statuses, record_cache_status, cache_headers
+
+
+def test_lru_cache_evicts_least_recently_used_by_size():
+    cache = LruCache(max_bytes=10)
+    cache.set("a", "a", 4)
+    cache.set("b", "b", 4)
+    assert cache.get("a") == "a"
+    cache.set("c", "c", 4)
+    assert cache.get("b") is None
+    assert cache.get("a") == "a"
+    assert cache.get("c") == "c"
+    assert cache.size == 8
+    assert cache.evictions == 1
+    assert cache.hits == 3
+    assert cache.misses == 1
+
+def test_lru_cache_ignores_too_big_values():
+    cache = LruCache(max_bytes=10)
+    cache.set("a", "a", 11)
+    assert cache.get("a") is None
+    assert cache.size == 0
+
+@patch("time.monotonic")
+def test_lru_cache_ttl(monotonic_mock):
+    cache = LruCache(max_bytes=10)
+    monotonic_mock.return_value = 100
+    cache.set("a", "a", 1, ttl_seconds=10)
+    monotonic_mock.return_value = 109
+    assert cache.get("a") == "a"
+    monotonic_mock.return_value = 110
+    assert cache.get("a") is None
+    assert cache.size == 0
+
+def test_sqlite_cache_persists(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    SqliteCache(path).set("a", b"value", ttl_seconds=60)
+    value, expires_at = SqliteCache(path).get("a")
+    assert value == b"value"
+    assert expires_at is not None
+    assert SqliteCache(path).get("b") is None
+
+def test_sqlite_cache_ttl(tmp_path):
+    cache = SqliteCache(str(tmp_path / "cache.sqlite"))
+    cache.set("a", b"value", ttl_seconds=-1)
+    cache.set("b", b"value")
+    assert cache.get("a") is None
+    assert cache.get("b") == (b"value", None)
+
+def test_sqlite_cache_tolerates_lock_of_other_process(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = SqliteCache(path, lock_timeout_seconds=0.01)
+    cache.set("a", b"value")
+    cache._connection.close()
+    other = sqlite3.connect(path, isolation_level=None)
+    # without shared memory for the WAL index, the lock of the other process blocks reads too
+    other.execute("PRAGMA locking_mode=EXCLUSIVE")
+    other.execute("BEGIN EXCLUSIVE")
+    other.execute("INSERT INTO entries (key, value) VALUES ('b', 'value')")
+    started_at = time.monotonic()
+    # a miss and a skipped write instead of an error, connecting as another process would
+    with patch("os.getpid", return_value=-1):
+        assert cache.get("a") is None
+        cache.set("c", b"value")
+    assert time.monotonic() - started_at < 1
+    assert cache.failures == 2
+    other.execute("ROLLBACK")
+    other.close()
+    assert cache.get("a") == (b"value", None)
+    assert cache.get("c") is None
+
+def test_file_cache_evicts_least_recently_used_by_size(tmp_path):
+    cache = FileCache(str(tmp_path), max_bytes=10)
+    cache.set("a", b"aaaa")
+    cache.set("b", b"bbbb")
+    assert cache.get("a") == b"aaaa"
+    cache.set("c", b"cccc")
+    assert cache.get("b") is None
+    assert cache.get("c") == b"cccc"
+    assert sorted(os.listdir(tmp_path)) == ["a", "c"]
+    assert cache.size == 8
+    assert cache.evictions == 1
+
+def test_file_cache_persists(tmp_path):
+    FileCache(str(tmp_path), max_bytes=10).set("a", b"aaaa")
+    cache = FileCache(str(tmp_path), max_bytes=10)
+    value = cache.get("a")
+    assert isinstance(value, memoryview)
+    assert value == b"aaaa"
+    assert cache.size == 4
+
+def test_bytes_cache_tiers(tmp_path):
+    cache = BytesCache(LruCache(max_bytes=4), FileCache(str(tmp_path), max_bytes=10))
+    cache.set("a", b"aaaa")
+    cache.set("b", b"bbbb")
+    assert cache.get("b") == b"bbbb"
+    # evicted from memory, but still on disk
+    assert isinstance(cache.get("a"), memoryview)
+    assert cache.get("c") is None
+    assert cache.hits == 2
+    assert cache.misses == 1
+    assert cache.evictions == 1
+
+def test_variant_cache_round_robin():
+    cache = VariantCache(LruCache(1024), ttl_seconds=60, variants=2)
+    assert cache.get("key") is None
+    cache.put("key", "first")
+    assert cache.get("key") is None
+    cache.put("key", "second")
+    cache.put("key", "third")
+    assert [cache.get("key") for _ in range(3)] == ["first", "second", "first"]
+    assert cache.hits == 3
+    assert cache.misses == 2
+
+def test_variant_cache_persistent_tier(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    VariantCache(LruCache(1024), ttl_seconds=60, persistent=SqliteCache(path)).put("key", "poem")
+    cache = VariantCache(LruCache(1024), ttl_seconds=60, persistent=SqliteCache(path))
+    assert cache.get("key") == "poem"
+
+def test_cache_headers():
+    statuses = track_cache_statuses()
+    assert cache_headers(statuses) == {}
+    record_cache_status("poem", True)
+    assert cache_headers(statuses) == {"X-Cache": "HIT", "X-Cache-Detail": "poem=HIT"}
+    record_cache_status("audio", False)
+    assert cache_headers(statuses) == {"X-Cache": "MISS", "X-Cache-Detail": "poem=HIT, audio=MISS"}
+
+def test_sqlite_cache_reconnects_after_fork(tmp_path):
+    cache = SqliteCache(str(tmp_path / "cache.sqlite"))
+    cache.set("a", b"value")
+    connection = cache._connection
+    with patch("os.getpid", return_value=-1):
+        assert cache._connection is not connection
+        assert cache.get("a") == (b"value", None)
+
+def test_file_cache_shared_between_processes(tmp_path):
+    first = FileCache(str(tmp_path), max_bytes=10)
+    second = FileCache(str(tmp_path), max_bytes=10)
+    first.set("a", b"aaaa")
+    assert second.get("a") == b"aaaa"
+    assert second.size == 4
+    second.set("b", b"bbbb")
+    # the files of the other process are evicted once it rescanned the directory
+    with patch.object(FileCache, "_RESCAN_INTERVAL", 1):
+        first.set("c", b"cccc")
+    assert sorted(os.listdir(tmp_path)) == ["b", "c"]
+    assert first.size == 8
+
+def test_variant_cache_shared_persistent_tier(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    first = VariantCache(LruCache(1024), ttl_seconds=60, variants=2, persistent=SqliteCache(path))
+    second = VariantCache(LruCache(1024), ttl_seconds=60, variants=2, persistent=SqliteCache(path))
+    first.put("key", "first")
+    assert second.get("key") is None
+    second.put("key", "second")
+    assert first.get("key") == "first"
+    assert first.get("key") == "second"
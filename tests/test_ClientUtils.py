@@ -0,0 +1,111 @@
+import asyncio
+import threading
+import grpc
+import pytest
+from unittest.mock import patch
+from google.cloud.texttospeech import TextToSpeechAsyncClient
+from google.cloud.texttospeech_v1.services.text_to_speech.transports import TextToSpeechGrpcAsyncIOTransport
+from ClientUtils import ClientPool, channel_options
+
+
+class MockChannel:
+    def __init__(self):
+        self.state = grpc.ChannelConnectivity.IDLE
+        self.closed = False
+
+    def get_state(self, try_to_connect: bool = False) -> grpc.ChannelConnectivity:
+        if try_to_connect and self.state == grpc.ChannelConnectivity.IDLE:
+            self.state = grpc.ChannelConnectivity.CONNECTING
+        return self.state
+
+    async def close(self, grace: float | None = None) -> None:
+        self.closed = True
+        self.state = grpc.ChannelConnectivity.SHUTDOWN
+
+class MockTransport:
+    @classmethod
+    def create_channel(cls, host: str, **kwargs) -> MockChannel:
+        return MockChannel()
+
+def create_pool(size: int = 2, **kwargs) -> ClientPool:
+    clients = iter(range(100))
+    return ClientPool("test", lambda channel: (next(clients), channel(MockTransport)("localhost")), size, **kwargs)
+
+async def channels(pool: ClientPool) -> list[MockChannel]:
+    return [pooled.channel for pooled in (await pool._loop_clients()).active]
+
+@pytest.mark.asyncio
+async def test_lease_spreads_calls_over_channels():
+    pool = create_pool(max_size=3, max_streams_per_channel=2)
+    async with pool.lease() as first, pool.lease() as second:
+        assert first[0] != second[0]
+        async with pool.lease() as third, pool.lease() as fourth:
+            assert {first[0], second[0]} == {third[0], fourth[0]}
+            assert len(await channels(pool)) == 2
+            # all channels carry the maximum number of streams, so the spare client is used, which was created ahead of time
+            async with pool.lease() as fifth:
+                assert fifth[0] == 2
+                assert len(await channels(pool)) == 3
+                assert pool.created == 3
+    async with pool.lease() as client:
+        assert client[0] == 0
+
+@pytest.mark.asyncio
+async def test_lease_avoids_failing_and_replaces_shut_down_channels():
+    pool = create_pool(max_size=2)
+    first, second = await channels(pool)
+    first.state = grpc.ChannelConnectivity.TRANSIENT_FAILURE
+    async with pool.lease() as client, pool.lease() as other:
+        assert client[0] == other[0] == 1
+    second.state = grpc.ChannelConnectivity.SHUTDOWN
+    async with pool.lease() as client:
+        assert client[0] == 2
+    assert pool.replaced == 1
+    assert pool.states() == {"TRANSIENT_FAILURE": 1, "IDLE": 1}
+
+@pytest.mark.asyncio
+async def test_warm_up_and_close():
+    pool = create_pool(max_size=3)
+    await pool.warm_up()
+    # the spare client isn't connected
+    assert pool.states() == {"CONNECTING": 2}
+    pooled_channels = [pooled.channel for pooled in (await pool._loop_clients()).spare] + await channels(pool)
+    await pool.close()
+    assert all(channel.closed for channel in pooled_channels)
+    assert pool.states() == {}
+
+@pytest.mark.asyncio
+async def test_prepared_once_in_thread():
+    prepared_in = []
+    pool = ClientPool("test", lambda channel: channel(MockTransport)("localhost"), 1, max_size=2, prepare=lambda: prepared_in.append(threading.current_thread()))
+    await asyncio.gather(pool.warm_up(), pool.warm_up())
+    async with pool.lease():
+        pass
+    assert prepared_in != [] and threading.current_thread() not in prepared_in
+    assert len(prepared_in) == 1
+    # all clients are created by the first use, none by the leases
+    assert pool.created == 2
+
+def test_clients_per_event_loop():
+    pool = create_pool(size=1, max_size=1)
+
+    async def lease():
+        async with pool.lease() as client:
+            return client[0]
+
+    assert asyncio.run(lease()) == 0
+    # the channel of the previous event loop can't be used on another one
+    assert asyncio.run(lease()) == 1
+
+@pytest.mark.asyncio
+async def test_pooled_client_gets_channel_options():
+    pool = ClientPool("tts", lambda channel: TextToSpeechAsyncClient(transport=TextToSpeechGrpcAsyncIOTransport(channel=channel(TextToSpeechGrpcAsyncIOTransport))),
+                      1, max_size=1, options=channel_options(keepalive_seconds=30))
+    with patch.object(TextToSpeechGrpcAsyncIOTransport, "create_channel", wraps=TextToSpeechGrpcAsyncIOTransport.create_channel) as create_channel:
+        async with pool.lease() as client:
+            assert isinstance(client, TextToSpeechAsyncClient)
+    options = create_channel.call_args.kwargs["options"]
+    assert ("grpc.keepalive_time_ms", 30000) in options
+    assert ("grpc.use_local_subchannel_pool", 1) in options
+    assert pool.states() == {"IDLE": 1}
+    await pool.close()
@@ -0,0 +1,188 @@
+import asyncio
+import time
+import pytest
+from ConcurrencyUtils import SingleFlight, AdaptiveLimiter, MicroBatcher, Overloaded, PRIORITY_LOW, PRIORITY_HIGH, request_priority
+from RetryUtils import GatewayTimeout, request_deadline, remaining_seconds
+from google.api_core.exceptions import ResourceExhausted
+
+
+@pytest.mark.asyncio
+async def test_single_flight_coalesces_concurrent_calls():
+    single_flight = SingleFlight()
+    calls = 0
+    async def function():
+        nonlocal calls
+        calls += 1
+        call = calls
+        await asyncio.sleep(0.01)
+        return call
+
+    results = await asyncio.gather(*[single_flight.do("key", function) for _ in range(5)], single_flight.do("other key", function))
+    assert results == [1, 1, 1, 1, 1, 2]
+    assert single_flight.leaders == 2
+    assert single_flight.coalesced == 4
+    assert single_flight.in_flight == 0
+
+    # a finished call isn't shared with later calls
+    assert await single_flight.do("key", function) == 3
+
+@pytest.mark.asyncio
+async def test_single_flight_propagates_errors():
+    single_flight = SingleFlight()
+    async def function():
+        await asyncio.sleep(0.01)
+        raise ValueError("failed")
+
+    results = await asyncio.gather(*[single_flight.do("key", function) for _ in range(3)], return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert single_flight.leaders == 1
+
+@pytest.mark.asyncio
+async def test_single_flight_survives_cancelled_callers():
+    single_flight = SingleFlight()
+    async def function():
+        await asyncio.sleep(0.01)
+        return "result"
+
+    leader = asyncio.ensure_future(single_flight.do("key", function))
+    follower = asyncio.ensure_future(single_flight.do("key", function))
+    await asyncio.sleep(0)
+    leader.cancel()
+    assert await follower == "result"
+    assert leader.cancelled()
+
+@pytest.mark.asyncio
+async def test_single_flight_deadline_per_caller():
+    single_flight = SingleFlight()
+    contexts = []
+    async def function():
+        await asyncio.sleep(0.1)
+        contexts.append((remaining_seconds(), request_priority.get()))
+        return "result"
+
+    async def call(timeout_seconds: float, priority: int):
+        request_deadline.set(time.monotonic() + timeout_seconds)
+        request_priority.set(priority)
+        return await single_flight.do("key", function)
+
+    leader = asyncio.ensure_future(call(0.05, PRIORITY_LOW))
+    await asyncio.sleep(0)
+    follower = asyncio.ensure_future(call(10, PRIORITY_HIGH))
+    # the short deadline of the leader doesn't apply to the follower
+    with pytest.raises(GatewayTimeout):
+        await leader
+    assert await follower == "result"
+    [(remaining, priority)] = contexts
+    assert remaining > 10
+    assert priority == PRIORITY_HIGH
+
+
+@pytest.mark.asyncio
+async def test_adaptive_limiter_limits_concurrency():
+    limiter = AdaptiveLimiter("upstream", initial_limit=2, max_limit=2, latency_target_seconds=1, queue_size=10, queue_timeout_seconds=1)
+    running = 0
+    max_running = 0
+    async def call():
+        nonlocal running, max_running
+        async with limiter.acquire():
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+    await asyncio.gather(*[call() for _ in range(6)])
+    assert max_running == 2
+    assert limiter.accepted == 6
+    assert limiter.in_flight == 0
+    assert limiter.queued == 0
+
+@pytest.mark.asyncio
+async def test_adaptive_limiter_adapts_limit():
+    limiter = AdaptiveLimiter("upstream", initial_limit=4, max_limit=8, latency_target_seconds=1, queue_size=10, queue_timeout_seconds=1)
+    async with limiter.acquire():
+        pass
+    async def saturate():
+        async with limiter.acquire():
+            await asyncio.sleep(0)
+    await asyncio.gather(*[saturate() for _ in range(8)])
+    assert limiter.limit == 5
+
+    with pytest.raises(ResourceExhausted):
+        async with limiter.acquire():
+            raise ResourceExhausted("quota exceeded")
+    assert limiter.limit == 4
+
+@pytest.mark.asyncio
+async def test_adaptive_limiter_sheds_low_priority_calls():
+    limiter = AdaptiveLimiter("upstream", initial_limit=1, max_limit=1, latency_target_seconds=1, queue_size=1, queue_timeout_seconds=1)
+    release = asyncio.Event()
+    async def call(priority):
+        async with limiter.acquire(priority):
+            await release.wait()
+        return priority
+
+    running = asyncio.ensure_future(call(PRIORITY_LOW))
+    await asyncio.sleep(0)
+    low = asyncio.ensure_future(call(PRIORITY_LOW))
+    await asyncio.sleep(0)
+    # the queue is full, the new low priority call is rejected
+    with pytest.raises(Overloaded) as overloaded:
+        await call(PRIORITY_LOW)
+    assert int(overloaded.value.headers["Retry-After"]) >= 1
+    # the high priority call displaces the waiting low priority call
+    high = asyncio.ensure_future(call(PRIORITY_HIGH))
+    await asyncio.sleep(0)
+    with pytest.raises(Overloaded):
+        await low
+    release.set()
+    assert await running == PRIORITY_LOW
+    assert await high == PRIORITY_HIGH
+    assert limiter.rejected == 2
+
+@pytest.mark.asyncio
+async def test_adaptive_limiter_queue_timeout():
+    limiter = AdaptiveLimiter("upstream", initial_limit=1, max_limit=1, latency_target_seconds=1, queue_size=1, queue_timeout_seconds=0.01)
+    async with limiter.acquire():
+        with pytest.raises(Overloaded):
+            async with limiter.acquire():
+                pass
+    assert limiter.queued == 0
+    async with limiter.acquire():
+        pass
+
+@pytest.mark.asyncio
+async def test_micro_batcher_batches_concurrent_calls():
+    batches = []
+    async def function(items):
+        batches.append(items)
+        return [ValueError(item) if item < 0 else item * 2 for item in items]
+    batcher = MicroBatcher(function, window_seconds=0.01, max_size=3)
+
+    results = await asyncio.gather(*[batcher.submit(item) for item in [1, 2, -3, 4]], return_exceptions=True)
+    assert results[:2] == [2, 4]
+    assert isinstance(results[2], ValueError)
+    assert results[3] == 8
+    # the first batch is full, the second one is processed after the window
+    assert batches == [[1, 2, -3], [4]]
+    assert batcher.batches == 2
+    assert batcher.items == 4
+
+@pytest.mark.asyncio
+async def test_micro_batcher_propagates_errors_and_survives_cancelled_callers():
+    async def failing(items):
+        raise ValueError("failed")
+    with pytest.raises(ValueError):
+        await MicroBatcher(failing, window_seconds=0, max_size=2).submit(1)
+
+    processed = asyncio.Event()
+    async def function(items):
+        await asyncio.sleep(0.01)
+        processed.set()
+        return items
+    batcher = MicroBatcher(function, window_seconds=0, max_size=2)
+    cancelled = asyncio.ensure_future(batcher.submit(1))
+    survivor = asyncio.ensure_future(batcher.submit(2))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    assert await survivor == 2
+    assert processed.is_set()
@@ -0,0 +1,75 @@
+import json
+import logging
+import pytest
+from LoggingUtils import configure_logging, _stop_listener, JsonFormatter, RequestContextMiddleware, _ContextQueueHandler, log_payload, request_id, payload_sampled
+
+class Payload:
+    formatted = 0
+
+    def __str__(self):
+        Payload.formatted += 1
+        return "payload"
+
+def test_json_formatter_includes_request_fields():
+    handler = _ContextQueueHandler(None)
+    request_id.set("abc")
+    record = logging.LogRecord("PoemUtils", logging.INFO, "", 0, "generated %d poems", (2,), None)
+    record.status = 200
+    line = JsonFormatter().format(handler.prepare(record))
+    entry = json.loads(line)
+    assert entry["message"] == "generated 2 poems"
+    assert entry["severity"] == "INFO"
+    assert entry["logger"] == "PoemUtils"
+    assert entry["request_id"] == "abc"
+    assert entry["status"] == 200
+
+def test_queue_handler_leaves_formatting_to_listener():
+    Payload.formatted = 0
+    record = logging.LogRecord("PoemUtils", logging.DEBUG, "", 0, "response: %s", (Payload(),), None)
+    prepared = _ContextQueueHandler(None).prepare(record)
+    assert Payload.formatted == 0
+    assert prepared.getMessage() == "response: payload"
+
+def test_log_payload_only_if_sampled_and_enabled(caplog):
+    logger = logging.getLogger("test_log_payload")
+    Payload.formatted = 0
+    with caplog.at_level(logging.INFO, logger="test_log_payload"):
+        log_payload(logger, "response: %s", Payload())
+    with caplog.at_level(logging.DEBUG, logger="test_log_payload"):
+        payload_sampled.set(False)
+        log_payload(logger, "response: %s", Payload())
+        assert Payload.formatted == 0
+        payload_sampled.set(True)
+        log_payload(logger, "response: %s", Payload())
+    assert [record.getMessage() for record in caplog.records] == ["response: payload"]
+
+@pytest.mark.asyncio
+async def test_middleware_sets_request_id(caplog):
+    ids = []
+    sampled = []
+    async def app(scope, receive, send):
+        ids.append(request_id.get())
+        sampled.append(payload_sampled.get())
+        await send({"type": "http.response.start", "status": 204, "headers": []})
+    messages = []
+    async def send(message):
+        messages.append(message)
+    middleware = RequestContextMiddleware(app, payload_sample_rate=0)
+
+    with caplog.at_level(logging.INFO, logger="LoggingUtils"):
+        await middleware({"type": "http", "method": "GET", "path": "/print_poem", "headers": [(b"x-request-id", b"given")]}, None, send)
+        await middleware({"type": "http", "method": "GET", "path": "/print_poem", "headers": [(b"x-cloud-trace-context", b"trace/1;o=1")]}, None, send)
+        await middleware({"type": "http", "method": "GET", "path": "/print_poem", "headers": []}, None, send)
+    assert ids[:2] == ["given", "trace"]
+    assert len(ids[2]) == 32
+    assert messages[0]["headers"] == [(b"x-request-id", b"given")]
+    assert caplog.records[0].getMessage() == "GET /print_poem 204"
+    assert sampled == [False, False, False]
+
+def test_configure_logging_repeatedly_stops_at_exit_once():
+    configure_logging()
+    configure_logging()
+    # as called at exit, after the previous listener was replaced
+    _stop_listener()
+    _stop_listener()
+    configure_logging()
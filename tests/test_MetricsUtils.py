@@ -0,0 +1,79 @@
+import asyncio
+import pytest
+from MetricsUtils import Metric, Counter, Gauge, Histogram, CallbackMetric, Registry, MetricsMiddleware, STAGE_DURATION, STAGE_ERRORS, STAGE_IN_FLIGHT, REQUEST_DURATION, stage
+
+def test_render_prometheus_text_format():
+    registry = Registry()
+    counter = registry.register(Counter("errors", "The errors", ["reason"]))
+    gauge = registry.register(Gauge("in_flight", "The calls in flight"))
+    histogram = registry.register(Histogram("latency_seconds", "The latency", buckets=(0.1, 1)))
+    registry.register(CallbackMetric("hits", "The hits", "counter", ["cache"], lambda: {("poem",): 3}))
+    counter.inc(reason='SAFETY "x"')
+    counter.inc(2, reason='SAFETY "x"')
+    gauge.inc()
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert registry.render() == "\n".join([
+        "# HELP errors The errors",
+        "# TYPE errors counter",
+        'errors_total{reason="SAFETY \\"x\\""} 3',
+        "# HELP in_flight The calls in flight",
+        "# TYPE in_flight gauge",
+        "in_flight 1",
+        "# HELP latency_seconds The latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        "latency_seconds_sum 5.55",
+        "latency_seconds_count 3",
+        "# HELP hits The hits",
+        "# TYPE hits counter",
+        'hits_total{cache="poem"} 3',
+    ]) + "\n"
+
+def test_labels_are_checked():
+    with pytest.raises(ValueError):
+        Counter("errors", "The errors", ["reason"]).inc(stage="gemini")
+
+def test_metric_without_samples_cant_be_created():
+    class Incomplete(Metric):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete("incomplete", "Forgets its samples")
+
+def test_failing_callback_is_skipped():
+    registry = Registry()
+    registry.register(CallbackMetric("hits", "The hits", "counter", ["cache"], lambda: 1 / 0))
+    registry.register(Gauge("in_flight", "The calls in flight"))
+    assert registry.render() == "# HELP in_flight The calls in flight\n# TYPE in_flight gauge\n"
+
+@pytest.mark.asyncio
+async def test_stage_times_and_counts_errors():
+    count = STAGE_DURATION.count(stage="test")
+    with stage("test"):
+        assert STAGE_IN_FLIGHT.value(stage="test") == 1
+        await asyncio.sleep(0)
+    with pytest.raises(KeyError):
+        with stage("test"):
+            raise KeyError()
+    assert STAGE_IN_FLIGHT.value(stage="test") == 0
+    assert STAGE_DURATION.count(stage="test") == count + 2
+    assert STAGE_ERRORS.value(stage="test", error="KeyError") == 1
+
+@pytest.mark.asyncio
+async def test_middleware_labels_unknown_paths_as_other():
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 404 if scope["path"] == "/unknown" else 200, "headers": []})
+    async def send(message):
+        pass
+    count = REQUEST_DURATION.count(path="other", status="404")
+    middleware = MetricsMiddleware(app)
+
+    await middleware({"type": "http", "method": "GET", "path": "/unknown", "headers": []}, None, send)
+    await middleware({"type": "http", "method": "GET", "path": "/metrics", "headers": []}, None, send)
+    assert REQUEST_DURATION.count(path="other", status="404") == count + 1
+    assert REQUEST_DURATION.count(path="/metrics", status="200") >= 1
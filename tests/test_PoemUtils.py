@@ -1,8 +1,19 @@
 from unittest.mock import AsyncMock, patch, MagicMock
 from PoemUtils import PoemUtils
+from ConcurrencyUtils import MicroBatcher
+from CacheUtils import LruCache, VariantCache
+from RetryUtils import RetryPolicy, GatewayTimeout, request_deadline
+from MetricsUtils import UPSTREAM_ERRORS
 from connexion.exceptions import InternalServerError
 from constants import PROJECT_ID, GENERATIVE_MODEL_LOCATION
 import google.cloud.aiplatform_v1beta1.types.content as types
+from google.cloud.aiplatform_v1beta1.types.prediction_service import GenerateContentResponse
+from vertexai import init as init_vertexai
+from vertexai.preview.generative_models import GenerativeModel
+import asyncio
+import functools
+import inspect
+import time
 import pytest
 
 
@@ -48,8 +59,196 @@ async def test_generate_poem_wrong_finish_reason(generate_content_mock: AsyncMoc
     poem_utils = PoemUtils()
     generate_content_mock.assert_not_called()
 
+    safety_errors = UPSTREAM_ERRORS.value(upstream="gemini", reason="SAFETY")
     candidate = MagicMock(text = POEM, finish_reason = types.Candidate.FinishReason.SAFETY)
     generate_content_mock.return_value  = MagicMock(candidates = [candidate])
     with pytest.raises(InternalServerError):
         await poem_utils.generate_poem("en", "12", "flowers")
+    assert UPSTREAM_ERRORS.value(upstream="gemini", reason="SAFETY") == safety_errors + 1
     generate_content_mock.assert_called_once_with("Generate a poem about 'flowers' that rhymes in the language represented by the IETF language tag 'en' with the maximum length of 12 lines.")
+
+@patch("vertexai.init")
+@patch("vertexai.preview.generative_models.GenerativeModel.generate_content_async")
+@pytest.mark.asyncio
+async def test_generate_poem_cached(generate_content_mock: AsyncMock, _: MagicMock):
+    poem_utils = PoemUtils(cache=VariantCache(LruCache(1024), ttl_seconds=60))
+
+    candidate = MagicMock(text = POEM, finish_reason = types.Candidate.FinishReason.STOP)
+    generate_content_mock.return_value  = MagicMock(candidates = [candidate])
+
+    assert await poem_utils.generate_poem("en", "12", "flowers") == POEM
+    assert await poem_utils.generate_poem("en", "12", "Flowers") == POEM
+    generate_content_mock.assert_called_once()
+
+    await poem_utils.generate_poem("en", "12", "trees")
+    assert generate_content_mock.call_count == 2
+
+@patch("vertexai.init")
+@patch("vertexai.preview.generative_models.GenerativeModel.generate_content_async")
+@pytest.mark.asyncio
+async def test_generate_poem_fresh(generate_content_mock: AsyncMock, _: MagicMock):
+    poem_utils = PoemUtils(cache=VariantCache(LruCache(1024), ttl_seconds=60))
+
+    candidate = MagicMock(text = POEM, finish_reason = types.Candidate.FinishReason.STOP)
+    generate_content_mock.return_value  = MagicMock(candidates = [candidate])
+
+    assert await poem_utils.generate_poem("en", "12", "flowers", fresh=True) == POEM
+    await poem_utils.generate_poem("en", "12", "flowers")
+    await poem_utils.generate_poem("en", "12", "flowers", fresh=True)
+    # neither cached nor served from the cache
+    assert generate_content_mock.call_count == 3
+    assert poem_utils.cache.hits == 0
+
+@patch("vertexai.init")
+@patch("vertexai.preview.generative_models.GenerativeModel.generate_content_async")
+@pytest.mark.asyncio
+async def test_stream_stanzas_ok(generate_content_mock: AsyncMock, _: MagicMock):
+    poem_utils = PoemUtils()
+    generate_content_mock.return_value = mock_stream(["Line 1\nLi", "ne 2\n\nLine 3\nLine 4\nLine 5", "\nLine 6\n"])
+
+    stanzas = [stanza async for stanza in poem_utils.stream_stanzas("en", "12", "flowers", max_lines=2)]
+    generate_content_mock.assert_called_once_with("Generate a poem about 'flowers' that rhymes in the language represented by the IETF language tag 'en' with the maximum length of 12 lines.", stream=True)
+    assert stanzas == ["Line 1\nLine 2", "Line 3\nLine 4", "Line 5\nLine 6"]
+
+@patch("vertexai.init")
+@patch("vertexai.preview.generative_models.GenerativeModel.generate_content_async")
+@pytest.mark.asyncio
+async def test_stream_poem_wrong_finish_reason(generate_content_mock: AsyncMock, _: MagicMock):
+    poem_utils = PoemUtils()
+    generate_content_mock.return_value = mock_stream(["Line 1\n", "Line 2"], types.Candidate.FinishReason.SAFETY)
+
+    chunks = []
+    with pytest.raises(InternalServerError):
+        async for chunk in poem_utils.stream_poem("en", "12", "flowers"):
+            chunks.append(chunk)
+    assert chunks == ["Line 1\n"]
+
+@patch("vertexai.init")
+@patch("vertexai.preview.generative_models.GenerativeModel.generate_content_async")
+@pytest.mark.asyncio
+async def test_stream_poem_deadline_exceeded_by_consumer(generate_content_mock: AsyncMock, _: MagicMock):
+    poem_utils = PoemUtils()
+    generate_content_mock.return_value = mock_stream(["Line 1\n", "Line 2"])
+    # the clients are created before, so that only the consumer exceeds the deadline
+    await poem_utils.preload_model()
+    request_deadline.set(time.monotonic() + 0.05)
+
+    chunks = []
+    with pytest.raises(GatewayTimeout):
+        async for chunk in poem_utils.stream_poem("en", "12", "flowers"):
+            chunks.append(chunk)
+            # e.g. sending the chunk to a slow client, which mustn't be cancelled by the deadline
+            await asyncio.sleep(0.1)
+    assert chunks == ["Line 1\n"]
+    assert asyncio.current_task().cancelling() == 0
+
+@patch("vertexai.init")
+@patch("vertexai.preview.generative_models.GenerativeModel.generate_content_async")
+@pytest.mark.asyncio
+async def test_stream_poem_cached(generate_content_mock: AsyncMock, _: MagicMock):
+    poem_utils = PoemUtils(cache=VariantCache(LruCache(1024), ttl_seconds=60))
+    generate_content_mock.return_value = mock_stream(["Line 1\n", "Line 2"])
+
+    assert [chunk async for chunk in poem_utils.stream_poem("en", "12", "flowers")] == ["Line 1\n", "Line 2"]
+    assert [chunk async for chunk in poem_utils.stream_poem("en", "12", "flowers")] == ["Line 1\nLine 2"]
+    generate_content_mock.assert_called_once()
+
+@patch("vertexai.init")
+@patch("vertexai.preview.generative_models.GenerativeModel.generate_content_async")
+@pytest.mark.asyncio
+async def test_generate_poem_coalesced(generate_content_mock: AsyncMock, _: MagicMock):
+    poem_utils = PoemUtils(cache=VariantCache(LruCache(1024), ttl_seconds=60, variants=2))
+    async def generate_content(prompt):
+        await asyncio.sleep(0.01)
+        return MagicMock(candidates = [MagicMock(text = POEM, finish_reason = types.Candidate.FinishReason.STOP)])
+    generate_content_mock.side_effect = generate_content
+
+    results = await asyncio.gather(*[poem_utils.generate_poem("en", "12", "flowers") for _ in range(5)])
+    assert results == [POEM] * 5
+    generate_content_mock.assert_called_once()
+    assert poem_utils.single_flight.leaders == 1
+    assert poem_utils.single_flight.coalesced == 4
+    # the coalesced requests didn't fill up the variants
+    await poem_utils.generate_poem("en", "12", "flowers")
+    assert generate_content_mock.call_count == 2
+
+@patch("vertexai.init")
+@patch("vertexai.preview.generative_models.GenerativeModel.generate_content_async")
+@pytest.mark.asyncio
+async def test_generate_poem_retried(generate_content_mock: AsyncMock, _: MagicMock):
+    poem_utils = PoemUtils(retry_policy=RetryPolicy(max_attempts=3, base_delay_seconds=0, max_delay_seconds=0))
+
+    failed = MagicMock(candidates = [MagicMock(text = POEM, finish_reason = types.Candidate.FinishReason.OTHER)])
+    succeeded = MagicMock(candidates = [MagicMock(text = POEM, finish_reason = types.Candidate.FinishReason.STOP)])
+    generate_content_mock.side_effect = [failed, failed, succeeded]
+    assert await poem_utils.generate_poem("en", "12", "flowers") == POEM
+    assert generate_content_mock.call_count == 3
+
+    generate_content_mock.side_effect = [failed, failed, failed]
+    with pytest.raises(InternalServerError):
+        await poem_utils.generate_poem("en", "12", "flowers")
+    assert generate_content_mock.call_count == 6
+
+@patch("vertexai.init")
+@patch("vertexai.preview.generative_models.GenerativeModel.generate_content_async")
+@pytest.mark.asyncio
+async def test_generate_poem_batched(generate_content_mock: AsyncMock, _: MagicMock):
+    poem_utils = PoemUtils()
+    poem_utils.batcher = MicroBatcher(poem_utils._generate_batch, window_seconds=0.01, max_size=8)
+    prompts = []
+    async def generate(prompt):
+        prompts.append(prompt)
+        return MagicMock(candidates = [MagicMock(text = '```json\n["Poem about roses.", "Poem about tulips."]\n```', finish_reason = types.Candidate.FinishReason.STOP)])
+    generate_content_mock.side_effect = generate
+
+    poems = await asyncio.gather(poem_utils.generate_poem("en", 12, "roses"), poem_utils.generate_poem("de", 4, "tulips"))
+    assert poems == ["Poem about roses.", "Poem about tulips."]
+    assert len(prompts) == 1
+    assert "1. Generate a poem about 'roses'" in prompts[0] and "2. Generate a poem about 'tulips'" in prompts[0]
+    assert poem_utils.batched_prompts == 2
+
+@patch("vertexai.init")
+@patch("vertexai.preview.generative_models.GenerativeModel.generate_content_async")
+@pytest.mark.asyncio
+async def test_generate_poem_batch_fallback(generate_content_mock: AsyncMock, _: MagicMock):
+    poem_utils = PoemUtils()
+    poem_utils.batcher = MicroBatcher(poem_utils._generate_batch, window_seconds=0.01, max_size=8)
+    async def generate(prompt):
+        if prompt.startswith("Fulfill"):
+            return MagicMock(candidates = [MagicMock(text = '["Only one poem."]', finish_reason = types.Candidate.FinishReason.STOP)])
+        return MagicMock(candidates = [MagicMock(text = prompt, finish_reason = types.Candidate.FinishReason.STOP)])
+    generate_content_mock.side_effect = generate
+
+    poems = await asyncio.gather(poem_utils.generate_poem("en", 12, "roses"), poem_utils.generate_poem("de", 4, "tulips"))
+    assert "'roses'" in poems[0] and "'tulips'" in poems[1]
+    assert generate_content_mock.call_count == 3
+    assert poem_utils.batch_fallbacks == 2
+
+@patch("vertexai.init")
+@patch("google.cloud.aiplatform_v1beta1.services.prediction_service.PredictionServiceAsyncClient.generate_content", autospec=True)
+@pytest.mark.asyncio
+async def test_generative_model_uses_pooled_channel(generate_content_mock: AsyncMock, _: MagicMock):
+    # vertexai offers no way to pass a channel or a transport, so the models rely on the private attribute their prediction client is cached in
+    from google.cloud.aiplatform import initializer
+    for function in (init_vertexai, GenerativeModel.__init__, initializer.global_config.create_client):
+        assert not {"channel", "transport"} & set(inspect.signature(function).parameters)
+    assert isinstance(inspect.getattr_static(GenerativeModel, "_prediction_async_client"), functools.cached_property)
+    poem_utils = PoemUtils()
+    generate_content_mock.return_value = GenerateContentResponse(candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=POEM)]),
+                                                                                             finish_reason=types.Candidate.FinishReason.STOP)])
+
+    assert await poem_utils.generate_poem("en", 12, "roses") == POEM
+    async with poem_utils.models.lease() as model:
+        client = model._prediction_async_client
+    # called on the client of the pool, whose channel is pooled
+    assert generate_content_mock.call_args.args[0] is client
+    assert client.transport.grpc_channel is (await poem_utils.models._loop_clients()).active[0].channel
+    await poem_utils.models.close()
+
+def mock_stream(texts: list[str], finish_reason = types.Candidate.FinishReason.STOP):
+    async def stream():
+        for index, text in enumerate(texts):
+            last = index == len(texts) - 1
+            candidate = MagicMock(text = text, finish_reason = finish_reason if last else types.Candidate.FinishReason.FINISH_REASON_UNSPECIFIED)
+            yield MagicMock(candidates = [candidate])
+    return stream()
@@ -0,0 +1,101 @@
+import asyncio
+import time
+import pytest
+from unittest.mock import patch
+from PoemUtils import PoemUtils
+from TtsUtils import TtsUtils, AudioFormat
+from PoolUtils import PoemPool
+from ConcurrencyUtils import request_priority, PRIORITY_BACKGROUND
+
+
+class MockPoemUtils(PoemUtils):
+    def __init__(self):
+        super().__init__()
+        self.generations = 0
+        self.priorities = []
+
+    async def generate_poem(self, language: str, max_length: int, topic: str | None, fresh: bool = False) -> str:
+        assert fresh
+        self.generations += 1
+        self.priorities.append(request_priority.get())
+        return f"poem {self.generations} about {topic}"
+
+class MockTtsUtils(TtsUtils):
+    async def synthesize(self, text: str, language: str, gender: str, audio_format: AudioFormat = AudioFormat()) -> bytes:
+        return bytes(f"{text} as {audio_format.encoding}", "utf-8")
+
+def create_pool(**kwargs) -> PoemPool:
+    arguments = dict(top_keys=1, size=2, min_requests=1.5, half_life_seconds=600, generations_per_hour=3600 * 1000, concurrency=4, max_age_seconds=60, audio_enabled=True)
+    arguments.update(kwargs)
+    return PoemPool(MockPoemUtils(), MockTtsUtils(), **arguments)
+
+@pytest.mark.asyncio
+async def test_pool_serves_popular_keys_once():
+    pool = create_pool()
+    assert pool.take_poem("en", 12, "roses") is None
+    pool.take_poem("en", 12, "tulips")
+    await asyncio.sleep(0.01)
+    # not requested often enough yet
+    assert await pool.refill() == 0
+    assert pool.take_poem("en", 12, "roses") is None
+    assert await pool.refill() == 2
+    assert pool._poem_utils.priorities == [PRIORITY_BACKGROUND] * 2
+    assert pool.entries == 2
+    assert [pool.take_poem("en", 12, "roses") for _ in range(3)] == ["poem 1 about roses", "poem 2 about roses", None]
+    assert pool.take_poem("en", 12, "tulips") is None
+    assert pool.hits == 2
+    assert pool.misses == 5
+
+@pytest.mark.asyncio
+async def test_pool_audio():
+    pool = create_pool(size=1)
+    audio_format = AudioFormat("ogg_opus")
+    for _ in range(2):
+        assert pool.take_audio("en", 12, "roses", "female", audio_format) is None
+    await asyncio.sleep(0.01)
+    assert await pool.refill() == 1
+    assert pool.take_audio("en", 12, "roses", "female", AudioFormat("mp3")) is None
+    assert pool.take_audio("en", 12, "roses", "female", audio_format) == ("poem 1 about roses", b"poem 1 about roses as ogg_opus")
+    assert create_pool(audio_enabled=False).take_audio("en", 12, "roses", "female", audio_format) is None
+
+@pytest.mark.asyncio
+async def test_pool_discards_expired_poems():
+    pool = create_pool(size=1)
+    for _ in range(2):
+        pool.take_poem("en", 12, "roses")
+    await asyncio.sleep(0.01)
+    await pool.refill()
+    with patch("time.monotonic", return_value=time.monotonic() + 61):
+        assert pool.take_poem("en", 12, "roses") is None
+    assert pool.expired == 1
+
+@pytest.mark.asyncio
+async def test_pool_respects_budget_and_load():
+    pool = create_pool(generations_per_hour=0)
+    for _ in range(2):
+        pool.take_poem("en", 12, "roses")
+    await asyncio.sleep(0.01)
+    assert await pool.refill() == 0
+
+    pool = create_pool()
+    for _ in range(2):
+        pool.take_poem("en", 12, "roses")
+    await asyncio.sleep(0.01)
+    async with pool._poem_utils.limiter.acquire():
+        pool._poem_utils.limiter._in_flight = pool._poem_utils.limiter.limit
+        assert await pool.refill() == 0
+        pool._poem_utils.limiter._in_flight = 1
+    assert await pool.refill() == 2
+
+def test_popularity_decays():
+    pool = create_pool(top_keys=2, half_life_seconds=10)
+    now = time.monotonic()
+    with patch("time.monotonic", return_value=now):
+        for _ in range(4):
+            pool.take_poem("en", 12, "roses")
+    with patch("time.monotonic", return_value=now + 10):
+        for _ in range(4):
+            pool.take_poem("en", 12, "tulips")
+        assert [key.topic for key in pool.popular_keys()] == ["tulips", "roses"]
+    with patch("time.monotonic", return_value=now + 20):
+        assert [key.topic for key in pool.popular_keys()] == ["tulips"]
@@ -0,0 +1,64 @@
+import sqlite3
+import time
+import pytest
+from unittest.mock import patch
+from AuthorizationUtils import ApiKey
+from RateLimitUtils import RateLimiter, RateLimited, CostExceedsBurst, MemoryBucketStore, SqliteBucketStore
+
+
+def test_bucket_refills_at_rate():
+    store = MemoryBucketStore()
+    now = time.monotonic()
+    with patch("time.monotonic", return_value=now):
+        assert store.take("key", 2, tokens_per_second=1, burst=3) == (True, 1)
+        assert store.take("key", 2, tokens_per_second=1, burst=3) == (False, 1)
+        assert store.take("other", 3, tokens_per_second=1, burst=3) == (True, 0)
+    with patch("time.monotonic", return_value=now + 1.5):
+        assert store.take("key", 2, tokens_per_second=1, burst=3) == (True, 0.5)
+    with patch("time.monotonic", return_value=now + 100):
+        # refilled up to the burst only
+        assert store.take("key", 0, tokens_per_second=1, burst=3) == (True, 3)
+
+def test_sqlite_buckets_are_shared(tmp_path):
+    path = str(tmp_path / "rate_limits.sqlite3")
+    store = SqliteBucketStore(path)
+    assert store.take("key", 2, tokens_per_second=0.001, burst=3)[0]
+    # e.g. another worker
+    other_store = SqliteBucketStore(path)
+    taken, tokens = other_store.take("key", 2, tokens_per_second=0.001, burst=3)
+    assert not taken
+    assert tokens == pytest.approx(1, abs=0.01)
+
+def test_sqlite_lock_timeout_falls_back_to_process_bucket(tmp_path):
+    path = str(tmp_path / "rate_limits.sqlite3")
+    store = SqliteBucketStore(path, lock_timeout_seconds=0.01)
+    # e.g. another worker holding the lock
+    other_connection = sqlite3.connect(path, isolation_level=None)
+    other_connection.execute("BEGIN IMMEDIATE")
+    started_at = time.monotonic()
+    assert store.take("key", 2, tokens_per_second=0.001, burst=3) == (True, 1)
+    assert time.monotonic() - started_at < 1
+    assert store.lock_timeouts == 1
+    other_connection.execute("COMMIT")
+    # the database is used again once the lock is released
+    assert store.take("key", 2, tokens_per_second=0.001, burst=3)[1] == pytest.approx(1, abs=0.01)
+    assert store.lock_timeouts == 1
+
+def test_rate_limiter_uses_limits_of_key():
+    rate_limiter = RateLimiter(MemoryBucketStore(), tokens_per_minute=60, burst=2)
+    headers = rate_limiter.take(ApiKey("default"), 1)
+    assert headers == {"RateLimit-Limit": "2", "RateLimit-Remaining": "1", "RateLimit-Reset": "1"}
+    rate_limiter.take(ApiKey("default"), 1)
+    with pytest.raises(RateLimited) as exception_info:
+        rate_limiter.take(ApiKey("default"), 1)
+    assert exception_info.value.status == 429
+    assert exception_info.value.headers["Retry-After"] == "1"
+    # a key with its own limits
+    assert rate_limiter.take(ApiKey("team", tokens_per_minute=6, burst=10), 10)["RateLimit-Reset"] == "100"
+    # a cost exceeding the burst is never accepted, rather than taking only the whole bucket
+    with pytest.raises(CostExceedsBurst) as exception_info:
+        rate_limiter.take(ApiKey("team", tokens_per_minute=6, burst=10), 4000)
+    assert exception_info.value.status == 413
+    assert rate_limiter.take(ApiKey("internal", tokens_per_minute=0), 100) == {}
+    assert rate_limiter.accepted == 3
+    assert rate_limiter.rejected == 2
@@ -0,0 +1,53 @@
+from ResponseUtils import content_response, etag, negotiate, not_modified
+
+CONTENT = memoryview(b"0123456789")
+ETAG = etag("0123456789abcdef")
+
+def test_full_content():
+    response = content_response(CONTENT, "audio/mpeg", {}, {"X-Cache": "HIT"}, 60, ETAG)
+    assert response.status_code == 200
+    assert response.body is CONTENT
+    assert response.headers["etag"] == '"0123456789abcdef"'
+    assert response.headers["content-length"] == "10"
+    assert response.headers["cache-control"] == "private, max-age=60"
+    assert response.headers["x-cache"] == "HIT"
+
+def test_if_none_match():
+    assert content_response(CONTENT, "audio/mpeg", {"if-none-match": f'"other", W/{ETAG}'}, {}, 60, ETAG).status_code == 304
+    assert content_response(CONTENT, "audio/mpeg", {"if-none-match": "*"}, {}, 60, ETAG).status_code == 304
+    assert content_response(CONTENT, "audio/mpeg", {"if-none-match": '"other"'}, {}, 60, ETAG).status_code == 200
+    response = not_modified({"if-none-match": ETAG}, ETAG, {"X-Cache": "HIT"}, 60)
+    assert response.status_code == 304
+    assert response.headers["etag"] == ETAG
+    assert response.headers["x-cache"] == "HIT"
+    assert not_modified({}, ETAG, {}, 60) is None
+
+def test_ranges():
+    for header, body, content_range in [("bytes=2-4", b"234", "bytes 2-4/10"), ("bytes=7-", b"789", "bytes 7-9/10"),
+                                        ("bytes=-3", b"789", "bytes 7-9/10"), ("bytes=8-100", b"89", "bytes 8-9/10")]:
+        response = content_response(CONTENT, "audio/mpeg", {"range": header}, {}, 60, ETAG)
+        assert response.status_code == 206
+        assert isinstance(response.body, memoryview)
+        assert response.body == body
+        assert response.headers["content-range"] == content_range
+        assert response.headers["content-length"] == str(len(body))
+
+def test_unsatisfiable_and_unsupported_ranges():
+    response = content_response(CONTENT, "audio/mpeg", {"range": "bytes=10-"}, {}, 60, ETAG)
+    assert response.status_code == 416
+    assert response.headers["content-range"] == "bytes */10"
+    # multiple ranges aren't supported, so the whole content is sent
+    assert content_response(CONTENT, "audio/mpeg", {"range": "bytes=0-1,4-5"}, {}, 60, ETAG).status_code == 200
+
+def test_if_range():
+    assert content_response(CONTENT, "audio/mpeg", {"range": "bytes=0-1", "if-range": ETAG}, {}, 60, ETAG).status_code == 206
+    assert content_response(CONTENT, "audio/mpeg", {"range": "bytes=0-1", "if-range": '"other"'}, {}, 60, ETAG).status_code == 200
+
+def test_negotiate():
+    media_types = ["audio/mpeg", "audio/ogg", "audio/wav"]
+    assert negotiate(None, media_types) == "audio/mpeg"
+    assert negotiate("*/*", media_types) == "audio/mpeg"
+    assert negotiate("audio/ogg; codecs=opus", media_types) == "audio/ogg"
+    assert negotiate("audio/*;q=0.5, audio/wav", media_types) == "audio/wav"
+    assert negotiate("audio/*, audio/mpeg;q=0", media_types) == "audio/ogg"
+    assert negotiate("text/plain", media_types) is None
@@ -0,0 +1,142 @@
+import asyncio
+import time
+import pytest
+from google.api_core.exceptions import ServiceUnavailable
+from RetryUtils import RetryPolicy, Hedger, GatewayTimeout, DeadlineMiddleware, TRANSIENT_ERRORS, retry, deadline_scope, remaining_seconds, request_deadline
+
+NO_DELAY = RetryPolicy(max_attempts=3, base_delay_seconds=0, max_delay_seconds=0)
+
+def is_transient(exception: Exception) -> bool:
+    return isinstance(exception, TRANSIENT_ERRORS)
+
+def test_backoff_is_jittered_and_capped():
+    policy = RetryPolicy(max_attempts=5, base_delay_seconds=1, max_delay_seconds=3)
+    for attempt in range(5):
+        assert 0 <= policy.backoff_seconds(attempt) <= min(3, 2 ** attempt)
+
+@pytest.mark.asyncio
+async def test_retry_retryable_errors():
+    calls = 0
+    async def function():
+        nonlocal calls
+        calls += 1
+        if calls < 3:
+            raise ServiceUnavailable("unavailable")
+        return "result"
+
+    assert await retry(function, NO_DELAY, is_transient) == "result"
+    assert calls == 3
+
+@pytest.mark.asyncio
+async def test_retry_gives_up():
+    calls = 0
+    async def function():
+        nonlocal calls
+        calls += 1
+        raise ServiceUnavailable("unavailable")
+
+    with pytest.raises(ServiceUnavailable):
+        await retry(function, NO_DELAY, is_transient)
+    assert calls == 3
+
+@pytest.mark.asyncio
+async def test_retry_not_retryable_errors():
+    calls = 0
+    async def function():
+        nonlocal calls
+        calls += 1
+        raise ValueError("invalid")
+
+    with pytest.raises(ValueError):
+        await retry(function, NO_DELAY, is_transient)
+    assert calls == 1
+
+@pytest.mark.asyncio
+async def test_retry_respects_deadline():
+    request_deadline.set(time.monotonic() + 0.01)
+    calls = 0
+    async def function():
+        nonlocal calls
+        calls += 1
+        raise ServiceUnavailable("unavailable")
+
+    with pytest.raises(ServiceUnavailable):
+        await retry(function, RetryPolicy(max_attempts=3, base_delay_seconds=1, max_delay_seconds=1), lambda _: True)
+    # a retry is only made if the random backoff fits into the deadline
+    assert calls <= 2
+
+@pytest.mark.asyncio
+async def test_deadline_scope():
+    async with deadline_scope():
+        await asyncio.sleep(0)
+
+    request_deadline.set(time.monotonic() + 0.01)
+    assert 0 < remaining_seconds() <= 0.01
+    with pytest.raises(GatewayTimeout):
+        async with deadline_scope():
+            await asyncio.sleep(1)
+    with pytest.raises(GatewayTimeout):
+        async with deadline_scope():
+            pass
+
+@pytest.mark.asyncio
+async def test_deadline_middleware():
+    deadlines = []
+    async def app(scope, receive, send):
+        deadlines.append(remaining_seconds())
+    middleware = DeadlineMiddleware(app, default_timeout_seconds=60)
+
+    await middleware({"type": "http", "headers": []}, None, None)
+    await middleware({"type": "http", "headers": [(b"x-request-timeout", b"5")]}, None, None)
+    await middleware({"type": "http", "headers": [(b"x-request-timeout", b"600")]}, None, None)
+    await middleware({"type": "http", "headers": [(b"x-request-timeout", b"invalid")]}, None, None)
+    assert 59 < deadlines[0] <= 60
+    assert 4 < deadlines[1] <= 5
+    assert 59 < deadlines[2] <= 60
+    assert 59 < deadlines[3] <= 60
+
+@pytest.mark.asyncio
+async def test_deadline_middleware_exempt_paths():
+    deadlines = []
+    async def app(scope, receive, send):
+        deadlines.append(remaining_seconds())
+    middleware = DeadlineMiddleware(app, default_timeout_seconds=60, exempt_paths=("/poems:batch",))
+
+    await middleware({"type": "http", "path": "/poems:batch", "headers": [(b"x-request-timeout", b"5")]}, None, None)
+    await middleware({"type": "http", "path": "/print_poem", "headers": [(b"x-request-timeout", b"5")]}, None, None)
+    assert deadlines[0] is None
+    assert 4 < deadlines[1] <= 5
+
+@pytest.mark.asyncio
+async def test_hedger_hedges_slow_calls():
+    hedger = Hedger(quantile=0.5, min_samples=2)
+    async def fast():
+        return "fast"
+    await hedger.run(fast)
+    await hedger.run(fast)
+    assert hedger.delay_seconds is not None
+
+    calls = 0
+    async def slow_then_fast():
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            await asyncio.sleep(1)
+            return "slow"
+        return "hedged"
+
+    start = time.monotonic()
+    assert await hedger.run(slow_then_fast) == "hedged"
+    assert time.monotonic() - start < 0.5
+    assert hedger.hedged == 1
+    assert hedger.hedge_wins == 1
+
+@pytest.mark.asyncio
+async def test_hedger_without_latencies_does_not_hedge():
+    hedger = Hedger()
+    async def failing():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        await hedger.run(failing)
+    assert hedger.hedged == 0
@@ -1,8 +1,14 @@
 from unittest.mock import AsyncMock, patch, MagicMock
+import asyncio
+import time
 import pytest
-from TtsUtils import TtsUtils
+from TtsUtils import TtsUtils, AudioFormat
 from google.cloud.texttospeech import SsmlVoiceGender, VoiceSelectionParams, AudioConfig, AudioEncoding, SynthesisInput
 from connexion.exceptions import InternalServerError
+from CacheUtils import BytesCache, LruCache, FileCache
+from RetryUtils import RetryPolicy, request_deadline
+from google.api_core.exceptions import ServiceUnavailable
+from constants import REQUEST_TIMEOUT_SECONDS
 
 
 TEXT = "some text"
@@ -97,6 +103,169 @@ async def test_synthesize_ok_non_hq_voice_not_matching_gender(synthesize_mock: A
     synthesize_mock.assert_awaited_once_with(input = SynthesisInput(text=TEXT), voice = VoiceSelectionParams(language_code=language, name="Other_Male"), audio_config=AUDIO_CONFIG)
     assert result == AUDIO
 
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.list_voices")
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.synthesize_speech")
+@pytest.mark.asyncio
+async def test_synthesize_voice_catalog_cached(synthesize_mock: AsyncMock, list_voices_mock: AsyncMock):
+    tts_utils = TtsUtils()
+    language = "en"
+    voices = [mock_voice(language, SsmlVoiceGender.MALE, "Neural_Male"),
+              mock_voice(language, SsmlVoiceGender.FEMALE, "Other_Female")]
+    list_voices_mock.return_value = MagicMock(voices=voices)
+    synthesize_mock.return_value = MagicMock(audio_content = AUDIO)
+
+    await asyncio.gather(tts_utils.synthesize(TEXT, language, "female"), tts_utils.synthesize(TEXT, language, "female"))
+    await tts_utils.synthesize(TEXT, language, "male")
+    await tts_utils.synthesize("other text", language, "unspecified")
+    list_voices_mock.assert_called_once_with(language_code = language)
+    assert synthesize_mock.await_args_list[0].kwargs["voice"] == VoiceSelectionParams(language_code=language, name="Other_Female")
+    assert synthesize_mock.await_args_list[-2].kwargs["voice"] == VoiceSelectionParams(language_code=language, name="Neural_Male")
+    assert synthesize_mock.await_args_list[-1].kwargs["voice"] == VoiceSelectionParams(language_code=language, name="Neural_Male")
+
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.list_voices")
+@pytest.mark.asyncio
+async def test_voice_index_bounded(list_voices_mock: AsyncMock):
+    tts_utils = TtsUtils(voice_catalog_max_languages=2)
+    list_voices_mock.side_effect = lambda language_code: MagicMock(voices=[] if language_code == "xx-YY" else [mock_voice(language_code, SsmlVoiceGender.FEMALE, "Neural_Female")])
+
+    assert await tts_utils._find_voice("EN_us", SsmlVoiceGender.FEMALE) == VoiceSelectionParams(language_code="en-US", name="Neural_Female")
+    assert await tts_utils._find_voice("en-US", SsmlVoiceGender.FEMALE) is not None
+    list_voices_mock.assert_called_once_with(language_code="en-US")
+    # languages without voices aren't indexed
+    assert await tts_utils._find_voice("xx-yy", SsmlVoiceGender.FEMALE) is None
+    await tts_utils._find_voice("de", SsmlVoiceGender.FEMALE)
+    await tts_utils._find_voice("en-US", SsmlVoiceGender.FEMALE)
+    await tts_utils._find_voice("fr", SsmlVoiceGender.FEMALE)
+    # the least recently used language was evicted
+    assert list(tts_utils._voice_index) == ["en-US", "fr"]
+
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.list_voices")
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.synthesize_speech")
+@pytest.mark.asyncio
+async def test_synthesize_voice_catalog_refreshed(synthesize_mock: AsyncMock, list_voices_mock: AsyncMock):
+    tts_utils = TtsUtils(voice_catalog_refresh_seconds=0)
+    language = "en"
+    list_voices_mock.return_value = MagicMock(voices=[mock_voice(language, SsmlVoiceGender.FEMALE, "Other_Female")])
+    synthesize_mock.return_value = MagicMock(audio_content = AUDIO)
+    await tts_utils.preload_voices([language])
+
+    # the outdated catalog is used while the refresh runs in the background
+    list_voices_mock.return_value = MagicMock(voices=[mock_voice(language, SsmlVoiceGender.FEMALE, "Neural_Female")])
+    await tts_utils.synthesize(TEXT, language, "female")
+    await asyncio.sleep(0)
+    await tts_utils.synthesize(TEXT, language, "female")
+    assert list_voices_mock.call_count >= 2
+    assert synthesize_mock.await_args_list[0].kwargs["voice"].name == "Other_Female"
+    assert synthesize_mock.await_args_list[1].kwargs["voice"].name == "Neural_Female"
+
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.list_voices")
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.synthesize_speech")
+@pytest.mark.asyncio
+async def test_synthesize_audio_cached(synthesize_mock: AsyncMock, list_voices_mock: AsyncMock):
+    tts_utils = TtsUtils()
+    language = "en"
+    list_voices_mock.return_value = MagicMock(voices=[mock_voice(language, SsmlVoiceGender.FEMALE, "Neural_Female")])
+    synthesize_mock.return_value = MagicMock(audio_content = AUDIO)
+
+    assert await tts_utils.synthesize(TEXT, language, "female") == AUDIO
+    assert await tts_utils.synthesize(TEXT, language, "female") == AUDIO
+    synthesize_mock.assert_awaited_once()
+    await tts_utils.synthesize("other text", language, "female")
+    assert synthesize_mock.await_count == 2
+
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.list_voices")
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.synthesize_speech")
+@pytest.mark.asyncio
+async def test_synthesize_audio_cached_on_disk(synthesize_mock: AsyncMock, list_voices_mock: AsyncMock, tmp_path):
+    language = "en"
+    list_voices_mock.return_value = MagicMock(voices=[mock_voice(language, SsmlVoiceGender.FEMALE, "Neural_Female")])
+    synthesize_mock.return_value = MagicMock(audio_content = AUDIO)
+    await TtsUtils(audio_cache=BytesCache(LruCache(0), FileCache(str(tmp_path), 1024))).synthesize(TEXT, language, "female")
+
+    result = await TtsUtils(audio_cache=BytesCache(LruCache(0), FileCache(str(tmp_path), 1024))).synthesize(TEXT, language, "female")
+    assert isinstance(result, memoryview)
+    assert result == AUDIO
+    synthesize_mock.assert_awaited_once()
+
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.list_voices")
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.synthesize_speech")
+@pytest.mark.asyncio
+async def test_synthesize_stream_in_order(synthesize_mock: AsyncMock, list_voices_mock: AsyncMock):
+    tts_utils = TtsUtils()
+    language = "en"
+    list_voices_mock.return_value = MagicMock(voices=[mock_voice(language, SsmlVoiceGender.FEMALE, "Neural_Female")])
+    running = 0
+    max_running = 0
+    async def synthesize(input, voice, audio_config):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        # later texts finish first
+        await asyncio.sleep(0.01 * (5 - len(input.text)))
+        running -= 1
+        return MagicMock(audio_content = bytes(input.text, "utf-8"))
+    synthesize_mock.side_effect = synthesize
+
+    async def texts():
+        for text in ["a", "bb", "ccc", "dddd"]:
+            yield text
+
+    chunks = [chunk async for chunk in tts_utils.synthesize_stream(texts(), language, "female", concurrency=2)]
+    assert chunks == [b"a", b"bb", b"ccc", b"dddd"]
+    assert max_running == 2
+
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.list_voices")
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.synthesize_speech")
+@pytest.mark.asyncio
+async def test_synthesize_stream_failing_texts(synthesize_mock: AsyncMock, list_voices_mock: AsyncMock):
+    tts_utils = TtsUtils()
+    language = "en"
+    list_voices_mock.return_value = MagicMock(voices=[mock_voice(language, SsmlVoiceGender.FEMALE, "Neural_Female")])
+    synthesize_mock.return_value = MagicMock(audio_content = AUDIO)
+
+    async def texts():
+        yield TEXT
+        raise InternalServerError("generation failed")
+
+    chunks = []
+    with pytest.raises(InternalServerError):
+        async for chunk in tts_utils.synthesize_stream(texts(), language, "female"):
+            chunks.append(chunk)
+    assert chunks == [AUDIO]
+
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.list_voices")
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.synthesize_speech")
+@pytest.mark.asyncio
+async def test_synthesize_coalesced(synthesize_mock: AsyncMock, list_voices_mock: AsyncMock):
+    tts_utils = TtsUtils()
+    language = "en"
+    list_voices_mock.return_value = MagicMock(voices=[mock_voice(language, SsmlVoiceGender.FEMALE, "Neural_Female")])
+    async def synthesize(input, voice, audio_config):
+        await asyncio.sleep(0.01)
+        return MagicMock(audio_content = AUDIO)
+    synthesize_mock.side_effect = synthesize
+
+    results = await asyncio.gather(*[tts_utils.synthesize(TEXT, language, "female") for _ in range(5)])
+    assert results == [AUDIO] * 5
+    synthesize_mock.assert_awaited_once()
+    assert tts_utils.single_flight.leaders == 1
+    assert tts_utils.single_flight.coalesced == 4
+
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.list_voices")
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.synthesize_speech")
+@pytest.mark.asyncio
+async def test_synthesize_retried_with_deadline(synthesize_mock: AsyncMock, list_voices_mock: AsyncMock):
+    tts_utils = TtsUtils(retry_policy=RetryPolicy(max_attempts=3, base_delay_seconds=0, max_delay_seconds=0))
+    language = "en"
+    list_voices_mock.return_value = MagicMock(voices=[mock_voice(language, SsmlVoiceGender.FEMALE, "Neural_Female")])
+    synthesize_mock.side_effect = [ServiceUnavailable("unavailable"), MagicMock(audio_content = AUDIO)]
+    request_deadline.set(time.monotonic() + 10)
+
+    assert await tts_utils.synthesize(TEXT, language, "female") == AUDIO
+    assert synthesize_mock.await_count == 2
+    # the synthesis is shared with concurrent requests, so it gets the default request timeout, while the caller waits until its deadline
+    assert 10 < synthesize_mock.await_args.kwargs["timeout"] <= REQUEST_TIMEOUT_SECONDS
+
 def mock_voice(language: str, gender: SsmlVoiceGender, name: str) -> MagicMock:
     mock = MagicMock(ssml_gender = gender, language_codes=[language])
     mock.name = name # cannot be given in constructor because then it's the name of the mock
@@ -104,4 +273,22 @@ def mock_voice(language: str, gender: SsmlVoiceGender, name: str) -> MagicMock:
 
     
     
-    
\ No newline at end of file
+    
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.list_voices")
+@patch("google.cloud.texttospeech.TextToSpeechAsyncClient.synthesize_speech")
+@pytest.mark.asyncio
+async def test_synthesize_audio_formats(synthesize_mock: AsyncMock, list_voices_mock: AsyncMock):
+    tts_utils = TtsUtils()
+    language = "en"
+    list_voices_mock.return_value = MagicMock(voices=[mock_voice(language, SsmlVoiceGender.FEMALE, "Neural_Female")])
+    synthesize_mock.return_value = MagicMock(audio_content = AUDIO)
+    audio_format = AudioFormat("ogg_opus", 16000, 1.25)
+
+    await tts_utils.synthesize(TEXT, language, "female", audio_format)
+    assert synthesize_mock.await_args.kwargs["audio_config"] == AudioConfig(audio_encoding=AudioEncoding.OGG_OPUS, sample_rate_hertz=16000, speaking_rate=1.25)
+    await tts_utils.synthesize(TEXT, language, "female", AudioFormat("ogg_opus", 16000, 1.25))
+    # cached per format
+    assert synthesize_mock.await_count == 1
+    await tts_utils.synthesize(TEXT, language, "female")
+    assert synthesize_mock.await_args.kwargs["audio_config"] == AUDIO_CONFIG
+    assert synthesize_mock.await_count == 2
@@ -0,0 +1,22 @@
+import pytest
+from benchmarks.fakes import Latency, FakeGenerativeModel
+from benchmarks.harness import run, percentile
+
+def test_latency_distribution():
+    latency = Latency(median_seconds=0.1, p99_seconds=1.0)
+    samples = sorted(latency.sample() for _ in range(10000))
+    assert 0.08 < percentile(samples, 0.5) < 0.12
+    assert 0.7 < percentile(samples, 0.99) < 1.4
+    assert Latency(0.1).sample() == 0.1
+
+@pytest.mark.asyncio
+async def test_run_in_process():
+    gemini = FakeGenerativeModel()
+    results = await run(["/print_poem", "/read_poem"], [1, 4], duration_seconds=0.1, topics=10, gemini=gemini)
+    assert [(result.path, result.concurrency) for result in results] == [("/print_poem", 1), ("/print_poem", 4), ("/read_poem", 1), ("/read_poem", 4)]
+    for result in results:
+        assert result.requests > 0
+        assert result.errors == 0
+        assert result.p50_ms <= result.p95_ms <= result.p99_ms <= result.max_ms
+        assert result.max_rss_mib > 0
+    assert gemini.calls > 0
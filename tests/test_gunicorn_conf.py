@@ -0,0 +1,34 @@
+import importlib.util
+import os
+import pytest
+
+def load_config():
+    spec = importlib.util.spec_from_file_location("gunicorn_conf", os.path.join(os.path.dirname(__file__), "..", "gunicorn.conf.py"))
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    return config
+
+@pytest.fixture
+def config(monkeypatch):
+    monkeypatch.setenv("WEB_CONCURRENCY", "2")
+    monkeypatch.setenv("CACHE_DIRECTORY", "/tmp/poem-api-test")
+    return load_config()
+
+def test_workers_from_environment(config):
+    assert config.workers == 2
+    assert config.preload_app
+    assert config.worker_class == "uvicorn.workers.UvicornWorker"
+
+def test_cpu_limit_cgroup_v2(config, tmp_path):
+    (tmp_path / "cpu.max").write_text("150000 100000\n")
+    assert config.cpu_limit(str(tmp_path)) == min(2, len(os.sched_getaffinity(0)))
+    (tmp_path / "cpu.max").write_text("max 100000\n")
+    assert config.cpu_limit(str(tmp_path)) == len(os.sched_getaffinity(0))
+
+def test_cpu_limit_cgroup_v1(config, tmp_path):
+    (tmp_path / "cpu").mkdir()
+    (tmp_path / "cpu" / "cpu.cfs_quota_us").write_text("50000\n")
+    (tmp_path / "cpu" / "cpu.cfs_period_us").write_text("100000\n")
+    assert config.cpu_limit(str(tmp_path)) == 1
+    (tmp_path / "cpu" / "cpu.cfs_quota_us").write_text("-1\n")
+    assert config.cpu_limit(str(tmp_path)) == len(os.sched_getaffinity(0))
@@ -1,24 +1,69 @@
+import asyncio
 import main
 from httpx import Response
+import base64
+import hashlib
+import json
+import time
 from unittest.mock import MagicMock
 from PoemUtils import PoemUtils
-from AuthorizationUtils import AuthorizationUtils
+from AuthorizationUtils import AuthorizationUtils, ApiKey
+from RateLimitUtils import RateLimiter, MemoryBucketStore
 from connexion.exceptions import Unauthorized
-from TtsUtils import TtsUtils
+from TtsUtils import TtsUtils, AudioFormat
+from connexion.exceptions import InternalServerError
+from ConcurrencyUtils import Overloaded
+from RetryUtils import deadline_scope
 
 
 class MockPoemUtils(PoemUtils):
     async def generate_poem(self, language: str, max_length: int, topic: str | None) -> str:
+        if topic == "unsafe":
+            raise InternalServerError("generation failed, finish reason is not STOP but SAFETY")
+        if topic == "busy":
+            raise Overloaded("Gemini", 3)
+        if topic == "slow":
+            async with deadline_scope():
+                await asyncio.sleep(0.2)
         return f"This is a poem about {topic} in {language} with the maximum length {max_length}."
+
+    async def stream_poem(self, language: str, max_length: int, topic: str | None):
+        yield f"This is a poem about {topic}\n\n"
+        yield f"in {language} with the maximum length {max_length}."
+
+    async def preload_model(self) -> None:
+        pass
     
+class FailingMockPoemUtils(MockPoemUtils):
+    async def stream_poem(self, language: str, max_length: int, topic: str | None):
+        yield "This is a poem\n"
+        raise InternalServerError("generation failed, finish reason is not STOP but SAFETY")
+
 class MockAuthorizationUtils(AuthorizationUtils):
-    async def check_api_key(self, api_key: str) -> None:
+    async def check_api_key(self, api_key: str) -> ApiKey:
+        if api_key == "limited":
+            return ApiKey("limited", tokens_per_minute=1, burst=5)
         if api_key != "correct":
             raise Unauthorized("Wrong API key")
+        return ApiKey("test")
+
+    async def preload_key(self) -> None:
+        raise Unauthorized("Data corruption detected")
 
 class MockTtsUtils(TtsUtils):
-    async def synthesize(self, text: str, language: str, gender: str) -> bytes:
+    syntheses = 0
+
+    async def audio_key(self, text: str, language: str, gender: str, audio_format: AudioFormat = AudioFormat()) -> str:
+        return hashlib.sha256(f"{text} {language} {gender} {audio_format}".encode("utf-8")).hexdigest()
+
+    async def synthesize(self, text: str, language: str, gender: str, audio_format: AudioFormat = AudioFormat()) -> bytes:
+        self.syntheses += 1
+        if audio_format != AudioFormat():
+            text = f"{text} As {audio_format.encoding}."
         return bytes(f"{text} Synthesized with a {gender} voice in {language}.", "utf-8")
+
+    async def preload_voices(self, languages: list[str]) -> None:
+        pass
         
 class TestMain:
 
@@ -27,18 +72,169 @@ class TestMain:
         main.poem_utils = MockPoemUtils()
         main.authorization_utils = MockAuthorizationUtils()
         main.tts_utils = MockTtsUtils()
+        main.rate_limiter = RateLimiter(MemoryBucketStore(), tokens_per_minute=0)
+
+    def test_ready(self):
+        # entering the client runs the lifespan, which starts the warm-up
+        with main.app.test_client() as client:
+            for _ in range(100):
+                response = client.get("/ready")
+                if response.status_code == 200:
+                    break
+                time.sleep(0.01)
+        assert response.status_code == 200
+        assert response.json()["ready"]
+        assert set(response.json()["warm_up_seconds"]) == {"generative_model", "tts", "api_key"}
+        assert response.json()["warm_up_failures"] == ["api_key"]
+
+    def test_metrics(self):
+        self.test_client.get("/print_poem?lang=en&max_length=12&topic=flowers&api_key=wrong")
+        response = self.test_client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["Content-Type"].startswith("text/plain")
+        assert 'poem_request_duration_seconds_count{path="/print_poem",status="401"}' in response.text
+        assert 'poem_upstream_concurrency_limit{upstream="gemini"}' in response.text
 
     def test_print_poem_ok(self):
         response = self.test_client.get("/print_poem?lang=en&max_length=12&topic=flowers&api_key=correct")
         assert response.status_code == 200
         assert response.text == "This is a poem about flowers in en with the maximum length 12."
 
+    def test_rate_limit(self):
+        response = self.test_client.get("/print_poem?lang=en&max_length=12&topic=flowers&api_key=limited")
+        assert response.status_code == 200
+        assert response.headers["ratelimit-limit"] == "5"
+        assert response.headers["ratelimit-remaining"] == "4"
+        assert response.headers["ratelimit-reset"] == "60"
+        response = self.test_client.get("/read_poem?lang=en&max_length=12&topic=flowers&gender=female&api_key=limited")
+        assert response.status_code == 200
+        assert response.headers["ratelimit-remaining"] == "0"
+        response = self.test_client.get("/print_poem?lang=en&max_length=12&topic=flowers&api_key=limited")
+        assert response.status_code == 429
+        assert 0 < int(response.headers["retry-after"]) <= 60
+        assert response.headers["ratelimit-remaining"] == "0"
+        # the bucket of another api key isn't affected
+        response = self.test_client.get("/print_poem?lang=en&max_length=12&topic=flowers&api_key=correct")
+        assert response.status_code == 200
+        assert "ratelimit-limit" not in response.headers
+        # a batch costing more than the burst could never be accepted
+        items = [{"topic": "flowers", "audio": True}, {"topic": "trees", "audio": True}]
+        response = self.test_client.post("/poems:batch?api_key=limited", json={"items": items})
+        assert response.status_code == 413
+        assert "8 tokens" in response.json()["detail"]
+        metrics = self.test_client.get("/metrics").text
+        assert 'poem_rate_limit_requests_total{result="rejected"} 2' in metrics
+        # the unauthenticated metrics don't reveal the names of the api keys
+        assert "limited" not in metrics
+
     def test_print_poem_wrong_api_key(self):
         response = self.test_client.get("/print_poem?lang=en&max_length=12&topic=flowers&api_key=wrong")
         assert response.status_code == 401
 
+    def test_print_poem_overloaded(self):
+        response = self.test_client.get("/print_poem?lang=en&max_length=12&topic=busy&api_key=correct")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "3"
+
+    def test_stream_poem_ok(self):
+        response = self.test_client.get("/stream_poem?lang=en&max_length=12&topic=flowers&api_key=correct")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        assert response.text == ("event: line\ndata: This is a poem about flowers\n\n"
+                                 "event: line\ndata: \n\n"
+                                 "event: line\ndata: in en with the maximum length 12.\n\n"
+                                 "event: done\ndata: \n\n")
+
+    def test_stream_poem_error(self):
+        main.poem_utils = FailingMockPoemUtils()
+        try:
+            response = self.test_client.get("/stream_poem?lang=en&max_length=12&topic=flowers&api_key=correct")
+        finally:
+            main.poem_utils = MockPoemUtils()
+        assert response.status_code == 200
+        assert response.text.startswith("event: line\ndata: This is a poem\n\nevent: error\ndata: ")
+        assert '"status": 500' in response.text
+
+    def test_stream_poem_wrong_api_key(self):
+        response = self.test_client.get("/stream_poem?lang=en&max_length=12&topic=flowers&api_key=wrong")
+        assert response.status_code == 401
+
     def test_read_poem_ok(self):
         response = self.test_client.get("/read_poem?lang=en&max_length=12&topic=flowers&gender=female&api_key=correct")
         assert response.status_code == 200
         assert response.content == bytes("This is a poem about flowers in en with the maximum length 12. Synthesized with a female voice in en.", "utf-8")
+        assert response.headers["content-length"] == str(len(response.content))
+        assert response.headers["accept-ranges"] == "bytes"
+        assert response.headers["cache-control"].startswith("private, max-age=")
+
+    def test_read_poem_range_and_etag(self):
+        url = "/read_poem?lang=en&max_length=12&topic=flowers&gender=female&api_key=correct"
+        etag = self.test_client.get(url).headers["etag"]
+        response = self.test_client.get(url, headers={"Range": "bytes=0-3", "If-Range": etag})
+        assert response.status_code == 206
+        assert response.content == b"This"
+        assert response.headers["content-range"] == "bytes 0-3/101"
+        syntheses = main.tts_utils.syntheses
+        response = self.test_client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers["etag"] == etag
+        # the current copy is confirmed without synthesizing the audio
+        assert main.tts_utils.syntheses == syntheses
+
+    def test_print_poem_from_pool(self):
+        main.poem_pool = MagicMock(take_poem=MagicMock(return_value="A pooled poem."))
+        try:
+            response = self.test_client.get("/print_poem?lang=en&max_length=12&topic=flowers&api_key=correct")
+        finally:
+            main.poem_pool = None
+        assert response.status_code == 200
+        assert response.text == "A pooled poem."
 
+    def test_read_poem_format(self):
+        url = "/read_poem?lang=en&max_length=12&topic=flowers&gender=female&api_key=correct"
+        response = self.test_client.get(url + "&format=ogg_opus")
+        assert response.headers["content-type"] == "audio/ogg"
+        assert response.content.endswith(b"As ogg_opus. Synthesized with a female voice in en.")
+        response = self.test_client.get(url, headers={"Accept": "audio/mpeg;q=0.5, audio/wav"})
+        assert response.headers["content-type"] == "audio/wav"
+        assert response.headers["vary"] == "Accept"
+        response = self.test_client.get(url + "&stream=true", headers={"Accept": "audio/wav, audio/ogg;q=0.1"})
+        assert response.headers["content-type"] == "audio/ogg"
+        response = self.test_client.get(url + "&stream=true&format=linear16")
+        assert response.status_code == 400
+
+    def test_read_poem_stream_ok(self):
+        response = self.test_client.get("/read_poem?lang=en&max_length=12&topic=flowers&gender=female&stream=true&api_key=correct")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "audio/mpeg"
+        assert response.content == bytes("This is a poem about flowers Synthesized with a female voice in en.in en with the maximum length 12. Synthesized with a female voice in en.", "utf-8")
+
+    def test_batch_poems_ok(self):
+        items = [{"language": "en", "max_length": 12, "topic": "flowers"},
+                 {"language": "de", "topic": "unsafe"},
+                 {"language": "nl-BE", "topic": "Gent", "audio": True, "gender": "female"}]
+        response = self.test_client.post("/poems:batch?api_key=correct", json={"items": items, "concurrency": 2})
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        results = sorted((json.loads(line) for line in response.text.splitlines()), key=lambda result: result["index"])
+        assert results[0] == {"index": 0, "poem": "This is a poem about flowers in en with the maximum length 12."}
+        assert results[1]["error"]["status"] == 500
+        assert results[2]["poem"] == "This is a poem about Gent in nl-BE with the maximum length 12."
+        assert base64.b64decode(results[2]["audio"]) == bytes(f"{results[2]['poem']} Synthesized with a female voice in nl-BE.", "utf-8")
+
+    def test_batch_poems_deadline_per_item(self):
+        items = [{"topic": "slow"}] * 3
+        # the batch takes longer than the timeout, its items don't
+        response = self.test_client.post("/poems:batch?api_key=correct", json={"items": items, "concurrency": 1}, headers={"X-Request-Timeout": "0.3"})
+        assert [json.loads(line).get("poem") is not None for line in response.text.splitlines()] == [True] * 3
+        response = self.test_client.post("/poems:batch?api_key=correct", json={"items": items, "concurrency": 1}, headers={"X-Request-Timeout": "0.1"})
+        assert [json.loads(line)["error"]["status"] for line in response.text.splitlines()] == [504] * 3
+
+    def test_batch_poems_invalid(self):
+        response = self.test_client.post("/poems:batch?api_key=correct", json={"items": [{"max_length": 100}]})
+        assert response.status_code == 400
+
+    def test_batch_poems_wrong_api_key(self):
+        response = self.test_client.post("/poems:batch?api_key=wrong", json={"items": [{"topic": "flowers"}]})
+        assert response.status_code == 401